@@ -0,0 +1,404 @@
+"""
+日语词汇PPT图片增强工具 - 离线基准测试
+在本地启动模拟的搜索/AI提供商和图片主机，不消耗真实API配额地测量端到端吞吐量
+
+用法示例：
+    python benchmark.py
+    python benchmark.py --synthetic-slides 60 --provider-latency 0.3 --image-latency 0.5 --error-rate 0.1
+    python benchmark.py --options '{"max_slides_in_flight": 4, "hedged_download_fanout": 4}' --json result.json
+"""
+
+import os
+import io
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+import multiprocessing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+BUNDLED_DECK = os.path.join(os.path.dirname(os.path.abspath(__file__)), "日语初级词汇第6课.pptx")
+
+# 合成PPT使用的词汇
+SYNTHETIC_WORDS = [
+    "りんご", "みかん", "いぬ", "ねこ", "とけい", "かばん", "くるま", "でんしゃ", "がっこう", "びょういん",
+    "としょかん", "ぎんこう", "つくえ", "いす", "ほん", "しんぶん", "てがみ", "かさ", "くつ", "ぼうし",
+]
+
+# 模拟图片主机的数量：图片分散在多个主机名（127.0.0.2起的回环地址）上，
+# 与真实情况一样，单个主机出错熔断不会让所有图片都无法下载
+IMAGE_HOSTS = 8
+
+
+class MockProviderHandler(BaseHTTPRequestHandler):
+    """
+    模拟的提供商和图片主机
+
+    路由：
+        GET  /customsearch/v1          Google Custom Search
+        GET  /google/search            Google图片搜索页面（爬虫）
+        GET  /serp/search              Serp API
+        POST /exa/search               EXA API
+        POST /gemini                   Gemini generateContent
+        POST /spark/chat/completions   Spark（OpenAI兼容）
+        POST /ollama/api/generate      Ollama
+        GET  /img/<n>.jpg              图片
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _config(self):
+        return self.server.config
+
+    def _delay(self, latency):
+        if latency > 0:
+            # 在设定值附近随机波动，模拟真实网络
+            time.sleep(random.uniform(0.5, 1.5) * latency)
+
+    def _send(self, status, body, content_type='application/json', headers=None):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        elif isinstance(body, str):
+            body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _fail(self, is_image=False):
+        """按错误率随机返回错误（图片主机还会返回防盗链HTML页面）"""
+        if random.random() >= self._config()['error_rate']:
+            return False
+        if is_image and random.random() < 0.5:
+            self._send(200, '<html><body>hotlink denied</body></html>' + ' ' * 2000, 'text/html')
+        else:
+            self._send(random.choice([429, 500, 503]), {'error': 'mock failure'})
+        return True
+
+    def _image_urls(self, query, count):
+        """为关键词生成候选图片URL（同一关键词总是得到相同的URL，依次分布在各个图片主机上）"""
+        seed = abs(hash(query)) % 100000
+        hosts = self.server.image_hosts
+        return [f"http://{hosts[(seed + i) % len(hosts)]}/img/{seed}_{i}.jpg" for i in range(count)]
+
+    def do_GET(self):
+        config = self._config()
+        parsed = urlparse(self.path)
+        params = parse_qs(parsed.query)
+
+        if parsed.path.startswith('/img/'):
+            self._delay(config['image_latency'])
+            if self._fail(is_image=True):
+                return
+            images = self.server.images
+            index = abs(hash(parsed.path)) % len(images)
+            self._send(200, images[index], 'image/jpeg')
+            return
+
+        self._delay(config['provider_latency'])
+        if self._fail():
+            return
+        query = params.get('q', [''])[0]
+        if parsed.path == '/customsearch/v1':
+            count = int(params.get('num', ['4'])[0])
+            self._send(200, {'items': [{'link': url} for url in self._image_urls(query, count)]})
+        elif parsed.path == '/serp/search':
+            count = max(4, int(params.get('num', ['4'])[0]))
+            self._send(200, {'images_results': [{'original': url} for url in self._image_urls(query, count)]})
+        elif parsed.path == '/google/search':
+            self._send(200, '<html><body>no results</body></html>', 'text/html')
+        else:
+            self._send(404, {'error': 'not found'})
+
+    def do_POST(self):
+        config = self._config()
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            payload = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            payload = {}
+        path = urlparse(self.path).path
+
+        if path == '/exa/search':
+            self._delay(config['provider_latency'])
+            if self._fail():
+                return
+            count = int(payload.get('num_results', 4))
+            self._send(200, {'results': [{'url': url} for url in self._image_urls(payload.get('query', ''), count)]})
+            return
+
+        self._delay(config['llm_latency'])
+        if self._fail():
+            return
+        if path == '/gemini':
+            prompt = payload['contents'][0]['parts'][0]['text']
+            self._send(200, {'candidates': [{'content': {'parts': [{'text': self._llm_answer(prompt)}]}}]})
+        elif path == '/spark/chat/completions':
+            prompt = payload['messages'][-1]['content']
+            self._send(200, {'choices': [{'message': {'content': self._llm_answer(prompt)}}]})
+        elif path == '/ollama/api/generate':
+            self._send(200, {'response': self._llm_answer(payload.get('prompt', ''))})
+        else:
+            self._send(404, {'error': 'not found'})
+
+    @staticmethod
+    def _llm_answer(prompt):
+        """批量优化时返回JSON映射，单个优化时返回一个英文关键词"""
+        match = re.search(r'Input: (\[.*?\])', prompt, re.DOTALL)
+        if match:
+            keywords = json.loads(match.group(1))
+            return json.dumps({keyword: f"picture of item {i}" for i, keyword in enumerate(keywords)})
+        return "japanese vocabulary picture"
+
+
+def make_mock_images(width, height, variants=12):
+    """生成若干张不同内容的JPEG图片（带噪点，压缩后大小接近真实照片）"""
+    from PIL import Image
+    images = []
+    for i in range(variants):
+        noise = Image.effect_noise((width, height), 40 + i * 5).convert('RGB')
+        tint = Image.new('RGB', (width, height), ((i * 67) % 256, (i * 131) % 256, (i * 29) % 256))
+        buf = io.BytesIO()
+        Image.blend(noise, tint, 0.5).save(buf, 'JPEG', quality=90)
+        images.append(buf.getvalue())
+    return images
+
+
+def _start_mock_server(address, config, images):
+    """在后台线程中启动一个模拟服务，返回server对象"""
+    server = ThreadingHTTPServer((address, 0), MockProviderHandler)
+    server.daemon_threads = True
+    server.config = config
+    server.images = images
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run_mock_server(config, port_queue, stop_event):
+    """
+    在独立进程中运行模拟服务（不占用被测进程的内存和GIL）
+
+    提供商在127.0.0.1上；图片主机绑定127.0.0.2起的回环地址，每个主机名独立熔断。
+    不支持绑定这些地址的平台（如macOS）退回到127.0.0.1的不同端口，此时所有图片共用一个熔断状态。
+    """
+    random.seed(config.get('seed', 0))
+    images = make_mock_images(*config['image_size'])
+    servers = [_start_mock_server('127.0.0.1', config, images)]
+    for i in range(IMAGE_HOSTS):
+        try:
+            servers.append(_start_mock_server(f"127.0.0.{i + 2}", config, images))
+        except OSError:
+            servers.append(_start_mock_server('127.0.0.1', config, images))
+    image_hosts = [f"{host}:{port}" for host, port in (server.server_address for server in servers[1:])]
+    for server in servers:
+        server.image_hosts = image_hosts
+    port_queue.put({'port': servers[0].server_address[1], 'image_hosts': image_hosts})
+    stop_event.wait()
+    for server in servers:
+        server.shutdown()
+
+
+def make_synthetic_deck(path, slides):
+    """生成合成PPT：每页一个日语词汇及其读音"""
+    from pptx import Presentation
+    from pptx.util import Inches
+    prs = Presentation()
+    for i in range(slides):
+        slide = prs.slides.add_slide(prs.slide_layouts[6])
+        word = SYNTHETIC_WORDS[i % len(SYNTHETIC_WORDS)]
+        box = slide.shapes.add_textbox(Inches(1), Inches(1), Inches(6), Inches(1.5))
+        box.text = f"{word}（{i + 1}）"
+    prs.save(path)
+
+
+def peak_rss_mb():
+    """当前进程的峰值常驻内存（MB），不支持的平台返回None"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux上单位为KB，macOS上为字节
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def cold_cache_options(options):
+    """
+    把各缓存路径改到一个新的临时目录，保证每份PPT都是冷启动
+
+    每份PPT单独一个目录，前一份PPT的搜索缓存、主机熔断和限流状态不会影响后一份
+    """
+    options = dict(options)
+    cache_dir = tempfile.mkdtemp(prefix="ppt_benchmark_cache_")
+    for name in ('search_cache_path', 'host_health_path', 'provider_limits_path',
+                 'checkpoint_path', 'slide_manifest_path'):
+        if options.get(name):
+            options[name] = os.path.join(cache_dir, os.path.basename(options[name]))
+    if options.get('image_store_dir'):
+        options['image_store_dir'] = os.path.join(cache_dir, 'images')
+    return options
+
+
+def run_case(deck_path, base_url, options, llm, result_queue):
+    """在独立进程中处理一份PPT并收集指标（每个用例单独统计峰值内存）"""
+    from main import PPTImageEnhancer
+
+    class BenchmarkEnhancer(PPTImageEnhancer):
+        GOOGLE_CSE_ENDPOINT = f"{base_url}/customsearch/v1"
+        GOOGLE_IMAGE_SEARCH_URL = f"{base_url}/google/search"
+        GEMINI_ENDPOINT = f"{base_url}/gemini"
+        EXA_ENDPOINT = f"{base_url}/exa/search"
+        SERP_ENDPOINT = f"{base_url}/serp/search"
+
+    saved = {}
+    slide_status = {}
+
+    def on_event(event, data):
+        if event == 'saved':
+            saved.update(data)
+        elif event == 'slide_done':
+            slide_status[data['status']] = slide_status.get(data['status'], 0) + 1
+
+    output_path = os.path.join(tempfile.mkdtemp(prefix="ppt_benchmark_"), "output.pptx")
+    kwargs = {
+        'output_path': output_path,
+        'google_api_key': 'mock-google-key',
+        'google_cse_id': 'mock-cse',
+        'serp_api_key': 'mock-serp-key',
+        'exa_api_key': 'mock-exa-key',
+        'verbose': False,
+        'log_to_stdout': False,
+        'event_callback': on_event,
+        'google_ai_api_key': 'mock-gemini-key' if llm == 'gemini' else None,
+        'spark_api_key': 'mock-spark-key' if llm == 'spark' else None,
+        'spark_base_url': f"{base_url}/spark",
+        # 不使用AI时也要指向本地（Ollama默认地址总会被尝试）
+        'ollama_base_url': f"{base_url}/ollama" if llm == 'ollama' else "http://127.0.0.1:9",
+    }
+    kwargs.update(options)
+
+    try:
+        started = time.time()
+        enhancer = BenchmarkEnhancer(deck_path, **kwargs)
+        enhancer.process_slides()
+        elapsed = time.time() - started
+        slides = len(enhancer.prs.slides)
+        # 有页面没有得到图片时（主机熔断、限流等），吞吐量没有意义，不报告
+        without_images = slide_status.get('no_images', 0) + slide_status.get('failed', 0)
+        result_queue.put({
+            'deck': os.path.basename(deck_path),
+            'slides': slides,
+            'slide_status': slide_status,
+            'seconds': round(elapsed, 3),
+            'slides_per_sec': round(slides / elapsed, 3) if elapsed > 0 and not without_images else None,
+            'stages': saved['performance']['stages'],
+            'peak_rss_mb': peak_rss_mb(),
+            'output_mb': round(saved.get('size', 0) / 1024 / 1024, 3),
+        })
+    except Exception as e:
+        import traceback
+        result_queue.put({'deck': os.path.basename(deck_path), 'error': f"{e}\n{traceback.format_exc()}"})
+
+
+def print_result(result):
+    """打印一个用例的结果"""
+    from main import format_performance_report
+    print(f"\n=== {result['deck']} ===")
+    if 'error' in result:
+        print(f"  ✗ 失败: {result['error']}")
+        return
+    status = result['slide_status']
+    if result['slides_per_sec'] is None:
+        without_images = status.get('no_images', 0) + status.get('failed', 0)
+        throughput = f"不适用（{without_images} 页没有得到图片）"
+    else:
+        throughput = f"{result['slides_per_sec']:.2f} 页/秒"
+    print(f"  页数: {result['slides']}  总耗时: {result['seconds']:.2f}s  吞吐量: {throughput}")
+    print(f"  页面状态: {', '.join(f'{name}={count}' for name, count in sorted(status.items()))}")
+    print(f"  峰值内存: {result['peak_rss_mb']} MB  输出大小: {result['output_mb']:.2f} MB")
+    print(format_performance_report({'slides': result['slides'], 'elapsed': result['seconds'],
+                                     'stages': result['stages']}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="日语词汇PPT图片增强工具 - 离线基准测试（使用本地模拟提供商）")
+    parser.add_argument('--deck', action='append', help="要处理的PPT（可重复；默认使用自带的日语初级词汇第6课.pptx）")
+    parser.add_argument('--synthetic-slides', type=int, default=30, help="额外生成的合成PPT页数（0为不生成）")
+    parser.add_argument('--provider-latency', type=float, default=0.2, help="搜索提供商的平均响应时间（秒）")
+    parser.add_argument('--llm-latency', type=float, default=0.5, help="AI提供商的平均响应时间（秒）")
+    parser.add_argument('--image-latency', type=float, default=0.3, help="图片主机的平均响应时间（秒）")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="每个请求随机失败的概率（0-1）")
+    parser.add_argument('--image-size', default="1600x1200", help="模拟图片的像素尺寸，如 1600x1200")
+    parser.add_argument('--llm', choices=['gemini', 'spark', 'ollama', 'none'], default='gemini', help="使用的AI提供商")
+    parser.add_argument('--options', default="{}", help="传给PPTImageEnhancer的性能参数（JSON）")
+    parser.add_argument('--use-config', action='store_true', help="在--options之前先加载config.json中的性能参数")
+    parser.add_argument('--json', help="把结果写入JSON文件")
+    parser.add_argument('--seed', type=int, default=0, help="模拟服务的随机种子")
+    args = parser.parse_args()
+
+    width, height = (int(v) for v in args.image_size.lower().split('x'))
+    options = {}
+    if args.use_config:
+        from main import load_performance_options
+        options.update(load_performance_options())
+    options.update(json.loads(args.options))
+
+    decks = list(args.deck or [BUNDLED_DECK])
+    if args.synthetic_slides > 0:
+        synthetic_path = os.path.join(tempfile.mkdtemp(prefix="ppt_benchmark_"),
+                                      f"synthetic_{args.synthetic_slides}.pptx")
+        make_synthetic_deck(synthetic_path, args.synthetic_slides)
+        decks.append(synthetic_path)
+
+    config = {
+        'provider_latency': args.provider_latency,
+        'llm_latency': args.llm_latency,
+        'image_latency': args.image_latency,
+        'error_rate': args.error_rate,
+        'image_size': (width, height),
+        'seed': args.seed,
+    }
+    port_queue = multiprocessing.Queue()
+    stop_event = multiprocessing.Event()
+    server = multiprocessing.Process(target=run_mock_server, args=(config, port_queue, stop_event), daemon=True)
+    server.start()
+    mock = port_queue.get(timeout=60)
+    base_url = f"http://127.0.0.1:{mock['port']}"
+
+    print(f"模拟服务: {base_url}（图片主机: {', '.join(mock['image_hosts'])}）")
+    print(f"参数: {json.dumps(config, ensure_ascii=False)}")
+    print(f"性能选项: {json.dumps(options, ensure_ascii=False)}")
+
+    results = []
+    try:
+        for deck in decks:
+            result_queue = multiprocessing.Queue()
+            worker = multiprocessing.Process(target=run_case,
+                                             args=(deck, base_url, cold_cache_options(options), args.llm, result_queue))
+            worker.start()
+            result = result_queue.get()
+            worker.join()
+            print_result(result)
+            results.append(result)
+    finally:
+        stop_event.set()
+        server.join(timeout=5)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'config': config, 'options': options, 'results': results}, f, ensure_ascii=False, indent=2)
+        print(f"\n结果已写入: {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1013 @@
+"""
+日语词汇PPT图片增强工具 - 持久化缓存
+基于SQLite（WAL模式），同一台机器上的多个gunicorn worker和多次任务共享
+"""
+
+import os
+import json
+import time
+import sqlite3
+import threading
+import unicodedata
+
+
+def connect_shared_db(db_path):
+    """
+    打开一个可被多个进程同时读写的SQLite连接（WAL模式）
+
+    Args:
+        db_path: 数据库文件路径（所在目录不存在时自动创建）
+
+    Returns:
+        sqlite3.Connection
+    """
+    db_dir = os.path.dirname(db_path)
+    if db_dir:
+        os.makedirs(db_dir, exist_ok=True)
+    conn = sqlite3.connect(db_path, timeout=10, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class SharedDB:
+    """
+    按线程（和进程）管理SQLite连接
+
+    sqlite3连接不能跨线程使用，gunicorn fork后也不能沿用父进程的连接，
+    所以每个线程第一次访问时各自建立连接。
+    """
+    def __init__(self, db_path, schema):
+        self.db_path = db_path
+        self.schema = schema
+        self._local = threading.local()
+
+    def conn(self):
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            local.conn = connect_shared_db(self.db_path)
+            local.conn.executescript(self.schema)
+            local.pid = os.getpid()
+        return local.conn
+
+
+class SearchResultCache:
+    """
+    搜索结果缓存：(规范化关键词, 提供商[:范围]) → 候选图片URL列表
+
+    结果依赖于用户配置的提供商（如Google的CSE、AI关键词优化使用的模型）用scope区分，
+    不同配置的结果互不复用；命中统计仍按提供商汇总。
+    带TTL过期和按最近访问时间淘汰的条目上限，命中/未命中计数保存在数据库中，
+    因此所有worker的统计会汇总在一起。
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS search_results (
+            provider TEXT NOT NULL,
+            keyword TEXT NOT NULL,
+            urls TEXT NOT NULL,
+            requested INTEGER NOT NULL,
+            created REAL NOT NULL,
+            accessed REAL NOT NULL,
+            PRIMARY KEY (provider, keyword)
+        );
+        CREATE INDEX IF NOT EXISTS idx_search_results_accessed ON search_results (accessed);
+        CREATE TABLE IF NOT EXISTS cache_counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+    """
+
+    # 每写入多少次检查一次过期和容量
+    EVICT_INTERVAL = 50
+
+    def __init__(self, db_path, ttl=7 * 86400, max_entries=50000):
+        """
+        Args:
+            db_path: SQLite数据库文件路径
+            ttl: 条目有效期（秒）
+            max_entries: 最多保留的条目数，超出时淘汰最久未访问的条目
+        """
+        self.db = SharedDB(db_path, self.SCHEMA)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._puts = 0
+
+    @staticmethod
+    def normalize_keyword(keyword):
+        """规范化关键词：全角/半角统一、小写、合并空白"""
+        keyword = unicodedata.normalize('NFKC', keyword or '')
+        return ' '.join(keyword.lower().split())
+
+    def _count(self, name):
+        self.db.conn().execute(
+            "INSERT INTO cache_counters (name, value) VALUES (?, 1) "
+            "ON CONFLICT(name) DO UPDATE SET value = value + 1", (name,))
+
+    @staticmethod
+    def _provider_key(provider, scope):
+        return f"{provider}:{scope}" if scope else provider
+
+    def get(self, provider, keyword, count, scope=None):
+        """
+        查询缓存
+
+        Args:
+            provider: 提供商名称（如google、serp、exa、scrape、llm）
+            keyword: 搜索关键词
+            count: 需要的结果数量（缓存的请求数量小于count时视为未命中）
+            scope: 区分同一提供商不同配置的短字符串（如CSE ID的哈希），None表示不区分
+
+        Returns:
+            URL列表，未命中时返回None
+        """
+        key = self._provider_key(provider, scope)
+        try:
+            conn = self.db.conn()
+            row = conn.execute(
+                "SELECT urls, requested, created FROM search_results WHERE provider = ? AND keyword = ?",
+                (key, self.normalize_keyword(keyword))).fetchone()
+            now = time.time()
+            if row is None or row[1] < count or now - row[2] > self.ttl:
+                self._count(f'{provider}_miss')
+                return None
+            conn.execute("UPDATE search_results SET accessed = ? WHERE provider = ? AND keyword = ?",
+                         (now, key, self.normalize_keyword(keyword)))
+            self._count(f'{provider}_hit')
+            return json.loads(row[0])
+        except sqlite3.Error:
+            # 缓存不可用时不影响正常搜索
+            return None
+
+    def put(self, provider, keyword, count, urls, scope=None):
+        """
+        写入缓存
+
+        Args:
+            provider: 提供商名称
+            keyword: 搜索关键词
+            count: 请求的结果数量
+            urls: 返回的URL列表
+            scope: 同get
+        """
+        now = time.time()
+        try:
+            self.db.conn().execute(
+                "INSERT OR REPLACE INTO search_results (provider, keyword, urls, requested, created, accessed) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (self._provider_key(provider, scope), self.normalize_keyword(keyword), json.dumps(urls, ensure_ascii=False), count, now, now))
+            self._puts += 1
+            if self._puts % self.EVICT_INTERVAL == 1:
+                self.evict()
+        except sqlite3.Error:
+            pass
+
+    def evict(self):
+        """删除过期条目，并在超出条目上限时淘汰最久未访问的条目"""
+        conn = self.db.conn()
+        conn.execute("DELETE FROM search_results WHERE created < ?", (time.time() - self.ttl,))
+        total = conn.execute("SELECT COUNT(*) FROM search_results").fetchone()[0]
+        if total > self.max_entries:
+            conn.execute(
+                "DELETE FROM search_results WHERE rowid IN "
+                "(SELECT rowid FROM search_results ORDER BY accessed ASC LIMIT ?)",
+                (total - self.max_entries,))
+
+    def stats(self):
+        """
+        获取缓存统计
+
+        Returns:
+            {'entries': 条目数, 'counters': {'google_hit': n, 'google_miss': n, ...}}
+        """
+        conn = self.db.conn()
+        entries = conn.execute("SELECT COUNT(*) FROM search_results").fetchone()[0]
+        counters = dict(conn.execute("SELECT name, value FROM cache_counters").fetchall())
+        return {'entries': entries, 'counters': counters}
+
+
+_search_caches = {}
+_registry_lock = threading.Lock()
+
+
+def get_search_cache(db_path, ttl=7 * 86400, max_entries=50000):
+    """获取同一进程内共享的搜索结果缓存（同一路径只创建一次）"""
+    with _registry_lock:
+        cache = _search_caches.get(db_path)
+        if cache is None:
+            cache = SearchResultCache(db_path, ttl=ttl, max_entries=max_entries)
+            _search_caches[db_path] = cache
+        cache.ttl = ttl
+        cache.max_entries = max_entries
+        return cache
+
+
+class ImageBlobStore:
+    """
+    按内容寻址的图片仓库：图片以sha256命名保存，另有URL → sha256索引
+
+    - 同一张图片无论来自哪个URL、哪次任务，只保存一份
+    - 写入时先写临时文件再原子替换，其他进程不会读到写了一半的文件
+    - 总大小超过预算时按最近访问时间淘汰（最近使用过的图片不会被淘汰，避免删掉正在使用的文件）
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS blobs (
+            sha256 TEXT PRIMARY KEY,
+            ext TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            created REAL NOT NULL,
+            accessed REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_blobs_accessed ON blobs (accessed);
+        CREATE TABLE IF NOT EXISTS url_index (
+            url TEXT PRIMARY KEY,
+            sha256 TEXT NOT NULL,
+            created REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_url_index_sha256 ON url_index (sha256);
+        CREATE TABLE IF NOT EXISTS blob_totals (
+            id INTEGER PRIMARY KEY CHECK (id = 0),
+            bytes INTEGER NOT NULL
+        );
+        CREATE TRIGGER IF NOT EXISTS blobs_total_insert AFTER INSERT ON blobs BEGIN
+            UPDATE blob_totals SET bytes = bytes + NEW.size WHERE id = 0;
+        END;
+        CREATE TRIGGER IF NOT EXISTS blobs_total_delete AFTER DELETE ON blobs BEGIN
+            UPDATE blob_totals SET bytes = bytes - OLD.size WHERE id = 0;
+        END;
+        INSERT OR IGNORE INTO blob_totals (id, bytes)
+            SELECT 0, COALESCE(SUM(size), 0) FROM blobs WHERE NOT EXISTS (SELECT 1 FROM blob_totals);
+    """
+    # 淘汰时每次取出的候选条数
+    EVICT_BATCH = 64
+
+    def __init__(self, root_dir, max_bytes=1024 * 1024 * 1024, min_idle_seconds=3600):
+        """
+        Args:
+            root_dir: 仓库根目录
+            max_bytes: 总字节预算
+            min_idle_seconds: 最近这么多秒内访问过的图片不参与淘汰
+        """
+        self.root_dir = root_dir
+        self.max_bytes = max_bytes
+        self.min_idle_seconds = min_idle_seconds
+        os.makedirs(root_dir, exist_ok=True)
+        self.db = SharedDB(os.path.join(root_dir, 'index.sqlite3'), self.SCHEMA)
+
+    def path_for(self, sha256, ext):
+        """sha256对应的文件路径（按前两位分目录，避免单个目录文件过多）"""
+        return os.path.join(self.root_dir, sha256[:2], f"{sha256}{ext}")
+
+    def lookup_url(self, url):
+        """
+        根据URL查找已保存的图片
+
+        Returns:
+            图片文件路径，不存在时返回None
+        """
+        try:
+            conn = self.db.conn()
+            row = conn.execute(
+                "SELECT b.sha256, b.ext FROM url_index u JOIN blobs b ON b.sha256 = u.sha256 WHERE u.url = ?",
+                (url,)).fetchone()
+            if row is None:
+                return None
+            path = self.path_for(row[0], row[1])
+            if not os.path.exists(path):
+                # 文件已被其他进程淘汰
+                conn.execute("DELETE FROM url_index WHERE url = ?", (url,))
+                return None
+            conn.execute("UPDATE blobs SET accessed = ? WHERE sha256 = ?", (time.time(), row[0]))
+            return path
+        except sqlite3.Error:
+            return None
+
+    def lookup_hash(self, sha256):
+        """
+        根据sha256查找已保存的图片
+
+        Returns:
+            图片文件路径，不存在时返回None
+        """
+        try:
+            conn = self.db.conn()
+            row = conn.execute("SELECT ext FROM blobs WHERE sha256 = ?", (sha256,)).fetchone()
+            if row is None:
+                return None
+            path = self.path_for(sha256, row[0])
+            if not os.path.exists(path):
+                return None
+            conn.execute("UPDATE blobs SET accessed = ? WHERE sha256 = ?", (time.time(), sha256))
+            return path
+        except sqlite3.Error:
+            return None
+
+    def put(self, data, ext, url=None):
+        """
+        保存图片
+
+        Args:
+            data: 图片字节内容
+            ext: 文件扩展名（如 .jpg、.png）
+            url: 图片来源URL（可选，用于建立URL索引）
+
+        Returns:
+            (sha256, 文件路径)
+        """
+        import hashlib
+        import tempfile
+
+        sha256 = hashlib.sha256(data).hexdigest()
+        path = self.path_for(sha256, ext)
+        now = time.time()
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except Exception:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+        try:
+            conn = self.db.conn()
+            conn.execute(
+                "INSERT INTO blobs (sha256, ext, size, created, accessed) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(sha256) DO UPDATE SET accessed = excluded.accessed",
+                (sha256, ext, len(data), now, now))
+            if url:
+                conn.execute("INSERT OR REPLACE INTO url_index (url, sha256, created) VALUES (?, ?, ?)",
+                             (url, sha256, now))
+            self.evict()
+        except sqlite3.Error:
+            pass
+        return sha256, path
+
+    def total_bytes(self):
+        """仓库中图片的总字节数（由blobs表上的触发器维护，不需要扫描整个表）"""
+        return self.db.conn().execute("SELECT bytes FROM blob_totals WHERE id = 0").fetchone()[0]
+
+    def evict(self):
+        """总大小超出预算时，按最近访问时间从旧到新删除图片"""
+        conn = self.db.conn()
+        excess = self.total_bytes() - self.max_bytes
+        cutoff = time.time() - self.min_idle_seconds
+        while excess > 0:
+            rows = conn.execute(
+                "SELECT sha256, ext, size FROM blobs WHERE accessed < ? ORDER BY accessed ASC LIMIT ?",
+                (cutoff, self.EVICT_BATCH)).fetchall()
+            if not rows:
+                return
+            for sha256, ext, size in rows:
+                if excess <= 0:
+                    break
+                conn.execute("DELETE FROM blobs WHERE sha256 = ?", (sha256,))
+                conn.execute("DELETE FROM url_index WHERE sha256 = ?", (sha256,))
+                try:
+                    os.remove(self.path_for(sha256, ext))
+                except OSError:
+                    pass
+                excess -= size
+
+
+_image_stores = {}
+
+
+def get_image_store(root_dir, max_bytes=1024 * 1024 * 1024):
+    """获取同一进程内共享的图片仓库（同一目录只创建一次）"""
+    with _registry_lock:
+        store = _image_stores.get(root_dir)
+        if store is None:
+            store = ImageBlobStore(root_dir, max_bytes=max_bytes)
+            _image_stores[root_dir] = store
+        store.max_bytes = max_bytes
+        return store
+
+
+class HostHealthTracker:
+    """
+    按主机统计图片下载的成功/失败，并为每个主机维护一个熔断器
+
+    - closed（正常）：连续失败达到阈值后转为open
+    - open（熔断）：直接跳过该主机，open_seconds秒后转为half_open
+    - half_open（试探）：只放行一个试探请求，成功则恢复closed，失败则重新open
+
+    状态保存在SQLite中，所有worker和任务共享。
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS host_health (
+            host TEXT PRIMARY KEY,
+            successes INTEGER NOT NULL DEFAULT 0,
+            failures INTEGER NOT NULL DEFAULT 0,
+            consecutive_failures INTEGER NOT NULL DEFAULT 0,
+            state TEXT NOT NULL DEFAULT 'closed',
+            opened_at REAL,
+            avg_latency REAL,
+            last_error TEXT,
+            updated REAL NOT NULL
+        );
+    """
+
+    def __init__(self, db_path, failure_threshold=3, open_seconds=300, probe_timeout=60):
+        """
+        Args:
+            db_path: SQLite数据库文件路径
+            failure_threshold: 连续失败多少次后熔断
+            open_seconds: 熔断持续时间（秒），之后允许一次试探
+            probe_timeout: 试探请求超过这么多秒没有结果时，允许新的试探
+        """
+        self.db = SharedDB(db_path, self.SCHEMA)
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.probe_timeout = probe_timeout
+
+    def get_states(self, hosts):
+        """
+        批量查询主机状态
+
+        Returns:
+            {主机: {'state', 'successes', 'failures', 'opened_at', 'avg_latency'}}，没有记录的主机不在结果中
+        """
+        hosts = list(set(hosts))
+        if not hosts:
+            return {}
+        try:
+            rows = self.db.conn().execute(
+                "SELECT host, state, successes, failures, opened_at, avg_latency FROM host_health "
+                f"WHERE host IN ({','.join('?' * len(hosts))})", hosts).fetchall()
+        except sqlite3.Error:
+            return {}
+        return {
+            row[0]: {'state': row[1], 'successes': row[2], 'failures': row[3],
+                     'opened_at': row[4], 'avg_latency': row[5]}
+            for row in rows
+        }
+
+    def is_available(self, info, now=None):
+        """根据get_states返回的状态判断主机当前是否可以尝试（不改变状态）"""
+        if info is None or info['state'] == 'closed':
+            return True
+        now = now or time.time()
+        if info['state'] == 'open':
+            return now - info['opened_at'] >= self.open_seconds
+        return now - info['opened_at'] >= self.probe_timeout
+
+    def acquire(self, host):
+        """
+        下载前调用：主机可以尝试时返回True
+
+        open状态到期时只有一个调用者能把状态切换为half_open并获得试探机会。
+        """
+        try:
+            conn = self.db.conn()
+            row = conn.execute("SELECT state, opened_at FROM host_health WHERE host = ?", (host,)).fetchone()
+            if row is None or row[0] == 'closed':
+                return True
+            now = time.time()
+            wait = self.open_seconds if row[0] == 'open' else self.probe_timeout
+            if now - row[1] < wait:
+                return False
+            cursor = conn.execute(
+                "UPDATE host_health SET state = 'half_open', opened_at = ?, updated = ? "
+                "WHERE host = ? AND state = ? AND opened_at = ?", (now, now, host, row[0], row[1]))
+            return cursor.rowcount == 1
+        except sqlite3.Error:
+            return True
+
+    def record_success(self, host, latency):
+        """记录一次成功的下载（耗时用于按速度排序）"""
+        now = time.time()
+        try:
+            self.db.conn().execute(
+                "INSERT INTO host_health (host, successes, state, avg_latency, updated) VALUES (?, 1, 'closed', ?, ?) "
+                "ON CONFLICT(host) DO UPDATE SET successes = successes + 1, consecutive_failures = 0, "
+                "state = 'closed', opened_at = NULL, updated = excluded.updated, "
+                "avg_latency = COALESCE(0.8 * avg_latency + 0.2 * excluded.avg_latency, excluded.avg_latency)",
+                (host, latency, now))
+        except sqlite3.Error:
+            pass
+
+    def record_failure(self, host, reason):
+        """
+        记录一次主机层面的失败（超时、连接错误、403、5xx、返回HTML等）
+
+        Returns:
+            记录后主机是否处于熔断状态
+        """
+        now = time.time()
+        conn = self.db.conn()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT state, consecutive_failures FROM host_health WHERE host = ?",
+                                   (host,)).fetchone()
+                state, consecutive = row if row else ('closed', 0)
+                consecutive += 1
+                if state == 'half_open' or consecutive >= self.failure_threshold:
+                    state = 'open'
+                conn.execute(
+                    "INSERT INTO host_health (host, failures, consecutive_failures, state, opened_at, last_error, updated) "
+                    "VALUES (?, 1, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT(host) DO UPDATE SET failures = failures + 1, "
+                    "consecutive_failures = excluded.consecutive_failures, state = excluded.state, "
+                    "opened_at = CASE WHEN excluded.state = 'open' THEN excluded.opened_at ELSE opened_at END, "
+                    "last_error = excluded.last_error, updated = excluded.updated",
+                    (host, consecutive, state, now, reason, now))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            return state == 'open'
+        except sqlite3.Error:
+            return False
+
+    def rank_urls(self, urls, host_of):
+        """
+        按主机健康度对候选URL排序
+
+        可以尝试的主机在前（按平滑后的成功率从高到低，成功率相同时按平均耗时），熔断中的主机排在最后。
+        没有记录的主机视为成功率50%。排序是稳定的，同等条件下保持搜索结果原来的顺序。
+
+        Args:
+            urls: 候选URL列表
+            host_of: 从URL取主机名的函数
+        """
+        if len(urls) < 2:
+            return list(urls)
+        states = self.get_states(host_of(url) for url in urls)
+        if not states:
+            return list(urls)
+        now = time.time()
+
+        def sort_key(url):
+            info = states.get(host_of(url))
+            if info is None:
+                return (0, -0.5, 0)
+            success_rate = (info['successes'] + 1) / (info['successes'] + info['failures'] + 2)
+            return (0 if self.is_available(info, now) else 1, -success_rate, info['avg_latency'] or 0)
+
+        return sorted(urls, key=sort_key)
+
+
+_host_trackers = {}
+
+
+def get_host_health(db_path, failure_threshold=3, open_seconds=300):
+    """获取同一进程内共享的主机健康度统计（同一路径只创建一次）"""
+    with _registry_lock:
+        tracker = _host_trackers.get(db_path)
+        if tracker is None:
+            tracker = HostHealthTracker(db_path, failure_threshold=failure_threshold, open_seconds=open_seconds)
+            _host_trackers[db_path] = tracker
+        tracker.failure_threshold = failure_threshold
+        tracker.open_seconds = open_seconds
+        return tracker
+
+
+class ProviderRateLimiter:
+    """
+    搜索/AI提供商的限流与配额状态（按 提供商 + API Key哈希 分别记录）
+
+    - 令牌桶：每个 (提供商, Key) 按rate每秒补充令牌，最多攒burst个
+    - 阻断：收到429/Retry-After或配额用尽时记录blocked_until，之前的请求直接跳过
+
+    状态保存在SQLite中，所有worker共享；服务器Key和用户请求中带来的Key各自独立计数。
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS provider_limits (
+            provider TEXT NOT NULL,
+            key_hash TEXT NOT NULL,
+            tokens REAL NOT NULL,
+            refilled REAL NOT NULL,
+            blocked_until REAL NOT NULL DEFAULT 0,
+            block_reason TEXT,
+            PRIMARY KEY (provider, key_hash)
+        );
+    """
+
+    def __init__(self, db_path):
+        """
+        Args:
+            db_path: SQLite数据库文件路径
+        """
+        self.db = SharedDB(db_path, self.SCHEMA)
+
+    def acquire(self, provider, key_hash, rate, burst):
+        """
+        尝试取得一次请求的许可
+
+        Args:
+            provider: 提供商名称
+            key_hash: API Key的哈希
+            rate: 每秒补充的令牌数（<=0 表示不限速，只检查阻断状态）
+            burst: 令牌桶容量
+
+        Returns:
+            (是否允许, 需要等待的秒数, 原因)：原因为 'rate'（令牌不足，可等待后重试）或阻断时记录的原因
+        """
+        now = time.time()
+        conn = self.db.conn()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    "SELECT tokens, refilled, blocked_until, block_reason FROM provider_limits "
+                    "WHERE provider = ? AND key_hash = ?", (provider, key_hash)).fetchone()
+                if row is not None and row[2] > now:
+                    conn.execute("COMMIT")
+                    return False, row[2] - now, row[3] or 'blocked'
+                if rate <= 0:
+                    conn.execute("COMMIT")
+                    return True, 0, None
+                burst = max(1.0, float(burst))
+                tokens = burst if row is None else min(burst, row[0] + (now - row[1]) * rate)
+                allowed = tokens >= 1
+                if allowed:
+                    tokens -= 1
+                conn.execute(
+                    "INSERT INTO provider_limits (provider, key_hash, tokens, refilled) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(provider, key_hash) DO UPDATE SET tokens = excluded.tokens, refilled = excluded.refilled",
+                    (provider, key_hash, tokens, now))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        except sqlite3.Error:
+            # 限流状态不可用时不阻止请求
+            return True, 0, None
+        if allowed:
+            return True, 0, None
+        return False, (1 - tokens) / rate, 'rate'
+
+    def block(self, provider, key_hash, until, reason):
+        """在until（时间戳）之前跳过该提供商 + Key（已有更晚的阻断时保留更晚的）"""
+        try:
+            self.db.conn().execute(
+                "INSERT INTO provider_limits (provider, key_hash, tokens, refilled, blocked_until, block_reason) "
+                "VALUES (?, ?, 0, ?, ?, ?) "
+                "ON CONFLICT(provider, key_hash) DO UPDATE SET "
+                "block_reason = CASE WHEN excluded.blocked_until > blocked_until THEN excluded.block_reason ELSE block_reason END, "
+                "blocked_until = MAX(blocked_until, excluded.blocked_until)",
+                (provider, key_hash, time.time(), until, reason))
+        except sqlite3.Error:
+            pass
+
+    def blocked(self):
+        """
+        当前处于阻断状态的提供商
+
+        Returns:
+            [(提供商, Key哈希, 剩余秒数, 原因)]
+        """
+        now = time.time()
+        rows = self.db.conn().execute(
+            "SELECT provider, key_hash, blocked_until, block_reason FROM provider_limits WHERE blocked_until > ?",
+            (now,)).fetchall()
+        return [(row[0], row[1], row[2] - now, row[3]) for row in rows]
+
+
+_rate_limiters = {}
+
+
+def get_rate_limiter(db_path):
+    """获取同一进程内共享的提供商限流状态（同一路径只创建一次）"""
+    with _registry_lock:
+        limiter = _rate_limiters.get(db_path)
+        if limiter is None:
+            limiter = ProviderRateLimiter(db_path)
+            _rate_limiters[db_path] = limiter
+        return limiter
+
+
+class MetricsStore:
+    """
+    跨进程汇总的监控指标（计数器和直方图）
+
+    每个进程先在内存中累加增量，每隔flush_interval秒在一个事务中加到共享数据库上，
+    因此所有gunicorn worker的数据自然汇总在一起，某个worker重启也不会丢失已写入的累计值。
+    直方图按Prometheus的方式保存为累积桶计数器（_bucket{le=...}、_sum、_count）。
+    另外每个worker定期上报自己的内存占用，超过stale_seconds没有上报的worker视为已退出。
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS metric_counters (
+            name TEXT NOT NULL,
+            labels TEXT NOT NULL,
+            value REAL NOT NULL,
+            PRIMARY KEY (name, labels)
+        );
+        CREATE TABLE IF NOT EXISTS metric_workers (
+            pid INTEGER PRIMARY KEY,
+            rss_bytes INTEGER NOT NULL,
+            started REAL NOT NULL,
+            updated REAL NOT NULL
+        );
+    """
+
+    def __init__(self, db_path, flush_interval=5, stale_seconds=120):
+        """
+        Args:
+            db_path: SQLite数据库文件路径
+            flush_interval: 内存中的增量最多累积多少秒后写入数据库
+            stale_seconds: worker超过这么多秒没有上报即不再导出
+        """
+        self.db = SharedDB(db_path, self.SCHEMA)
+        self.flush_interval = flush_interval
+        self.stale_seconds = stale_seconds
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._last_flush = time.time()
+
+    @staticmethod
+    def format_labels(labels):
+        """把标签字典格式化为Prometheus的标签串（按名称排序，作为存储键）"""
+        if not labels:
+            return ''
+        parts = []
+        for key, value in sorted(labels.items()):
+            value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            parts.append(f'{key}="{value}"')
+        return ','.join(parts)
+
+    def inc(self, name, value=1, labels=None):
+        """
+        计数器增加value
+
+        Args:
+            name: 指标名
+            value: 增量
+            labels: 标签字典（可选）
+        """
+        key = (name, self.format_labels(labels))
+        with self._lock:
+            self._pending[key] = self._pending.get(key, 0) + value
+        self._maybe_flush()
+
+    def observe(self, name, value, buckets, labels=None):
+        """
+        向直方图记录一个观测值
+
+        Args:
+            name: 指标名
+            value: 观测值
+            buckets: 桶上界列表（升序，不含+Inf）
+            labels: 标签字典（可选）
+        """
+        labels = dict(labels or {})
+        with self._lock:
+            # 没有落入的桶也写入0，保证每个桶都会被导出
+            for bound in list(buckets) + ['+Inf']:
+                key = (f"{name}_bucket", self.format_labels(dict(labels, le=bound)))
+                hit = 1 if bound == '+Inf' or value <= bound else 0
+                self._pending[key] = self._pending.get(key, 0) + hit
+            for suffix, delta in (('_sum', value), ('_count', 1)):
+                key = (name + suffix, self.format_labels(labels))
+                self._pending[key] = self._pending.get(key, 0) + delta
+        self._maybe_flush()
+
+    def _maybe_flush(self):
+        if time.time() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """把内存中累积的增量写入数据库"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.time()
+        if not pending:
+            return
+        conn = self.db.conn()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(
+                "INSERT INTO metric_counters (name, labels, value) VALUES (?, ?, ?) "
+                "ON CONFLICT(name, labels) DO UPDATE SET value = value + excluded.value",
+                [(name, labels, value) for (name, labels), value in pending.items()])
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            try:
+                conn.execute("ROLLBACK")
+            except sqlite3.Error:
+                pass
+            # 写入失败时放回内存，下次再试
+            with self._lock:
+                for key, value in pending.items():
+                    self._pending[key] = self._pending.get(key, 0) + value
+
+    def report_worker(self, pid, rss_bytes, started):
+        """上报一个worker进程当前的内存占用"""
+        self.db.conn().execute(
+            "INSERT OR REPLACE INTO metric_workers (pid, rss_bytes, started, updated) VALUES (?, ?, ?, ?)",
+            (pid, int(rss_bytes), started, time.time()))
+
+    def snapshot(self):
+        """
+        读取汇总后的指标
+
+        Returns:
+            {'counters': [(指标名, 标签串, 值), ...], 'workers': [(pid, rss_bytes, started), ...]}
+        """
+        conn = self.db.conn()
+        conn.execute("DELETE FROM metric_workers WHERE updated < ?", (time.time() - self.stale_seconds,))
+        counters = conn.execute("SELECT name, labels, value FROM metric_counters ORDER BY name, labels").fetchall()
+        workers = conn.execute("SELECT pid, rss_bytes, started FROM metric_workers ORDER BY pid").fetchall()
+        return {'counters': counters, 'workers': workers}
+
+
+_metrics_stores = {}
+
+
+def get_metrics_store(db_path, flush_interval=5):
+    """获取同一进程内共享的指标存储（同一路径只创建一次）"""
+    with _registry_lock:
+        store = _metrics_stores.get(db_path)
+        if store is None:
+            store = MetricsStore(db_path, flush_interval=flush_interval)
+            _metrics_stores[db_path] = store
+        return store
+
+
+class SlideCheckpointStore:
+    """
+    逐页处理检查点：(PPT内容哈希, 页码) → 该页使用的图片哈希、模板ID和搜索关键词
+
+    图片本身保存在图片仓库中，这里只记录sha256。任务中途被终止（超时、内存不足、程序崩溃）后
+    重新处理同一份PPT时，已完成的页面直接用这些记录重新排版，不再搜索和下载。
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS slide_checkpoints (
+            deck_key TEXT NOT NULL,
+            slide INTEGER NOT NULL,
+            text_hash TEXT NOT NULL,
+            template_id INTEGER NOT NULL,
+            keywords TEXT NOT NULL,
+            images TEXT NOT NULL,
+            updated REAL NOT NULL,
+            PRIMARY KEY (deck_key, slide)
+        );
+        CREATE INDEX IF NOT EXISTS idx_slide_checkpoints_updated ON slide_checkpoints (updated);
+    """
+
+    def __init__(self, db_path, ttl=7 * 86400):
+        """
+        Args:
+            db_path: SQLite数据库文件路径
+            ttl: 检查点保留时间（秒），超过后视为放弃的任务并删除
+        """
+        self.db = SharedDB(db_path, self.SCHEMA)
+        self.ttl = ttl
+        self._saves = 0
+
+    def save(self, deck_key, slide, text_hash, template_id, keywords, images):
+        """
+        记录一页的处理结果
+
+        Args:
+            deck_key: PPT内容哈希
+            slide: 页码（从0开始）
+            text_hash: 该页文本的哈希（页面内容变化时检查点失效）
+            template_id: 使用的模板ID
+            keywords: 搜索过的关键词列表
+            images: 使用的图片 [[sha256, 扩展名], ...]（按排版顺序）
+        """
+        try:
+            self.db.conn().execute(
+                "INSERT OR REPLACE INTO slide_checkpoints "
+                "(deck_key, slide, text_hash, template_id, keywords, images, updated) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (deck_key, slide, text_hash, template_id, json.dumps(keywords, ensure_ascii=False),
+                 json.dumps(images), time.time()))
+            self._saves += 1
+            if self._saves % 50 == 1:
+                self.expire()
+        except sqlite3.Error:
+            # 检查点写入失败不影响处理
+            pass
+
+    def load(self, deck_key):
+        """
+        读取一份PPT的所有检查点
+
+        Returns:
+            {页码: {'text_hash', 'template_id', 'keywords', 'images'}}
+        """
+        try:
+            rows = self.db.conn().execute(
+                "SELECT slide, text_hash, template_id, keywords, images FROM slide_checkpoints WHERE deck_key = ? "
+                "AND updated >= ?", (deck_key, time.time() - self.ttl)).fetchall()
+        except sqlite3.Error:
+            return {}
+        return {
+            row[0]: {'text_hash': row[1], 'template_id': row[2],
+                     'keywords': json.loads(row[3]), 'images': json.loads(row[4])}
+            for row in rows
+        }
+
+    def clear(self, deck_key):
+        """处理成功完成后删除该PPT的检查点"""
+        try:
+            self.db.conn().execute("DELETE FROM slide_checkpoints WHERE deck_key = ?", (deck_key,))
+        except sqlite3.Error:
+            pass
+
+    def expire(self):
+        """删除超过TTL的检查点"""
+        self.db.conn().execute("DELETE FROM slide_checkpoints WHERE updated < ?", (time.time() - self.ttl,))
+
+
+_checkpoint_stores = {}
+
+
+def get_checkpoint_store(db_path, ttl=7 * 86400):
+    """获取同一进程内共享的检查点存储（同一路径只创建一次）"""
+    with _registry_lock:
+        store = _checkpoint_stores.get(db_path)
+        if store is None:
+            store = SlideCheckpointStore(db_path, ttl=ttl)
+            _checkpoint_stores[db_path] = store
+        store.ttl = ttl
+        return store
+
+
+class SlideManifest:
+    """
+    增量处理清单：幻灯片文本哈希 → 上次处理该页时使用的图片哈希、模板ID和搜索关键词
+
+    与检查点不同，清单不区分是哪份PPT，处理成功后也不删除：老师修改几页后重新上传时，
+    文本没有变化的页面直接复用上次的图片和排版，只有新增或修改过的页面需要搜索和下载。
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS slide_manifest (
+            text_hash TEXT PRIMARY KEY,
+            template_id INTEGER NOT NULL,
+            keywords TEXT NOT NULL,
+            images TEXT NOT NULL,
+            updated REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_slide_manifest_updated ON slide_manifest (updated);
+    """
+
+    def __init__(self, db_path, ttl=30 * 86400):
+        """
+        Args:
+            db_path: SQLite数据库文件路径
+            ttl: 条目最后一次使用后保留的秒数
+        """
+        self.db = SharedDB(db_path, self.SCHEMA)
+        self.ttl = ttl
+        self._puts = 0
+
+    def get(self, text_hash):
+        """
+        查询一页上次的处理结果
+
+        Returns:
+            {'template_id', 'keywords', 'images'}，没有记录或已过期时返回None
+        """
+        try:
+            row = self.db.conn().execute(
+                "SELECT template_id, keywords, images FROM slide_manifest WHERE text_hash = ? AND updated >= ?",
+                (text_hash, time.time() - self.ttl)).fetchone()
+        except sqlite3.Error:
+            return None
+        if row is None:
+            return None
+        return {'template_id': row[0], 'keywords': json.loads(row[1]), 'images': json.loads(row[2])}
+
+    def put(self, text_hash, template_id, keywords, images):
+        """
+        记录一页的处理结果（已有记录时覆盖，并刷新使用时间）
+
+        Args:
+            text_hash: 该页文本的哈希
+            template_id: 使用的模板ID
+            keywords: 搜索过的关键词列表
+            images: 使用的图片 [[sha256, 扩展名], ...]（按排版顺序）
+        """
+        try:
+            self.db.conn().execute(
+                "INSERT OR REPLACE INTO slide_manifest (text_hash, template_id, keywords, images, updated) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (text_hash, template_id, json.dumps(keywords, ensure_ascii=False), json.dumps(images), time.time()))
+            self._puts += 1
+            if self._puts % 50 == 1:
+                self.expire()
+        except sqlite3.Error:
+            pass
+
+    def expire(self):
+        """删除超过TTL未使用的条目"""
+        self.db.conn().execute("DELETE FROM slide_manifest WHERE updated < ?", (time.time() - self.ttl,))
+
+
+_slide_manifests = {}
+
+
+def get_slide_manifest(db_path, ttl=30 * 86400):
+    """获取同一进程内共享的增量处理清单（同一路径只创建一次）"""
+    with _registry_lock:
+        manifest = _slide_manifests.get(db_path)
+        if manifest is None:
+            manifest = SlideManifest(db_path, ttl=ttl)
+            _slide_manifests[db_path] = manifest
+        manifest.ttl = ttl
+        return manifest
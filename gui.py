@@ -330,8 +330,25 @@ class PPTEnhancerGUI:
             self.log("=" * 60, "info")
             
             # 加载配置
-            from main import load_config
-            google_api_key, google_cse_id, spark_api_key, spark_base_url, spark_model = load_config()
+            from main import load_config, load_performance_options
+            (google_api_key, google_cse_id, google_ai_api_key, spark_api_key, spark_base_url, spark_model,
+             ollama_base_url, ollama_model, exa_api_key, serp_api_key) = load_config()
+            
+            # 订阅增强器的日志事件（不再替换全局sys.stdout）
+            def on_event(event, data):
+                if event != 'log':
+                    return
+                message = data['message']
+                tag = "info"
+                if "[DEBUG]" in message:
+                    tag = "debug"
+                elif "✓" in message or "成功" in message or "完成" in message:
+                    tag = "success"
+                elif "✗" in message or "失败" in message or "错误" in message or "ERROR" in message:
+                    tag = "error"
+                elif "警告" in message or "WARN" in message:
+                    tag = "warning"
+                self.log(message, tag)
             
             # 创建增强器
             enhancer = PPTImageEnhancer(
@@ -339,53 +356,30 @@ class PPTEnhancerGUI:
                 output_path=output_path,
                 google_api_key=google_api_key,
                 google_cse_id=google_cse_id,
+                google_ai_api_key=google_ai_api_key,
                 spark_api_key=spark_api_key,
                 spark_base_url=spark_base_url,
                 spark_model=spark_model,
-                verbose=True
+                ollama_base_url=ollama_base_url,
+                ollama_model=ollama_model,
+                exa_api_key=exa_api_key,
+                serp_api_key=serp_api_key,
+                verbose=True,
+                event_callback=on_event,
+                log_to_stdout=False,
+                **load_performance_options()
             )
             
-            # 创建一个自定义的输出类来捕获print输出
-            class GUILogger:
-                def __init__(self, gui_app):
-                    self.gui_app = gui_app
-                
-                def write(self, message):
-                    if message.strip():
-                        tag = "info"
-                        if "[DEBUG]" in message:
-                            tag = "debug"
-                        elif "✓" in message or "成功" in message or "完成" in message:
-                            tag = "success"
-                        elif "✗" in message or "失败" in message or "错误" in message or "ERROR" in message:
-                            tag = "error"
-                        elif "警告" in message or "WARN" in message:
-                            tag = "warning"
-                        self.gui_app.log(message.strip(), tag)
-                
-                def flush(self):
-                    pass
+            # 处理幻灯片
+            enhancer.process_slides()
             
-            # 重定向stdout
-            import sys
-            original_stdout = sys.stdout
-            sys.stdout = GUILogger(self)
+            self.log("=" * 60, "success")
+            self.log("处理完成！", "success")
+            self.log(f"输出文件: {output_path}", "success")
+            self.log("=" * 60, "success")
             
-            try:
-                # 处理幻灯片
-                enhancer.process_slides()
-                
-                self.log("=" * 60, "success")
-                self.log("处理完成！", "success")
-                self.log(f"输出文件: {output_path}", "success")
-                self.log("=" * 60, "success")
-                
-                # 使用after确保在主线程中显示消息框
-                self.root.after(0, lambda: messagebox.showinfo("完成", f"处理完成！\n\n输出文件:\n{output_path}"))
-                
-            finally:
-                # 恢复stdout
-                sys.stdout = original_stdout
+            # 使用after确保在主线程中显示消息框
+            self.root.after(0, lambda: messagebox.showinfo("完成", f"处理完成！\n\n输出文件:\n{output_path}"))
             
         except Exception as e:
             self.log(f"处理出错: {str(e)}", "error")
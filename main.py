@@ -4,15 +4,21 @@
 """
 
 import os
+import io
 import requests  # pyright: ignore[reportMissingModuleSource]
 from pptx import Presentation  # pyright: ignore[reportMissingImports]
 from pptx.util import Inches, Pt  # pyright: ignore[reportMissingImports]
 from pptx.enum.text import PP_ALIGN  # pyright: ignore[reportMissingImports]
 from pptx.dml.color import RGBColor  # pyright: ignore[reportMissingImports]
 import time
-from urllib.parse import quote, urlencode
+from urllib.parse import quote, urlencode, urlparse
 import json
 import re
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from cache_store import (get_search_cache, get_image_store, get_host_health, get_rate_limiter, get_checkpoint_store,
+                         get_slide_manifest)
 try:
     from PIL import Image
     PIL_AVAILABLE = True
@@ -20,16 +26,189 @@ except ImportError:
     PIL_AVAILABLE = False
     print("[WARN] Pillow未安装，无法转换WEBP格式图片。请运行: pip install Pillow")
 
+# 常用API主机的连接池大小（同一主机上并发请求较多时需要更大的连接池）
+DEFAULT_HOST_POOL_SIZES = {
+    'www.googleapis.com': 16,
+    'serpapi.com': 16,
+    'api.exa.ai': 8,
+    'generativelanguage.googleapis.com': 8,
+    'spark-api-open.xf-yun.com': 8,
+}
+
+
+class HTTPSessionPool:
+    """
+    带连接池和keep-alive的HTTP会话
+    
+    所有API调用和图片下载共用，避免每次请求都重新进行TCP+TLS握手。
+    requests.Session 的连接池（urllib3）是线程安全的，可以在流水线的多个线程中共用。
+    """
+    def __init__(self, pool_maxsize=10, host_pool_sizes=None, connect_timeout=5):
+        """
+        Args:
+            pool_maxsize: 每个主机默认保持的最大连接数
+            host_pool_sizes: {主机名: 连接数}，为特定主机单独设置连接池大小
+            connect_timeout: 建立连接的超时时间（秒）；读取超时由每次请求单独指定
+        """
+        from requests.adapters import HTTPAdapter
+        
+        self.connect_timeout = connect_timeout
+        self.session = requests.Session()
+        default_adapter = HTTPAdapter(pool_connections=32, pool_maxsize=pool_maxsize)
+        self.session.mount('https://', default_adapter)
+        self.session.mount('http://', default_adapter)
+        for host, size in (host_pool_sizes or {}).items():
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=int(size))
+            self.session.mount(f'https://{host}/', adapter)
+            self.session.mount(f'http://{host}/', adapter)
+    
+    def request(self, method, url, timeout=30, **kwargs):
+        """
+        发送请求
+        
+        Args:
+            method: HTTP方法
+            url: 请求URL
+            timeout: 读取超时（秒），或 (连接超时, 读取超时) 元组
+        """
+        if not isinstance(timeout, tuple):
+            timeout = (min(self.connect_timeout, timeout), timeout)
+        return self.session.request(method, url, timeout=timeout, **kwargs)
+    
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+    
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+
+_http_pools = {}
+_http_pools_lock = threading.Lock()
+
+
+def get_shared_http_pool(pool_maxsize=10, host_pool_sizes=None, connect_timeout=5):
+    """获取同一进程内共享的HTTP会话（相同配置只创建一次，多个任务共用连接）"""
+    host_pool_sizes = dict(DEFAULT_HOST_POOL_SIZES, **(host_pool_sizes or {}))
+    key = (pool_maxsize, tuple(sorted(host_pool_sizes.items())), connect_timeout)
+    with _http_pools_lock:
+        pool = _http_pools.get(key)
+        if pool is None:
+            pool = HTTPSessionPool(pool_maxsize=pool_maxsize, host_pool_sizes=host_pool_sizes,
+                                   connect_timeout=connect_timeout)
+            _http_pools[key] = pool
+        return pool
+
+
+
+class StageTimings:
+    """
+    线程安全的分阶段耗时统计
+    
+    用 span(stage) 包住一段代码即可记录一次耗时；阶段名可以带子项，
+    如 search.google、download.example.com。开销只有两次计时和一次加锁，可以常开。
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._samples = {}
+    
+    @contextmanager
+    def span(self, stage):
+        """记录 with 块的耗时（块内抛出异常时同样记录）"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - started)
+    
+    def add(self, stage, seconds):
+        """直接记录一次耗时（秒）"""
+        with self._lock:
+            self._samples.setdefault(stage, []).append(seconds)
+    
+    @staticmethod
+    def _percentile(values, percent):
+        """最近秩法求百分位数（values已排序）"""
+        rank = int(round(percent / 100 * len(values))) - 1
+        return values[min(len(values) - 1, max(0, rank))]
+    
+    def summary(self):
+        """
+        Returns:
+            {阶段: {count, total, p50, p95, max}}，时间单位为秒，按阶段名排序
+        """
+        with self._lock:
+            samples = {stage: sorted(values) for stage, values in self._samples.items()}
+        return {
+            stage: {
+                'count': len(values),
+                'total': round(sum(values), 4),
+                'p50': round(self._percentile(values, 50), 4),
+                'p95': round(self._percentile(values, 95), 4),
+                'max': round(values[-1], 4),
+            }
+            for stage, values in sorted(samples.items())
+        }
+
+
+def format_performance_report(report):
+    """
+    把性能报告格式化为便于在控制台阅读的表格
+    
+    Args:
+        report: PPTImageEnhancer.performance_report
+        
+    Returns:
+        多行字符串
+    """
+    lines = [f"性能报告: {report.get('slides', 0)} 页，总耗时 {report.get('elapsed', 0):.2f} 秒",
+             f"  {'stage':<38}{'count':>6}{'total(s)':>10}{'p50(s)':>9}{'p95(s)':>9}{'max(s)':>9}"]
+    for stage, stats in report.get('stages', {}).items():
+        lines.append(f"  {stage:<38}{stats['count']:>6}{stats['total']:>10.2f}"
+                     f"{stats['p50']:>9.3f}{stats['p95']:>9.3f}{stats['max']:>9.3f}")
+    return "\n".join(lines)
+
+# 主动限速是可选的：默认只遵守429/Retry-After/配额阻断，只有provider_rate_limits中列出的提供商才按令牌桶限速。
+# 参考值（每秒请求数, 突发请求数）：google (1, 5)、serp (2, 5)、exa (2, 5)、gemini (0.25, 2，免费层约15次/分钟)、spark (1, 2)
+
+# AI关键词优化的提供商；其余提供商（google、serp、exa、scrape）为图片搜索，请求耗时分别计入llm.<提供商>和search.<提供商>阶段
+LLM_PROVIDERS = ('gemini', 'spark', 'ollama')
+
+
+class ProviderUnavailableError(Exception):
+    """提供商当前处于限流/配额阻断期，本次请求被跳过"""
+    pass
+
+
 class PPTImageEnhancer:
+    # 各提供商的API地址（基准测试等场景可在子类中指向本地模拟服务）
+    GOOGLE_CSE_ENDPOINT = "https://www.googleapis.com/customsearch/v1"
+    GOOGLE_IMAGE_SEARCH_URL = "https://www.google.com/search"
+    GEMINI_ENDPOINT = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash-exp:generateContent"
+    EXA_ENDPOINT = "https://api.exa.ai/search"
+    SERP_ENDPOINT = "https://serpapi.com/search"
+    
     def __init__(self, ppt_path, output_path=None, google_api_key=None, google_cse_id=None, 
                  google_ai_api_key=None, spark_api_key=None, spark_base_url=None, spark_model=None,
-                 ollama_base_url=None, ollama_model=None, exa_api_key=None, serp_api_key=None, verbose=True):
+                 ollama_base_url=None, ollama_model=None, exa_api_key=None, serp_api_key=None, verbose=True,
+                 max_slides_in_flight=1, search_workers=2, download_workers=2,
+                 hedged_download_fanout=0, search_fanout=False,
+                 search_cache_path=None, search_cache_ttl=7 * 86400, search_cache_max_entries=50000,
+                 image_store_dir=None, image_store_max_mb=1024,
+                 http_pool_maxsize=10, http_host_pool_sizes=None, http_connect_timeout=5, http_pool=None,
+                 llm_batch_size=0, speculative_keyword_optimization=False, speculative_llm_wait=10.0,
+                 event_callback=None, log_to_stdout=True,
+                 image_target_dpi=0, image_jpeg_quality=85, max_image_mb=20,
+                 host_health_path=None, host_failure_threshold=3, host_open_seconds=300,
+                 provider_limits_path=None, provider_rate_limits=None, provider_max_wait=5.0,
+                 provider_quota_block_seconds=3600, checkpoint_path=None, resume=True,
+                 incremental=False, slide_manifest_path=None):
         """
         初始化PPT图片增强器
         
         Args:
-            ppt_path: 输入PPT文件路径
-            output_path: 输出PPT文件路径（如果为None，则在原文件名后加_enhanced）
+            ppt_path: 输入PPT文件路径，或可读写定位的二进制文件对象（如BytesIO、SpooledTemporaryFile）
+            output_path: 输出PPT文件路径或可写的二进制文件对象（如果为None，则在原文件名后加_enhanced；
+                         输入为文件对象时保存到内存中的BytesIO）
             google_api_key: Google Custom Search API Key（可选）
             google_cse_id: Google Custom Search Engine ID（可选）
             google_ai_api_key: Google AI (Gemini) API Key（可选，优先用于优化搜索关键词）
@@ -41,11 +220,52 @@ class PPTImageEnhancer:
             exa_api_key: EXA API Key（可选）
             serp_api_key: Serp API Key（可选）
             verbose: 是否显示详细日志
+            max_slides_in_flight: 同时处理中的最大页数（大于1时启用跨页流水线，1为逐页处理）
+            search_workers: 流水线搜索阶段的线程数
+            download_workers: 流水线下载阶段的线程数
+            hedged_download_fanout: 对冲下载的并发候选数K（大于2时同时下载前K个候选，取最先成功的2张；0为关闭）
+            search_fanout: 是否同时查询所有搜索提供商（凑够结果即返回），False时按优先顺序逐个查询
+            search_cache_path: 持久化搜索结果缓存的SQLite文件路径（多个worker共享；None为不使用）
+            search_cache_ttl: 搜索结果缓存有效期（秒）
+            search_cache_max_entries: 搜索结果缓存最多保留的条目数
+            image_store_dir: 按内容寻址的图片仓库目录（跨任务复用已下载的图片；None为不使用）
+            image_store_max_mb: 图片仓库的容量上限（MB），超出时淘汰最久未使用的图片
+            http_pool_maxsize: 每个主机默认保持的最大keep-alive连接数
+            http_host_pool_sizes: {主机名: 连接数}，为特定主机单独设置连接池大小
+            http_connect_timeout: 建立连接的超时时间（秒），与各请求的读取超时分开
+            http_pool: 直接指定共用的HTTPSessionPool（默认使用进程内共享的连接池）
+            llm_batch_size: 大于0时，处理前把整份PPT的关键词按此大小分批交给AI一次性优化（0为逐个优化）
+            speculative_keyword_optimization: 是否在AI优化关键词的同时直接用原始关键词搜索
+            speculative_llm_wait: 投机模式下原始关键词结果不足时，最多再等待AI优化的秒数
+            event_callback: 处理事件回调 callback(event, data)，见 emit_event（可选，也可用add_event_listener添加）
+            log_to_stdout: 是否把日志打印到控制台（关闭后日志只通过log事件发出）
+            image_target_dpi: 大于0时按图片在幻灯片上的显示尺寸和此DPI缩小图片后再嵌入（0为嵌入原图）
+            image_jpeg_quality: 缩小后重新编码JPEG的质量（1-95）
+            max_image_mb: 单张图片下载的大小上限（MB），超过后立即放弃该图片
+            host_health_path: 图片主机健康度统计的SQLite文件路径（多个worker共享；None为不使用）
+            host_failure_threshold: 主机连续失败多少次后熔断（直接跳过该主机）
+            host_open_seconds: 熔断持续时间（秒），之后放行一次试探请求
+            provider_limits_path: 提供商限流/配额状态的SQLite文件路径（多个worker共享；None为不限流）
+            provider_rate_limits: {提供商: [每秒请求数, 突发请求数]}，只对列出的提供商主动限速（默认不限速）
+            provider_max_wait: 令牌不足时最多等待的秒数，超过则跳过该提供商
+            provider_quota_block_seconds: 配额用尽且无法确定恢复时间时，跳过该提供商的秒数
+            checkpoint_path: 逐页检查点的SQLite文件路径（需要同时启用图片仓库；None为不记录检查点）
+            resume: 是否从检查点恢复：同一份PPT上次处理中断时，已完成的页面直接用记录的图片和模板重新排版
+            incremental: 增量处理：文本与之前处理过的页面相同时，直接复用那次的图片和排版（需要slide_manifest_path和图片仓库）
+            slide_manifest_path: 增量处理清单的SQLite文件路径（记录每页文本哈希对应的图片和模板）
         """
         self.ppt_path = ppt_path
+        # 日志中显示的文件名（输入为文件对象时使用其name属性）
+        if isinstance(ppt_path, str):
+            self.ppt_name = ppt_path
+        else:
+            self.ppt_name = str(getattr(ppt_path, 'name', None) or '<内存中的PPT>')
         if output_path is None:
-            base_name = os.path.splitext(ppt_path)[0]
-            self.output_path = f"{base_name}_enhanced.pptx"
+            if isinstance(ppt_path, str):
+                base_name = os.path.splitext(ppt_path)[0]
+                self.output_path = f"{base_name}_enhanced.pptx"
+            else:
+                self.output_path = io.BytesIO()
         else:
             self.output_path = output_path
         
@@ -65,25 +285,309 @@ class PPTImageEnhancer:
         self.last_template_id = -1  # 记录上一页使用的模板ID，确保相邻页面不同
         self.optimized_keywords_cache = {}  # 缓存已优化的关键词，避免重复调用AI
         self.failed_urls = set()  # 记录失败的URL，避免重复尝试下载
+        self.max_slides_in_flight = max(1, int(max_slides_in_flight or 1))
+        self.search_workers = max(1, int(search_workers or 1))
+        self.download_workers = max(1, int(download_workers or 1))
+        self.hedged_download_fanout = int(hedged_download_fanout or 0)
+        self.search_fanout = bool(search_fanout)
+        self.llm_batch_size = int(llm_batch_size or 0)
+        self.speculative_keyword_optimization = bool(speculative_keyword_optimization)
+        self.speculative_llm_wait = float(speculative_llm_wait)
+        self._llm_executor = None  # 投机模式下运行AI优化的线程池（按需创建）
+        self._pending_optimizations = {}
+        self._optimization_lock = threading.Lock()
+        self.search_cache = None
+        if search_cache_path:
+            self.search_cache = get_search_cache(search_cache_path, ttl=search_cache_ttl,
+                                                 max_entries=search_cache_max_entries)
+        self.http = http_pool or get_shared_http_pool(
+            pool_maxsize=int(http_pool_maxsize), host_pool_sizes=http_host_pool_sizes,
+            connect_timeout=float(http_connect_timeout))
+        self.image_store = None
+        if image_store_dir:
+            self.image_store = get_image_store(image_store_dir, max_bytes=int(image_store_max_mb) * 1024 * 1024)
+        self.rate_limiter = get_rate_limiter(provider_limits_path) if provider_limits_path else None
+        self.provider_rate_limits = {}
+        for name, limit in (provider_rate_limits or {}).items():
+            self.provider_rate_limits[name] = tuple(limit) if limit else None
+        self.provider_max_wait = float(provider_max_wait)
+        # 当前线程的请求是否已不再需要（并发查询提前返回后，其余提供商线程不再等待和消耗令牌）
+        self._request_scope = threading.local()
+        self.provider_quota_block_seconds = float(provider_quota_block_seconds)
+        self.host_health = None
+        if host_health_path:
+            self.host_health = get_host_health(host_health_path, failure_threshold=int(host_failure_threshold),
+                                               open_seconds=float(host_open_seconds))
+        self.log_to_stdout = bool(log_to_stdout)
+        # 尽早注册监听者，初始化过程中的警告也通过_log发出
+        self._event_listeners = []
+        if event_callback is not None:
+            self.add_event_listener(event_callback)
+        self.image_target_dpi = int(image_target_dpi or 0)
+        self.image_jpeg_quality = max(1, min(95, int(image_jpeg_quality)))
+        self.max_image_bytes = int(float(max_image_mb) * 1024 * 1024)
+        self.image_bytes_original = 0  # 嵌入前图片的原始总大小
+        self.image_bytes_embedded = 0  # 实际嵌入PPT的图片总大小
+        self.checkpoints = None
+        self.resume = bool(resume)
+        self._deck_key = None  # 输入PPT内容的哈希（检查点按此区分不同的PPT）
+        self._restored_slides = {}  # 可从检查点恢复的页面 {页码: 检查点}
+        if checkpoint_path:
+            if self.image_store is None:
+                self._log("[WARN] 检查点需要启用图片仓库（image_store_dir），本次不记录检查点")
+            else:
+                self.checkpoints = get_checkpoint_store(checkpoint_path)
+                self._deck_key = self._file_hash(ppt_path)
+        self.slide_manifest = None
+        if incremental and slide_manifest_path:
+            if self.image_store is None:
+                self._log("[WARN] 增量处理需要启用图片仓库（image_store_dir），本次处理所有页面")
+            else:
+                self.slide_manifest = get_slide_manifest(slide_manifest_path)
+        self.timings = StageTimings()  # 各阶段耗时统计
+        self.performance_report = None  # process_slides 完成后的性能报告
         
         if self.verbose:
             if self.google_api_key and self.google_cse_id:
-                print(f"[INFO] Google Custom Search API已配置")
+                self._log(f"[INFO] Google Custom Search API已配置")
             else:
-                print(f"[INFO] Google API未配置")
+                self._log(f"[INFO] Google API未配置")
             if self.exa_api_key:
-                print(f"[INFO] EXA API已配置")
+                self._log(f"[INFO] EXA API已配置")
             if self.serp_api_key:
-                print(f"[INFO] Serp API已配置")
+                self._log(f"[INFO] Serp API已配置")
             if self.google_ai_api_key:
-                print(f"[INFO] Google AI (Gemini) API已配置，将优先用于优化搜索关键词")
+                self._log(f"[INFO] Google AI (Gemini) API已配置，将优先用于优化搜索关键词")
             if self.ollama_base_url:
-                print(f"[INFO] Ollama本地模型已配置: {self.ollama_base_url} (模型: {self.ollama_model})")
+                self._log(f"[INFO] Ollama本地模型已配置: {self.ollama_base_url} (模型: {self.ollama_model})")
             if self.spark_api_key:
-                print(f"[INFO] Spark AI API已配置，Gemini失败时将使用Spark")
+                self._log(f"[INFO] Spark AI API已配置，Gemini失败时将使用Spark")
             if not self.google_ai_api_key and not self.spark_api_key and not self.ollama_base_url:
-                print(f"[INFO] AI API未配置，将直接使用原始关键词搜索")
+                self._log(f"[INFO] AI API未配置，将直接使用原始关键词搜索")
+        
+    def add_event_listener(self, callback):
+        """
+        订阅处理事件
+        
+        Args:
+            callback: 回调函数 callback(event, data)，event为事件名，data为事件数据字典。
+                      流水线模式下会在工作线程中调用，回调需要自行保证线程安全
+        """
+        self._event_listeners.append(callback)
+    
+    def emit_event(self, event, **data):
+        """
+        通知所有监听者一个处理事件（每个事件都带有time时间戳）
+        
+        事件类型：
+            log: 一行日志 {message}
+            started: 开始处理 {ppt_path, total}
+            slide_started: 开始处理某页 {slide, total}
+            search_done: 某页搜索完成 {slide, keyword, candidates, elapsed}
+            image_downloaded: 某页得到了一张可用图片（包括图片仓库命中）{slide, url, path, size, elapsed}
+            image_fetched: 从网络实际下载了一张图片 {url, size, elapsed}
+            provider_request: 向搜索/AI提供商发出一次请求 {provider, status, error, elapsed}
+                              status为HTTP状态码（请求异常或因限流跳过时为None），error为None表示成功
+            cache_lookup: 查询一次缓存 {cache, provider, hit}，cache为 search / llm / image_store
+            slide_done: 某页处理结束（按页码顺序）{slide, total, completed, status, images, template_id, error, elapsed}
+                        status为 done / no_text / no_images / failed
+            saved: PPT已保存 {path, total, size, save_elapsed, elapsed, image_bytes_original, image_bytes_embedded,
+                   performance}，保存到文件对象时path为None，performance见 build_performance_report
+        
+        slide从1开始计数；elapsed均为秒。回调抛出的异常会被忽略，不影响处理。
+        """
+        if not self._event_listeners:
+            return
+        data['time'] = time.time()
+        for callback in list(self._event_listeners):
+            try:
+                callback(event, data)
+            except Exception:
+                pass
+    
+    def _log(self, *args, sep=' ', end='\n', flush=False):
+        """
+        输出日志（参数与print相同）：打印到控制台，同时作为log事件通知监听者
+        
+        不替换sys.stdout，因此同一进程中的多个任务各自的日志不会混在一起
+        """
+        if self.log_to_stdout:
+            print(*args, sep=sep, end=end, flush=flush)
+        if self._event_listeners:
+            message = sep.join(str(arg) for arg in args).strip()
+            if message:
+                self.emit_event('log', message=message)
+    
+    @staticmethod
+    def _key_hash(api_key):
+        """API Key的哈希（限流状态按Key区分，但不保存Key本身）"""
+        import hashlib
+        return hashlib.sha256((api_key or 'anonymous').encode('utf-8')).hexdigest()[:16]
+    
+    def _search_cache_scope(self, provider):
+        """
+        搜索缓存中区分同一提供商不同配置的范围（不保存配置本身，只保存哈希）
+        
+        Google的结果取决于CSE（可能限定了站点）；AI优化的结果取决于依次尝试的模型。
+        其他提供商的结果与用户配置无关，返回None。
+        """
+        if provider == 'google':
+            return self._key_hash(self.google_cse_id)[:12]
+        if provider == 'llm':
+            chain = []
+            if self.google_ai_api_key:
+                chain.append(f"gemini:{self.GEMINI_ENDPOINT}")
+            if self.ollama_base_url:
+                chain.append(f"ollama:{self.ollama_model}@{self.ollama_base_url}")
+            if self.spark_api_key:
+                chain.append(f"spark:{self.spark_model}@{self.spark_base_url}")
+            return self._key_hash("|".join(chain))[:12]
+        return None
+    
+    def _provider_request(self, provider, api_key, method, url, **kwargs):
+        """
+        经过限流调度向提供商发送请求
+        
+        请求前检查该 提供商 + Key 是否处于429/配额阻断期，并从令牌桶取得许可（只限provider_rate_limits中配置的提供商，令牌不足时最多等待provider_max_wait秒）；
+        请求后根据429、Retry-After和配额错误更新阻断状态。
+        
+        Args:
+            provider: 提供商名称（google、serp、exa、scrape、gemini、spark、ollama）
+            api_key: 本次请求使用的API Key（没有Key时传None）
+            method: HTTP方法
+            url: 请求URL
+            **kwargs: 传给requests的其他参数
+            
+        Returns:
+            requests.Response
+            
+        Raises:
+            ProviderUnavailableError: 提供商处于阻断期、等待令牌超时，或并发查询已经不需要这次请求
+        """
+        if self.rate_limiter is None:
+            return self._send_provider_request(provider, method, url, **kwargs)
+        
+        key_hash = self._key_hash(api_key)
+        rate, burst = self.provider_rate_limits.get(provider) or (0, 0)
+        deadline = time.time() + self.provider_max_wait
+        cancel = getattr(self._request_scope, 'cancel', None)
+        waited = 0.0
+        while True:
+            if cancel is not None and cancel.is_set():
+                # 调用方已经不需要这次请求的结果，不再取令牌
+                if waited:
+                    self.timings.add(f"ratelimit_wait.{provider}", waited)
+                raise ProviderUnavailableError(f"{provider} 请求已取消")
+            allowed, wait, reason = self.rate_limiter.acquire(provider, key_hash, rate, burst)
+            if allowed:
+                break
+            if reason != 'rate' or time.time() + wait > deadline:
+                if waited:
+                    self.timings.add(f"ratelimit_wait.{provider}", waited)
+                if self.verbose:
+                    self._log(f"    [DEBUG] 跳过 {provider}：{reason}（约 {wait:.0f} 秒后恢复）")
+                self.emit_event('provider_request', provider=provider, status=None,
+                                error=f'skipped_{reason}', elapsed=0.0)
+                raise ProviderUnavailableError(f"{provider} 暂不可用: {reason}")
+            sleep_started = time.time()
+            if cancel is not None:
+                cancel.wait(wait)
+            else:
+                time.sleep(wait)
+            waited += time.time() - sleep_started
+        if waited:
+            # 等待令牌的时间单独统计，不计入提供商的请求耗时
+            self.timings.add(f"ratelimit_wait.{provider}", waited)
+        
+        response = self._send_provider_request(provider, method, url, **kwargs)
+        self._check_provider_limits(provider, key_hash, response)
+        return response
+    
+    def _send_provider_request(self, provider, method, url, **kwargs):
+        """
+        发送请求并发出provider_request事件（状态码、错误类型和耗时）
+        
+        耗时只包含网络请求本身，计入 search.<提供商> 或 llm.<提供商> 阶段
+        """
+        stage = f"{'llm' if provider in LLM_PROVIDERS else 'search'}.{provider}"
+        started = time.time()
+        try:
+            with self.timings.span(stage):
+                response = self.http.request(method, url, **kwargs)
+        except Exception as e:
+            self.emit_event('provider_request', provider=provider, status=None,
+                            error=type(e).__name__, elapsed=time.time() - started)
+            raise
+        status = response.status_code
+        self.emit_event('provider_request', provider=provider, status=status,
+                        error=f'http_{status}' if status >= 400 else None, elapsed=time.time() - started)
+        return response
+    
+    def _check_provider_limits(self, provider, key_hash, response):
+        """根据响应判断是否被限流或配额用尽，并记录阻断时间"""
+        status = response.status_code
+        if status not in (403, 429, 503):
+            return
+        
+        retry_after = self._parse_retry_after(response.headers.get('Retry-After'))
+        body = response.text[:2000].lower() if status != 503 else ''
+        if retry_after is None:
+            # Gemini在响应体中给出 "retryDelay": "37s"
+            match = re.search(r'retrydelay"?\s*:\s*"(\d+)', body)
+            if match:
+                retry_after = float(match.group(1))
+        # 每日/每月配额用尽（区别于每分钟的速率限制）
+        quota_exhausted = any(marker in body for marker in (
+            'dailylimitexceeded', 'perday', 'run out of searches', 'quota exceeded', 'quotaexceeded'))
+        rate_limited = 'ratelimitexceeded' in body or 'rate limit' in body
+        
+        if quota_exhausted:
+            until, reason = self._quota_reset_time(provider), 'quota_exhausted'
+        elif retry_after is not None:
+            until, reason = time.time() + retry_after, f'http_{status}_retry_after'
+        elif status == 429 or rate_limited:
+            until, reason = time.time() + 30, 'rate_limited'
+        else:
+            # 没有限流/配额信息的403/503由调用方按普通错误处理
+            return
+        
+        self.rate_limiter.block(provider, key_hash, until, reason)
+        if self.verbose:
+            self._log(f"[INFO] {provider} 被限流或配额已用尽（{reason}），{until - time.time():.0f} 秒内跳过该提供商")
+    
+    @staticmethod
+    def _parse_retry_after(value):
+        """解析Retry-After头（秒数或HTTP日期），返回秒数，无法解析时返回None"""
+        if not value:
+            return None
+        value = value.strip()
+        if value.isdigit():
+            return float(value)
+        try:
+            from email.utils import parsedate_to_datetime
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+    
+    def _quota_reset_time(self, provider):
+        """
+        配额用尽后预计恢复的时间戳
         
+        Google Custom Search 和 Gemini 的每日配额在太平洋时间零点重置；其他提供商跳过provider_quota_block_seconds秒
+        """
+        now = time.time()
+        if provider in ('google', 'gemini'):
+            from datetime import datetime, timedelta, timezone
+            try:
+                from zoneinfo import ZoneInfo
+                tz = ZoneInfo('America/Los_Angeles')
+            except Exception:
+                tz = timezone(timedelta(hours=-8))
+            local_now = datetime.fromtimestamp(now, tz)
+            next_midnight = (local_now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+            return next_midnight.timestamp()
+        return now + self.provider_quota_block_seconds
+    
     def search_images_google_api(self, keyword, count=2):
         """
         使用Google Custom Search API搜索图片
@@ -101,10 +605,10 @@ class PPTImageEnhancer:
         image_urls = []
         try:
             if self.verbose:
-                print(f"    [DEBUG] 使用Google Custom Search API搜索: {keyword}")
+                self._log(f"    [DEBUG] 使用Google Custom Search API搜索: {keyword}")
             
             # Google Custom Search API
-            url = "https://www.googleapis.com/customsearch/v1"
+            url = self.GOOGLE_CSE_ENDPOINT
             params = {
                 'key': self.google_api_key,
                 'cx': self.google_cse_id,
@@ -117,10 +621,10 @@ class PPTImageEnhancer:
                 'fileType': 'jpg,png'  # 限制为常见格式，避免webp
             }
             
-            response = requests.get(url, params=params, timeout=15)
+            response = self._provider_request('google', self.google_api_key, 'GET', url, params=params, timeout=15)
             
             if self.verbose:
-                print(f"    [DEBUG] Google API响应状态: {response.status_code}")
+                self._log(f"    [DEBUG] Google API响应状态: {response.status_code}")
             
             if response.status_code == 200:
                 data = response.json()
@@ -133,17 +637,17 @@ class PPTImageEnhancer:
                         if img_url and not img_url.lower().endswith('.webp') and '.webp' not in img_url.lower():
                             image_urls.append(img_url)
                             if self.verbose:
-                                print(f"    [DEBUG] 找到图片: {img_url[:60]}...")
+                                self._log(f"    [DEBUG] 找到图片: {img_url[:60]}...")
                 else:
                     if self.verbose:
-                        print(f"    [DEBUG] Google API未返回结果")
+                        self._log(f"    [DEBUG] Google API未返回结果")
             else:
                 if self.verbose:
-                    print(f"    [DEBUG] Google API错误: {response.status_code} - {response.text[:100]}")
+                    self._log(f"    [DEBUG] Google API错误: {response.status_code} - {response.text[:100]}")
                     
         except Exception as e:
             if self.verbose:
-                print(f"    [DEBUG] Google API异常: {str(e)}")
+                self._log(f"    [DEBUG] Google API异常: {str(e)}")
         
         return image_urls
     
@@ -161,10 +665,10 @@ class PPTImageEnhancer:
         image_urls = []
         try:
             if self.verbose:
-                print(f"    [DEBUG] 尝试爬取Google图片搜索结果: {keyword}")
+                self._log(f"    [DEBUG] 尝试爬取Google图片搜索结果: {keyword}")
             
             # 构建Google图片搜索URL
-            search_url = f"https://www.google.com/search?tbm=isch&q={quote(keyword)}&safe=active"
+            search_url = f"{self.GOOGLE_IMAGE_SEARCH_URL}?tbm=isch&q={quote(keyword)}&safe=active"
             
             headers = {
                 'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
@@ -172,10 +676,10 @@ class PPTImageEnhancer:
                 'Accept-Language': 'zh-CN,zh;q=0.9,en;q=0.8',
             }
             
-            response = requests.get(search_url, headers=headers, timeout=15)
+            response = self._provider_request('scrape', None, 'GET', search_url, headers=headers, timeout=15)
             
             if self.verbose:
-                print(f"    [DEBUG] Google搜索结果响应状态: {response.status_code}")
+                self._log(f"    [DEBUG] Google搜索结果响应状态: {response.status_code}")
             
             if response.status_code == 200:
                 # 从HTML中提取图片URL
@@ -193,19 +697,19 @@ class PPTImageEnhancer:
                         if 'encrypted-tbn0.gstatic.com' not in img_url or '=s' not in img_url:
                             image_urls.append(img_url)
                             if self.verbose:
-                                print(f"    [DEBUG] 提取到原图 {len(image_urls)}: {img_url[:60]}...")
+                                self._log(f"    [DEBUG] 提取到原图 {len(image_urls)}: {img_url[:60]}...")
                         elif len(image_urls) < count:
                             # 如果是缩略图，尝试提取原图URL（去掉尺寸参数）
                             original_url = img_url.split('=s')[0] if '=s' in img_url else img_url
                             if original_url not in image_urls:
                                 image_urls.append(original_url)
                                 if self.verbose:
-                                    print(f"    [DEBUG] 提取到原图（从缩略图转换） {len(image_urls)}: {original_url[:60]}...")
+                                    self._log(f"    [DEBUG] 提取到原图（从缩略图转换） {len(image_urls)}: {original_url[:60]}...")
                 
                 # 如果原图不够，尝试其他模式
                 if len(image_urls) < count:
                     if self.verbose:
-                        print(f"    [DEBUG] 原图结果不足({len(image_urls)}/{count})，尝试其他模式")
+                        self._log(f"    [DEBUG] 原图结果不足({len(image_urls)}/{count})，尝试其他模式")
                     
                     # 模式2：通用的 jpg/png/webp 链接（排除缩略图）
                     pattern2 = r'"(https://[^"]+\.(jpg|jpeg|png)[^"]*)"'
@@ -218,7 +722,7 @@ class PPTImageEnhancer:
                             if url not in image_urls:
                                 image_urls.append(url)
                                 if self.verbose:
-                                    print(f"    [DEBUG] 提取到图片 {len(image_urls)} (备用): {url[:60]}...")
+                                    self._log(f"    [DEBUG] 提取到图片 {len(image_urls)} (备用): {url[:60]}...")
                     
                     # 模式3：从缩略图URL中提取原图（最后手段）
                     if len(image_urls) < count:
@@ -232,7 +736,7 @@ class PPTImageEnhancer:
                     # 模式4：兜底，从<img>标签中提取src（排除缩略图）
                     if len(image_urls) < count:
                         if self.verbose:
-                            print(f"    [DEBUG] 前几种模式结果不足({len(image_urls)}/{count})，尝试从<img>标签中提取")
+                            self._log(f"    [DEBUG] 前几种模式结果不足({len(image_urls)}/{count})，尝试从<img>标签中提取")
                         img_pattern = r'<img[^>]+src="(https://[^"]+)"'
                         img_matches = re.findall(img_pattern, html, re.IGNORECASE)
                         for url in img_matches:
@@ -243,19 +747,19 @@ class PPTImageEnhancer:
                                 if url not in image_urls:
                                     image_urls.append(url)
                                     if self.verbose:
-                                        print(f"    [DEBUG] 提取到图片 (img标签-原图): {url[:60]}...")
+                                        self._log(f"    [DEBUG] 提取到图片 (img标签-原图): {url[:60]}...")
                             elif any(ext in url.lower() for ext in ['.jpg', '.jpeg', '.png']) and 'encrypted-tbn0' not in url:
                                 if url not in image_urls:
                                     image_urls.append(url)
                                     if self.verbose:
-                                        print(f"    [DEBUG] 提取到图片 (img标签): {url[:60]}...")
+                                        self._log(f"    [DEBUG] 提取到图片 (img标签): {url[:60]}...")
             else:
                 if self.verbose:
-                    print(f"    [DEBUG] Google搜索失败: {response.status_code}")
+                    self._log(f"    [DEBUG] Google搜索失败: {response.status_code}")
                     
         except Exception as e:
             if self.verbose:
-                print(f"    [DEBUG] Google爬取异常: {str(e)}")
+                self._log(f"    [DEBUG] Google爬取异常: {str(e)}")
         
         return image_urls
     
@@ -288,7 +792,7 @@ class PPTImageEnhancer:
                 "English search query:"
             )
             
-            url = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash-exp:generateContent"
+            url = self.GEMINI_ENDPOINT
             params = {'key': self.google_ai_api_key}
             payload = {
                 "contents": [{
@@ -301,29 +805,30 @@ class PPTImageEnhancer:
             }
             
             if self.verbose:
-                print(f"    [DEBUG] 调用Google Gemini AI优化关键词: {japanese_text}")
-                print(f"    [DEBUG] Gemini API请求URL: {url}")
+                self._log(f"    [DEBUG] 调用Google Gemini AI优化关键词: {japanese_text}")
+                self._log(f"    [DEBUG] Gemini API请求URL: {url}")
             
-            response = requests.post(url, params=params, json=payload, timeout=30)
+            response = self._provider_request('gemini', self.google_ai_api_key, 'POST', url,
+                                              params=params, json=payload, timeout=30)
             response.raise_for_status()
             
             result = response.json()
             candidates = result.get("candidates", [])
             if not candidates:
                 if self.verbose:
-                    print(f"    [DEBUG] Gemini API未返回候选结果")
+                    self._log(f"    [DEBUG] Gemini API未返回候选结果")
                 return None
             
             content_parts = candidates[0].get("content", {}).get("parts", [])
             if not content_parts:
                 if self.verbose:
-                    print(f"    [DEBUG] Gemini API响应格式异常")
+                    self._log(f"    [DEBUG] Gemini API响应格式异常")
                 return None
             
             content = content_parts[0].get("text", "").strip()
             
             if self.verbose:
-                print(f"    [DEBUG] Gemini AI原始响应: {content[:100]}...")
+                self._log(f"    [DEBUG] Gemini AI原始响应: {content[:100]}...")
             
             # Clean output
             optimized_keyword = content.split('\n')[0].strip()
@@ -332,16 +837,16 @@ class PPTImageEnhancer:
             
             if optimized_keyword and len(optimized_keyword) <= 40:
                 if self.verbose:
-                    print(f"    [DEBUG] Gemini AI优化后的关键词: {optimized_keyword}")
+                    self._log(f"    [DEBUG] Gemini AI优化后的关键词: {optimized_keyword}")
                 return optimized_keyword[:40]
             else:
                 if self.verbose:
-                    print(f"    [DEBUG] Gemini AI返回的关键词格式不正确: {content}")
+                    self._log(f"    [DEBUG] Gemini AI返回的关键词格式不正确: {content}")
                 return None
                 
         except Exception as e:
             if self.verbose:
-                print(f"    [DEBUG] Gemini AI优化关键词失败: {str(e)}")
+                self._log(f"    [DEBUG] Gemini AI优化关键词失败: {str(e)}")
             return None
     
     def optimize_search_keyword_with_spark(self, japanese_text):
@@ -392,17 +897,18 @@ class PPTImageEnhancer:
             }
             
             if self.verbose:
-                print(f"    [DEBUG] 调用Spark AI优化关键词: {japanese_text}")
-                print(f"    [DEBUG] Spark API请求URL: {endpoint}")
+                self._log(f"    [DEBUG] 调用Spark AI优化关键词: {japanese_text}")
+                self._log(f"    [DEBUG] Spark API请求URL: {endpoint}")
             
-            response = requests.post(endpoint, json=payload, headers=headers, timeout=30)
+            response = self._provider_request('spark', self.spark_api_key, 'POST', endpoint,
+                                              json=payload, headers=headers, timeout=30)
             response.raise_for_status()
             
             result = response.json()
             content = result.get("choices", [{}])[0].get("message", {}).get("content", "").strip()
             
             if self.verbose:
-                print(f"    [DEBUG] Spark AI原始响应: {content[:100]}...")
+                self._log(f"    [DEBUG] Spark AI原始响应: {content[:100]}...")
             
             # Clean output: keep only the first line, strip quotes and extra labels
             optimized_keyword = content.split('\n')[0].strip()
@@ -412,16 +918,16 @@ class PPTImageEnhancer:
             # Limit length to avoid overly long prompts to Google
             if optimized_keyword and len(optimized_keyword) <= 40:
                 if self.verbose:
-                    print(f"    [DEBUG] Spark AI优化后的关键词: {optimized_keyword}")
+                    self._log(f"    [DEBUG] Spark AI优化后的关键词: {optimized_keyword}")
                 return optimized_keyword[:40]
             else:
                 if self.verbose:
-                    print(f"    [DEBUG] Spark AI返回的关键词格式不正确: {content}")
+                    self._log(f"    [DEBUG] Spark AI返回的关键词格式不正确: {content}")
                 return None
                 
         except Exception as e:
             if self.verbose:
-                print(f"    [DEBUG] Spark AI优化关键词失败: {str(e)}")
+                self._log(f"    [DEBUG] Spark AI优化关键词失败: {str(e)}")
             return None
     
     def optimize_search_keyword_with_ollama(self, japanese_text):
@@ -460,18 +966,18 @@ class PPTImageEnhancer:
             }
             
             if self.verbose:
-                print(f"    [DEBUG] 调用Ollama本地模型优化关键词: {japanese_text}")
-                print(f"    [DEBUG] Ollama API请求URL: {endpoint}")
+                self._log(f"    [DEBUG] 调用Ollama本地模型优化关键词: {japanese_text}")
+                self._log(f"    [DEBUG] Ollama API请求URL: {endpoint}")
             
             # 增加超时时间到120秒，因为首次调用需要加载模型
-            response = requests.post(endpoint, json=payload, timeout=120)
+            response = self._provider_request('ollama', self.ollama_base_url, 'POST', endpoint, json=payload, timeout=120)
             response.raise_for_status()
             
             result = response.json()
             content = result.get("response", "").strip()
             
             if self.verbose:
-                print(f"    [DEBUG] Ollama原始响应: {content[:100]}...")
+                self._log(f"    [DEBUG] Ollama原始响应: {content[:100]}...")
             
             # Clean output: keep only the first line, strip quotes and extra labels
             optimized_keyword = content.split('\n')[0].strip()
@@ -481,27 +987,27 @@ class PPTImageEnhancer:
             # Limit length to avoid overly long prompts
             if optimized_keyword and len(optimized_keyword) <= 40:
                 if self.verbose:
-                    print(f"    [DEBUG] Ollama优化后的关键词: {optimized_keyword}")
+                    self._log(f"    [DEBUG] Ollama优化后的关键词: {optimized_keyword}")
                 return optimized_keyword[:40]
             else:
                 if self.verbose:
-                    print(f"    [DEBUG] Ollama返回的关键词格式不正确: {content}")
+                    self._log(f"    [DEBUG] Ollama返回的关键词格式不正确: {content}")
                 return None
                 
         except requests.exceptions.Timeout as e:
             if self.verbose:
-                print(f"    [DEBUG] Ollama优化关键词超时: {str(e)}")
-                print(f"    [DEBUG] 提示: 首次调用可能需要更长时间加载模型，跳过Ollama优化")
+                self._log(f"    [DEBUG] Ollama优化关键词超时: {str(e)}")
+                self._log(f"    [DEBUG] 提示: 首次调用可能需要更长时间加载模型，跳过Ollama优化")
             # 超时不抛出异常，只返回None，让程序继续
             return None
         except requests.exceptions.ConnectionError as e:
             if self.verbose:
-                print(f"    [DEBUG] Ollama连接错误: {str(e)}")
-                print(f"    [DEBUG] 提示: Ollama服务可能未运行，跳过Ollama优化")
+                self._log(f"    [DEBUG] Ollama连接错误: {str(e)}")
+                self._log(f"    [DEBUG] 提示: Ollama服务可能未运行，跳过Ollama优化")
             return None
         except Exception as e:
             if self.verbose:
-                print(f"    [DEBUG] Ollama优化关键词失败: {str(e)}")
+                self._log(f"    [DEBUG] Ollama优化关键词失败: {str(e)}")
             # 不抛出异常，只返回None，让程序继续
             return None
     
@@ -522,10 +1028,10 @@ class PPTImageEnhancer:
         image_urls = []
         try:
             if self.verbose:
-                print(f"    [DEBUG] 使用EXA API搜索: {keyword}")
+                self._log(f"    [DEBUG] 使用EXA API搜索: {keyword}")
             
             # EXA API - 使用search端点
-            url = "https://api.exa.ai/search"
+            url = self.EXA_ENDPOINT
             headers = {
                 'x-api-key': self.exa_api_key,
                 'Content-Type': 'application/json'
@@ -539,10 +1045,10 @@ class PPTImageEnhancer:
                 'contents': {'text': True, 'images': True}
             }
             
-            response = requests.post(url, headers=headers, json=payload, timeout=15)
+            response = self._provider_request('exa', self.exa_api_key, 'POST', url, headers=headers, json=payload, timeout=15)
             
             if self.verbose:
-                print(f"    [DEBUG] EXA API响应状态: {response.status_code}")
+                self._log(f"    [DEBUG] EXA API响应状态: {response.status_code}")
             
             if response.status_code == 200:
                 data = response.json()
@@ -555,17 +1061,17 @@ class PPTImageEnhancer:
                         if img_url and not img_url.lower().endswith('.webp') and '.webp' not in img_url.lower():
                             image_urls.append(img_url)
                             if self.verbose:
-                                print(f"    [DEBUG] 找到图片: {img_url[:60]}...")
+                                self._log(f"    [DEBUG] 找到图片: {img_url[:60]}...")
                 else:
                     if self.verbose:
-                        print(f"    [DEBUG] EXA API未返回结果")
+                        self._log(f"    [DEBUG] EXA API未返回结果")
             else:
                 if self.verbose:
-                    print(f"    [DEBUG] EXA API错误: {response.status_code} - {response.text[:100]}")
+                    self._log(f"    [DEBUG] EXA API错误: {response.status_code} - {response.text[:100]}")
                     
         except Exception as e:
             if self.verbose:
-                print(f"    [DEBUG] EXA API异常: {str(e)}")
+                self._log(f"    [DEBUG] EXA API异常: {str(e)}")
         
         return image_urls
     
@@ -586,10 +1092,10 @@ class PPTImageEnhancer:
         image_urls = []
         try:
             if self.verbose:
-                print(f"    [DEBUG] 使用Serp API搜索: {keyword}")
+                self._log(f"    [DEBUG] 使用Serp API搜索: {keyword}")
             
             # Serp API for Google Images
-            url = "https://serpapi.com/search"
+            url = self.SERP_ENDPOINT
             params = {
                 'api_key': self.serp_api_key,
                 'engine': 'google_images',
@@ -599,10 +1105,10 @@ class PPTImageEnhancer:
                 'ijn': 0  # 第一页
             }
             
-            response = requests.get(url, params=params, timeout=15)
+            response = self._provider_request('serp', self.serp_api_key, 'GET', url, params=params, timeout=15)
             
             if self.verbose:
-                print(f"    [DEBUG] Serp API响应状态: {response.status_code}")
+                self._log(f"    [DEBUG] Serp API响应状态: {response.status_code}")
             
             if response.status_code == 200:
                 data = response.json()
@@ -612,20 +1118,199 @@ class PPTImageEnhancer:
                         if img_url and not img_url.lower().endswith('.webp') and '.webp' not in img_url.lower():
                             image_urls.append(img_url)
                             if self.verbose:
-                                print(f"    [DEBUG] 找到图片: {img_url[:60]}...")
+                                self._log(f"    [DEBUG] 找到图片: {img_url[:60]}...")
                 else:
                     if self.verbose:
-                        print(f"    [DEBUG] Serp API未返回结果")
+                        self._log(f"    [DEBUG] Serp API未返回结果")
             else:
                 if self.verbose:
-                    print(f"    [DEBUG] Serp API错误: {response.status_code} - {response.text[:100]}")
+                    self._log(f"    [DEBUG] Serp API错误: {response.status_code} - {response.text[:100]}")
                     
         except Exception as e:
             if self.verbose:
-                print(f"    [DEBUG] Serp API异常: {str(e)}")
+                self._log(f"    [DEBUG] Serp API异常: {str(e)}")
         
         return image_urls
     
+    def _complete_batch_with_llm(self, provider, prompt, max_tokens):
+        """
+        调用指定的AI模型完成批量关键词优化的prompt（要求返回JSON）
+        
+        Args:
+            provider: 'gemini'、'ollama' 或 'spark'
+            prompt: 完整的prompt
+            max_tokens: 最大输出长度
+            
+        Returns:
+            模型返回的原始文本
+        """
+        if provider == 'gemini':
+            url = self.GEMINI_ENDPOINT
+            payload = {
+                "contents": [{"parts": [{"text": prompt}]}],
+                "generationConfig": {
+                    "temperature": 0.3,
+                    "maxOutputTokens": max_tokens,
+                    "responseMimeType": "application/json"
+                }
+            }
+            response = self._provider_request('gemini', self.google_ai_api_key, 'POST', url,
+                                              params={'key': self.google_ai_api_key}, json=payload, timeout=60)
+            response.raise_for_status()
+            parts = response.json().get("candidates", [{}])[0].get("content", {}).get("parts", [])
+            return parts[0].get("text", "") if parts else ""
+        
+        if provider == 'ollama':
+            endpoint = f"{self.ollama_base_url.rstrip('/')}/api/generate"
+            payload = {
+                "model": self.ollama_model,
+                "prompt": prompt,
+                "stream": False,
+                "format": "json",
+                "options": {"temperature": 0.3, "num_predict": max_tokens}
+            }
+            # CPU上的本地模型处理长prompt较慢，给足时间（仍然只有一次调用）
+            response = self._provider_request('ollama', self.ollama_base_url, 'POST', endpoint, json=payload, timeout=300)
+            response.raise_for_status()
+            return response.json().get("response", "")
+        
+        headers = {
+            "Authorization": f"Bearer {self.spark_api_key}",
+            "Content-Type": "application/json",
+        }
+        payload = {
+            "model": self.spark_model,
+            "messages": [{"role": "user", "content": prompt}],
+            "stream": False,
+            "temperature": 0.3,
+            "max_tokens": max_tokens,
+        }
+        response = self._provider_request('spark', self.spark_api_key, 'POST', f"{self.spark_base_url.rstrip('/')}/chat/completions",
+                                          json=payload, headers=headers, timeout=60)
+        response.raise_for_status()
+        return response.json().get("choices", [{}])[0].get("message", {}).get("content", "")
+    
+    @staticmethod
+    def _parse_batch_keywords(content, keywords):
+        """
+        从模型输出中解析 {日语: 英文关键词} 映射，丢弃格式不正确的条目
+        
+        Returns:
+            {原始关键词: 优化后的关键词}
+        """
+        match = re.search(r'\{.*\}', content or '', re.DOTALL)
+        if not match:
+            return {}
+        data = json.loads(match.group(0))
+        if not isinstance(data, dict):
+            return {}
+        result = {}
+        for keyword in keywords:
+            value = data.get(keyword)
+            if not isinstance(value, str):
+                continue
+            value = re.sub(r'^["\']|["\']$', '', value.split('\n')[0].strip())
+            if value and len(value) <= 40:
+                result[keyword] = value
+        return result
+    
+    def optimize_search_keywords_batch(self, keywords):
+        """
+        批量优化关键词：把整份PPT的关键词放进一个（或按llm_batch_size分成几个）prompt，
+        解析返回的JSON映射并写入关键词缓存，把N次AI调用变成1~2次
+        
+        没有出现在返回结果中的关键词不写缓存，之后仍会逐个优化。
+        
+        Args:
+            keywords: 原始关键词列表
+            
+        Returns:
+            成功优化的关键词数量
+        """
+        providers = []
+        if self.google_ai_api_key:
+            providers.append('gemini')
+        if self.ollama_base_url:
+            providers.append('ollama')
+        if self.spark_api_key:
+            providers.append('spark')
+        if not providers or self.llm_batch_size <= 0:
+            return 0
+        llm_scope = self._search_cache_scope('llm')
+        
+        # 去重，并跳过已经在缓存中的关键词
+        pending = []
+        for keyword in keywords:
+            if not keyword or keyword in pending or keyword in self.optimized_keywords_cache:
+                continue
+            if self.search_cache is not None:
+                cached = self.search_cache.get('llm', keyword, 1, scope=llm_scope)
+                if cached:
+                    self.optimized_keywords_cache[keyword] = cached[0]
+                    continue
+            pending.append(keyword)
+        
+        if not pending:
+            return 0
+        
+        optimized_count = 0
+        for start in range(0, len(pending), self.llm_batch_size):
+            chunk = pending[start:start + self.llm_batch_size]
+            prompt = (
+                "You are helping to search images on Google Images.\n"
+                "For EACH Japanese word or short phrase in the JSON array below, generate ONE short English\n"
+                "image search query (at most 4-5 words) that will find images closely related to its meaning.\n"
+                "If a word is abstract, choose a concrete visual concept that represents it.\n\n"
+                f"Input: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+                "Output ONLY a JSON object that maps every input string (exactly as given) to its English query,\n"
+                "without any explanation."
+            )
+            max_tokens = 30 * len(chunk) + 100
+            
+            for provider in providers:
+                if self.verbose:
+                    self._log(f"    [DEBUG] 批量优化关键词（{provider}）: {len(chunk)} 个")
+                try:
+                    start_time = time.time()
+                    with self.timings.span(f"optimize_batch.{provider}"):
+                        content = self._complete_batch_with_llm(provider, prompt, max_tokens)
+                    mapping = self._parse_batch_keywords(content, chunk)
+                except Exception as e:
+                    if self.verbose:
+                        self._log(f"    [DEBUG] 批量优化关键词失败（{provider}）: {type(e).__name__}: {str(e)[:100]}")
+                    continue
+                if not mapping:
+                    if self.verbose:
+                        self._log(f"    [DEBUG] {provider} 返回的批量结果无法解析: {str(content)[:100]}")
+                    continue
+                
+                if self.verbose:
+                    self._log(f"    [DEBUG] {provider} 批量优化完成: {len(mapping)}/{len(chunk)} 个，"
+                          f"耗时 {time.time() - start_time:.1f}秒")
+                for keyword, optimized_keyword in mapping.items():
+                    self.optimized_keywords_cache[keyword] = optimized_keyword
+                    if self.search_cache is not None:
+                        self.search_cache.put('llm', keyword, 1, [optimized_keyword], scope=llm_scope)
+                optimized_count += len(mapping)
+                break
+        
+        return optimized_count
+    
+    def _prefetch_slide_keywords(self):
+        """处理幻灯片之前，批量优化整份PPT中会用到的关键词"""
+        keywords = []
+        for slide in self.prs.slides:
+            texts = self.extract_text_from_slide(slide)
+            if not texts:
+                continue
+            # 与 search_images 和重试逻辑中实际使用的关键词保持一致
+            keywords.append(self.clean_search_keyword(" ".join(texts)))
+            keywords.append(texts[0])
+        
+        self._log(f"批量优化搜索关键词...")
+        optimized_count = self.optimize_search_keywords_batch(keywords)
+        self._log(f"  已预先优化 {optimized_count} 个关键词")
+    
     def optimize_search_keyword_cached(self, keyword):
         """
         优化搜索关键词（带缓存，避免重复调用AI）
@@ -639,56 +1324,80 @@ class PPTImageEnhancer:
         # 检查缓存
         if keyword in self.optimized_keywords_cache:
             if self.verbose:
-                print(f"    [DEBUG] 使用缓存的关键词优化结果: {self.optimized_keywords_cache[keyword]}")
+                self._log(f"    [DEBUG] 使用缓存的关键词优化结果: {self.optimized_keywords_cache[keyword]}")
             return self.optimized_keywords_cache[keyword]
         
-        # 优先使用Gemini AI优化搜索关键词，失败则尝试Ollama，最后尝试Spark AI
-        optimized_keyword = None
-        if self.google_ai_api_key:
-            optimized_keyword = self.optimize_search_keyword_with_gemini(keyword)
-            if not optimized_keyword and self.ollama_base_url:
+        # 检查持久化缓存（其他任务或其他worker已经优化过的关键词）
+        if self.search_cache is not None:
+            cached = self.search_cache.get('llm', keyword, 1, scope=self._search_cache_scope('llm'))
+            self.emit_event('cache_lookup', cache='llm', provider=None, hit=bool(cached))
+            if cached:
                 if self.verbose:
-                    print(f"    [DEBUG] Gemini优化失败，尝试使用Ollama本地模型")
+                    self._log(f"    [DEBUG] 使用持久化缓存的关键词优化结果: {cached[0]}")
+                self.optimized_keywords_cache[keyword] = cached[0]
+                return cached[0]
+        
+        with self.timings.span('optimize'):
+            # 优先使用Gemini AI优化搜索关键词，失败则尝试Ollama，最后尝试Spark AI
+            optimized_keyword = None
+            if self.google_ai_api_key:
+                optimized_keyword = self.optimize_search_keyword_with_gemini(keyword)
+                if not optimized_keyword and self.ollama_base_url:
+                    if self.verbose:
+                        self._log(f"    [DEBUG] Gemini优化失败，尝试使用Ollama本地模型")
+                    optimized_keyword = self.optimize_search_keyword_with_ollama(keyword)
+                if not optimized_keyword and self.spark_api_key:
+                    if self.verbose:
+                        self._log(f"    [DEBUG] Gemini和Ollama优化失败，尝试使用Spark AI")
+                    optimized_keyword = self.optimize_search_keyword_with_spark(keyword)
+            elif self.ollama_base_url:
                 optimized_keyword = self.optimize_search_keyword_with_ollama(keyword)
-            if not optimized_keyword and self.spark_api_key:
-                if self.verbose:
-                    print(f"    [DEBUG] Gemini和Ollama优化失败，尝试使用Spark AI")
-                optimized_keyword = self.optimize_search_keyword_with_spark(keyword)
-        elif self.ollama_base_url:
-            optimized_keyword = self.optimize_search_keyword_with_ollama(keyword)
-            if not optimized_keyword and self.spark_api_key:
-                if self.verbose:
-                    print(f"    [DEBUG] Ollama优化失败，尝试使用Spark AI")
+                if not optimized_keyword and self.spark_api_key:
+                    if self.verbose:
+                        self._log(f"    [DEBUG] Ollama优化失败，尝试使用Spark AI")
+                    optimized_keyword = self.optimize_search_keyword_with_spark(keyword)
+            elif self.spark_api_key:
                 optimized_keyword = self.optimize_search_keyword_with_spark(keyword)
-        elif self.spark_api_key:
-            optimized_keyword = self.optimize_search_keyword_with_spark(keyword)
         
         # 缓存结果（包括None，避免重复尝试）
         self.optimized_keywords_cache[keyword] = optimized_keyword
+        # 只把成功的结果写入持久化缓存，失败可能只是暂时的
+        if optimized_keyword and self.search_cache is not None:
+            self.search_cache.put('llm', keyword, 1, [optimized_keyword], scope=self._search_cache_scope('llm'))
         return optimized_keyword
     
-    def search_images(self, keyword, count=2):
+    def clean_search_keyword(self, keyword):
         """
-        搜索与关键词相关的图片（优先使用Google图片搜索）
+        清理关键词，提取主要词汇（去掉括号和假名）
         
         Args:
-            keyword: 搜索关键词（日语词汇）
-            count: 需要的图片数量
+            keyword: 原始关键词
             
         Returns:
-            图片URL列表
+            清理后的关键词
         """
-        image_urls = []
-        
-        # 清理关键词，提取主要词汇（去掉括号和假名）
         clean_keyword = keyword
         if '）' in clean_keyword or ')' in clean_keyword:
             parts = clean_keyword.split('）') if '）' in clean_keyword else clean_keyword.split(')')
             if len(parts) > 1:
                 clean_keyword = parts[-1].strip()
+        return clean_keyword
+    
+    def build_search_keywords(self, keyword, optimize=True):
+        """
+        生成搜索关键词变体（AI优化后的关键词优先）
+        
+        Args:
+            keyword: 搜索关键词（日语词汇）
+            optimize: 是否调用AI优化关键词（False时只生成原始关键词变体）
+            
+        Returns:
+            搜索关键词列表
+        """
+        clean_keyword = self.clean_search_keyword(keyword)
         
         # 使用缓存的优化方法
-        optimized_keyword = self.optimize_search_keyword_cached(clean_keyword)
+        optimized_keyword = self.optimize_search_keyword_cached(clean_keyword) if optimize else None
         
         # 生成搜索关键词变体
         search_keywords = []
@@ -701,15 +1410,163 @@ class PPTImageEnhancer:
         ])
         
         if self.verbose:
-            print(f"    [DEBUG] 原始关键词: {clean_keyword}")
+            self._log(f"    [DEBUG] 原始关键词: {clean_keyword}")
             if optimized_keyword:
-                print(f"    [DEBUG] Spark AI优化后的关键词: {optimized_keyword}")
-            print(f"    [DEBUG] 搜索关键词列表: {search_keywords}")
+                self._log(f"    [DEBUG] Spark AI优化后的关键词: {optimized_keyword}")
+            self._log(f"    [DEBUG] 搜索关键词列表: {search_keywords}")
+        
+        return search_keywords
+    
+    def get_search_providers(self):
+        """
+        获取已配置的图片搜索提供商（按优先顺序排列）
+        
+        Returns:
+            (名称, 搜索方法) 元组列表
+        """
+        providers = []
+        if self.google_api_key and self.google_cse_id:
+            providers.append(('google', self.search_images_google_api))
+        if self.serp_api_key:
+            providers.append(('serp', self.search_images_serp_api))
+        if self.exa_api_key:
+            providers.append(('exa', self.search_images_exa_api))
+        # 爬取Google图片搜索结果不需要API key，始终作为最后的备用方案
+        providers.append(('scrape', self.search_images_google_scrape))
+        return providers
+    
+    def search_with_provider(self, name, search_func, keyword, count):
+        """
+        调用单个搜索提供商（先查持久化缓存，未命中时才发起网络请求）
+        
+        Args:
+            name: 提供商名称
+            search_func: 提供商的搜索方法
+            keyword: 搜索关键词
+            count: 需要的图片数量
+            
+        Returns:
+            图片URL列表（未过滤已知失败的URL）
+        """
+        if self.search_cache is not None:
+            cached = self.search_cache.get(name, keyword, count, scope=self._search_cache_scope(name))
+            if cached is not None and not self._has_usable_url(cached):
+                # 缓存的URL都已下载失败或所在主机熔断中，重新搜索并覆盖该条目
+                if self.verbose:
+                    self._log(f"    [DEBUG] 搜索缓存({name}) 的结果均不可用，重新搜索: {keyword}")
+                cached = None
+            self.emit_event('cache_lookup', cache='search', provider=name, hit=cached is not None)
+            if cached is not None:
+                if self.verbose:
+                    self._log(f"    [DEBUG] 搜索缓存命中({name}): {keyword} → {len(cached)} 个结果")
+                return cached[:count]
+        
+        urls = search_func(keyword, count)
+        # 空结果不缓存（可能是配额用尽或网络错误）
+        if urls and self.search_cache is not None:
+            self.search_cache.put(name, keyword, count, urls, scope=self._search_cache_scope(name))
+        return urls
+    
+    def _has_usable_url(self, urls):
+        """判断URL列表中是否还有可以尝试下载的（不在失败列表中且主机未熔断）"""
+        urls = [url for url in urls if url not in self.failed_urls]
+        if not urls or self.host_health is None:
+            return bool(urls)
+        states = self.host_health.get_states(self._url_host(url) for url in urls)
+        return any(self.host_health.is_available(states.get(self._url_host(url))) for url in urls)
+    
+    def search_images(self, keyword, count=2):
+        """
+        搜索与关键词相关的图片（优先使用Google图片搜索）
+        
+        search_fanout开启时同时查询所有已配置的提供商，否则按优先顺序逐个查询
+        
+        Args:
+            keyword: 搜索关键词（日语词汇）
+            count: 需要的图片数量
+            
+        Returns:
+            图片URL列表
+        """
+        has_llm = self.google_ai_api_key or self.ollama_base_url or self.spark_api_key
+        if (self.speculative_keyword_optimization and has_llm
+                and self.clean_search_keyword(keyword) not in self.optimized_keywords_cache):
+            image_urls = self._search_images_speculative(keyword, count)
+        else:
+            image_urls = self._search_with_keywords(self.build_search_keywords(keyword), count)
+        
+        # 按主机健康度排序：成功率高的主机在前，熔断中的主机排到最后
+        if self.host_health is not None:
+            image_urls = self.host_health.rank_urls(image_urls, self._url_host)
+        
+        # 不再使用随机Picsum图片，只使用实际搜索结果
+        if self.verbose:
+            self._log(f"    [DEBUG] 总共找到 {len(image_urls)} 张图片（已过滤 {len(self.failed_urls)} 个已知失败的URL）")
+        
+        return image_urls[:count]
+    
+    def _search_with_keywords(self, search_keywords, count):
+        """按配置选择并发查询或逐个查询提供商"""
+        if self.search_fanout:
+            return self._search_images_fanout(search_keywords, count)
+        return self._search_images_sequential(search_keywords, count)
+    
+    def _start_keyword_optimization(self, keyword):
+        """
+        在后台线程中开始AI关键词优化（同一关键词同时只优化一次）
+        
+        Returns:
+            concurrent.futures.Future，结果为优化后的关键词或None
+        """
+        with self._optimization_lock:
+            future = self._pending_optimizations.get(keyword)
+            if future is None:
+                if self._llm_executor is None:
+                    self._llm_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="llm-optimize")
+                future = self._llm_executor.submit(self.optimize_search_keyword_cached, keyword)
+                self._pending_optimizations[keyword] = future
+            return future
+    
+    def _search_images_speculative(self, keyword, count):
+        """
+        投机搜索：原始关键词的搜索和AI关键词优化同时进行
+        
+        原始关键词的结果足够时直接使用（AI优化继续在后台完成并写入缓存，供重试和后续页面使用）；
+        不够时最多再等待speculative_llm_wait秒，AI优化及时返回才用优化后的关键词补充搜索。
+        """
+        future = self._start_keyword_optimization(self.clean_search_keyword(keyword))
+        raw_keywords = self.build_search_keywords(keyword, optimize=False)
+        image_urls = self._search_with_keywords(raw_keywords, count)
+        if len(image_urls) >= count:
+            if self.verbose:
+                self._log(f"    [DEBUG] 原始关键词结果已足够({len(image_urls)}/{count})，不等待AI优化")
+            return image_urls
+        
+        try:
+            optimized_keyword = future.result(timeout=self.speculative_llm_wait)
+        except Exception:
+            optimized_keyword = None
+        if not optimized_keyword or optimized_keyword in raw_keywords:
+            if self.verbose:
+                self._log(f"    [DEBUG] AI优化未在 {self.speculative_llm_wait} 秒内返回可用结果，使用原始关键词结果")
+            return image_urls
+        
+        if self.verbose:
+            self._log(f"    [DEBUG] 原始关键词结果不足({len(image_urls)}/{count})，使用AI优化后的关键词: {optimized_keyword}")
+        merged = []
+        for url in self._search_with_keywords([optimized_keyword], count) + image_urls:
+            if url not in merged:
+                merged.append(url)
+        return merged
+    
+    def _search_images_sequential(self, search_keywords, count):
+        """按优先顺序依次查询各提供商：Google API → Serp API → EXA API → Google爬虫"""
+        image_urls = []
         
         # 方案1: 尝试使用Google Custom Search API
         if self.google_api_key and self.google_cse_id:
             for search_term in search_keywords:
-                google_urls = self.search_images_google_api(search_term, count)
+                google_urls = self.search_with_provider('google', self.search_images_google_api, search_term, count)
                 # 过滤掉已知失败的URL
                 google_urls = [url for url in google_urls if url not in self.failed_urls]
                 image_urls.extend(google_urls)
@@ -719,9 +1576,9 @@ class PPTImageEnhancer:
         # 方案2: 如果Google API结果不足，尝试使用Serp API
         if len(image_urls) < count and self.serp_api_key:
             if self.verbose:
-                print(f"    [DEBUG] Google API结果不足({len(image_urls)}/{count})，尝试使用Serp API")
+                self._log(f"    [DEBUG] Google API结果不足({len(image_urls)}/{count})，尝试使用Serp API")
             for search_term in search_keywords:
-                serp_urls = self.search_images_serp_api(search_term, count - len(image_urls))
+                serp_urls = self.search_with_provider('serp', self.search_images_serp_api, search_term, count - len(image_urls))
                 # 过滤掉已知失败的URL
                 serp_urls = [url for url in serp_urls if url not in self.failed_urls]
                 image_urls.extend(serp_urls)
@@ -731,9 +1588,9 @@ class PPTImageEnhancer:
         # 方案3: 如果结果不足，尝试使用EXA API
         if len(image_urls) < count and self.exa_api_key:
             if self.verbose:
-                print(f"    [DEBUG] API结果不足({len(image_urls)}/{count})，尝试使用EXA API")
+                self._log(f"    [DEBUG] API结果不足({len(image_urls)}/{count})，尝试使用EXA API")
             for search_term in search_keywords:
-                exa_urls = self.search_images_exa_api(search_term, count - len(image_urls))
+                exa_urls = self.search_with_provider('exa', self.search_images_exa_api, search_term, count - len(image_urls))
                 # 过滤掉已知失败的URL
                 exa_urls = [url for url in exa_urls if url not in self.failed_urls]
                 image_urls.extend(exa_urls)
@@ -743,33 +1600,174 @@ class PPTImageEnhancer:
         # 方案4: 如果API结果不足，尝试爬取Google图片搜索结果
         if len(image_urls) < count:
             if self.verbose:
-                print(f"    [DEBUG] API结果不足({len(image_urls)}/{count})，尝试爬取Google搜索结果")
+                self._log(f"    [DEBUG] API结果不足({len(image_urls)}/{count})，尝试爬取Google搜索结果")
             for search_term in search_keywords:
-                scraped_urls = self.search_images_google_scrape(search_term, count - len(image_urls))
+                scraped_urls = self.search_with_provider('scrape', self.search_images_google_scrape, search_term, count - len(image_urls))
                 # 过滤掉已知失败的URL
                 scraped_urls = [url for url in scraped_urls if url not in self.failed_urls]
                 image_urls.extend(scraped_urls)
                 if len(image_urls) >= count:
                     break
         
-        # 不再使用随机Picsum图片，只使用实际搜索结果
+        return image_urls
+    
+    def _search_images_fanout(self, search_keywords, count):
+        """
+        同时查询所有已配置的提供商，凑够count个不重复且未失败的URL后立即返回
+        
+        每个提供商在自己的线程中依次尝试关键词变体，每得到一批结果就放入队列；
+        同时到达的多批结果按提供商优先顺序合并，因此Google的结果仍然排在Serp之前。
+        提前返回后，仍在运行的提供商线程在当前请求结束后不再继续查询其余变体。
+        """
+        import queue
+        
+        providers = self.get_search_providers()
+        results = queue.Queue()
+        stop_event = threading.Event()
+        
+        def provider_worker(rank, name, search_func):
+            self._request_scope.cancel = stop_event
+            try:
+                found = 0
+                for search_term in search_keywords:
+                    if stop_event.is_set() or found >= count:
+                        break
+                    try:
+                        urls = self.search_with_provider(name, search_func, search_term, count)
+                    except Exception as e:
+                        if self.verbose:
+                            self._log(f"    [DEBUG] {name} 搜索异常: {str(e)}")
+                        urls = []
+                    found += len(urls)
+                    results.put((rank, urls))
+            finally:
+                self._request_scope.cancel = None
+                results.put((rank, None))  # 该提供商已结束
+        
         if self.verbose:
-            print(f"    [DEBUG] 总共找到 {len(image_urls)} 张图片（已过滤 {len(self.failed_urls)} 个已知失败的URL）")
+            self._log(f"    [DEBUG] 并发查询 {len(providers)} 个搜索提供商: {[name for name, _ in providers]}")
         
-        return image_urls[:count]
+        for rank, (name, search_func) in enumerate(providers):
+            threading.Thread(target=provider_worker, args=(rank, name, search_func),
+                             name=f"search-{name}", daemon=True).start()
+        
+        urls_by_rank = [[] for _ in providers]
+        pending = len(providers)
+        image_urls = []
+        try:
+            while pending > 0:
+                batches = [results.get()]
+                # 取出同时已经到达的其他结果，一起按优先顺序合并
+                while True:
+                    try:
+                        batches.append(results.get_nowait())
+                    except queue.Empty:
+                        break
+                for rank, urls in batches:
+                    if urls is None:
+                        pending -= 1
+                    else:
+                        urls_by_rank[rank].extend(urls)
+                
+                image_urls = []
+                for urls in urls_by_rank:
+                    for url in urls:
+                        if url not in self.failed_urls and url not in image_urls:
+                            image_urls.append(url)
+                if len(image_urls) >= count:
+                    if self.verbose:
+                        self._log(f"    [DEBUG] 已获得 {len(image_urls)} 个候选URL，不再等待其余提供商")
+                    break
+        finally:
+            stop_event.set()
+        
+        return image_urls
+    
+    # 判断图片格式需要读取的开头字节数
+    SNIFF_BYTES = 200
+    # 视为主机层面失败（计入熔断）的HTTP状态码，404等只与单个URL有关
+    HOST_FAILURE_STATUSES = (401, 403, 429, 500, 502, 503, 504)
+    
+    @staticmethod
+    def _url_host(url):
+        """取URL的主机名"""
+        try:
+            return (urlparse(url).hostname or '').lower()
+        except ValueError:
+            return ''
+    
+    def _record_host_result(self, url, success, latency=None, reason=None):
+        """把一次下载结果计入主机健康度统计"""
+        if self.host_health is None:
+            return
+        host = self._url_host(url)
+        if not host:
+            return
+        if success:
+            self.host_health.record_success(host, latency)
+        elif self.host_health.record_failure(host, reason) and self.verbose:
+            self._log(f"    [DEBUG] 主机 {host} 连续失败，已熔断 {self.host_health.open_seconds:.0f} 秒（原因: {reason}）")
     
-    def download_image(self, url, save_path, retry_count=3):
+    @staticmethod
+    def _sniff_image_format(head):
         """
-        下载图片到本地（带重试机制和详细日志）
+        根据内容开头的字节判断格式
+        
+        Args:
+            head: 内容开头的字节（最多SNIFF_BYTES个）
+            
+        Returns:
+            'JPEG' / 'PNG' / 'GIF' / 'WEBP' / 'HTML'，无法识别时返回None
+        """
+        if head[:2] == b'\xff\xd8':
+            return 'JPEG'
+        if head[:8] == b'\x89PNG\r\n\x1a\n':
+            return 'PNG'
+        if head[:6] in (b'GIF87a', b'GIF89a'):
+            return 'GIF'
+        if head[:4] == b'RIFF' and b'WEBP' in head[:20]:
+            return 'WEBP'
+        text = head.decode('utf-8', errors='ignore').lstrip().lower()
+        if text.startswith('<!doctype') or text.startswith('<html') or '<html' in text[:100]:
+            return 'HTML'
+        return None
+    
+    def download_image(self, url, save_path=None, retry_count=3, cancel_event=None):
+        """
+        下载图片（带重试机制和详细日志）
         
         Args:
             url: 图片URL
-            save_path: 保存路径
+            save_path: 保存路径（None时不写磁盘，图片保存在内存中）
             retry_count: 重试次数
+            cancel_event: 可选的threading.Event，被设置后立即放弃下载（用于对冲下载取消多余请求）
             
         Returns:
-            是否下载成功
+            下载成功时返回图片：使用图片仓库时为仓库中的文件路径，指定save_path时为该路径，
+            否则为内存中的BytesIO（可直接交给add_picture_safe）；失败返回False
         """
+        # 先查图片仓库，之前任务下载过的图片不再访问网络
+        if self.image_store is not None:
+            stored_path = self.image_store.lookup_url(url)
+            self.emit_event('cache_lookup', cache='image_store', provider=None, hit=bool(stored_path))
+            if stored_path:
+                if self.verbose:
+                    self._log(f"    [DEBUG] 图片仓库命中: {url[:60]}... → {stored_path}")
+                return stored_path
+        
+        # 熔断中的主机直接跳过，不再等待超时
+        if self.host_health is not None:
+            host = self._url_host(url)
+            if host and not self.host_health.acquire(host):
+                if self.verbose:
+                    self._log(f"    [DEBUG] ✗ 主机 {host} 处于熔断状态，已跳过: {url[:60]}...")
+                return False
+        
+        with self.timings.span(f"download.{self._url_host(url) or 'unknown'}"):
+            return self._fetch_image(url, save_path, retry_count, cancel_event)
+    
+    def _fetch_image(self, url, save_path, retry_count, cancel_event):
+        """从网络下载图片（download_image 的网络部分，参数和返回值相同）"""
         headers = {
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
             'Accept': 'image/webp,image/apng,image/*,*/*;q=0.8',
@@ -778,20 +1776,24 @@ class PPTImageEnhancer:
         }
         
         if self.verbose:
-            print(f"    [DEBUG] 开始下载图片")
-            print(f"    [DEBUG] URL: {url[:80]}...")
-            print(f"    [DEBUG] 保存路径: {save_path}")
+            self._log(f"    [DEBUG] 开始下载图片")
+            self._log(f"    [DEBUG] URL: {url[:80]}...")
+            if save_path:
+                self._log(f"    [DEBUG] 保存路径: {save_path}")
         
         # 为了避免在某个服务器上长时间反复重试，
         # 一旦出现超时或连接错误，立即放弃该URL，返回失败，
         # 由上层逻辑去尝试其他图片或重新搜索。
         for attempt in range(retry_count):
+            if cancel_event is not None and cancel_event.is_set():
+                return False
+            response = None
             try:
                 if self.verbose and attempt > 0:
-                    print(f"    [DEBUG] 重试 {attempt}/{retry_count}")
+                    self._log(f"    [DEBUG] 重试 {attempt}/{retry_count}")
                 
                 start_time = time.time()
-                response = requests.get(
+                response = self.http.get(
                     url, 
                     timeout=30,  # 增加超时时间
                     allow_redirects=True, 
@@ -801,111 +1803,203 @@ class PPTImageEnhancer:
                 elapsed_time = time.time() - start_time
                 
                 if self.verbose:
-                    print(f"    [DEBUG] HTTP状态码: {response.status_code}")
-                    print(f"    [DEBUG] 响应时间: {elapsed_time:.2f}秒")
-                    print(f"    [DEBUG] Content-Type: {response.headers.get('Content-Type', '未知')}")
-                    print(f"    [DEBUG] Content-Length: {response.headers.get('Content-Length', '未知')} bytes")
+                    self._log(f"    [DEBUG] HTTP状态码: {response.status_code}")
+                    self._log(f"    [DEBUG] 响应时间: {elapsed_time:.2f}秒")
+                    self._log(f"    [DEBUG] Content-Type: {response.headers.get('Content-Type', '未知')}")
+                    self._log(f"    [DEBUG] Content-Length: {response.headers.get('Content-Length', '未知')} bytes")
                 
                 if response.status_code == 200:
                     # 先根据 Content-Type 判断是否为WEBP，直接拒绝
                     content_type = response.headers.get('Content-Type', '').lower()
                     if 'image/webp' in content_type:
                         if self.verbose:
-                            print(f"    [DEBUG] 检测到WEBP格式(Content-Type)，已跳过该图片: {url}")
+                            self._log(f"    [DEBUG] 检测到WEBP格式(Content-Type)，已跳过该图片: {url}")
                         self.failed_urls.add(url)  # 记录失败的URL
                         return False
                     
-                    # 检查是否是有效的图片
-                    content = response.content
-                    content_size = len(content)
-                    
-                    if self.verbose:
-                        print(f"    [DEBUG] 下载内容大小: {content_size} bytes")
+                    # Content-Length已经超过上限时不再下载
+                    content_length = response.headers.get('Content-Length', '')
+                    if content_length.isdigit() and int(content_length) > self.max_image_bytes:
+                        if self.verbose:
+                            self._log(f"    [DEBUG] ✗ 图片过大 ({content_length} bytes > {self.max_image_bytes} bytes)，已跳过: {url}")
+                        self.failed_urls.add(url)  # 记录失败的URL
+                        return False
                     
-                    if content_size > 1000:  # 至少1KB
-                        # 首先检查是否是HTML错误页面（常见错误响应）
-                        content_str = content[:200].decode('utf-8', errors='ignore').lower()
-                        if content_str.startswith('<!doctype') or content_str.startswith('<html') or '<html' in content_str[:100]:
-                            if self.verbose:
-                                print(f"    [DEBUG] ✗ 下载的内容是HTML页面而不是图片，已跳过: {url}")
-                            self.failed_urls.add(url)  # 记录失败的URL
-                            return False
-                        
-                        # 检查是否是图片格式
-                        is_image = False
-                        image_format = "未知"
-                        
-                        if content[:2] == b'\xff\xd8':
-                            is_image = True
-                            image_format = "JPEG"
-                        elif content[:8] == b'\x89PNG\r\n\x1a\n':
-                            is_image = True
-                            image_format = "PNG"
-                        elif content[:6] in [b'GIF87a', b'GIF89a']:
-                            is_image = True
-                            image_format = "GIF"
-                        elif content[:12] == b'RIFF' and b'WEBP' in content[:20]:
-                            # 明确识别为WEBP，直接跳过，不保存到本地
+                    # 分块流式读取：先根据开头的字节判断格式，不是图片立即放弃；超过大小上限也立即放弃
+                    # （同时便于在对冲下载中被取消时尽快停止）
+                    buffer = io.BytesIO()
+                    image_format = None
+                    for chunk in response.iter_content(chunk_size=64 * 1024):
+                        if cancel_event is not None and cancel_event.is_set():
+                            response.close()
                             if self.verbose:
-                                print(f"    [DEBUG] 检测到WEBP图片(内容特征)，已跳过该图片: {url}")
-                            self.failed_urls.add(url)  # 记录失败的URL
+                                self._log(f"    [DEBUG] 下载已取消（其他候选已成功）: {url[:60]}...")
                             return False
-                        
+                        buffer.write(chunk)
+                        if image_format is None and buffer.tell() >= self.SNIFF_BYTES:
+                            image_format = self._sniff_image_format(buffer.getvalue()[:self.SNIFF_BYTES])
+                            if image_format not in ('JPEG', 'PNG', 'GIF'):
+                                break
+                        if buffer.tell() > self.max_image_bytes:
+                            break
+                    if image_format is None:
+                        # 内容不足SNIFF_BYTES字节
+                        image_format = self._sniff_image_format(buffer.getvalue()[:self.SNIFF_BYTES])
+                    content_size = buffer.tell()
+                    
+                    if self.verbose:
+                        self._log(f"    [DEBUG] 已读取内容大小: {content_size} bytes")
+                        self._log(f"    [DEBUG] 图片格式检测: {image_format or '未知'}")
+                    
+                    if image_format == 'HTML':
+                        # 常见的错误响应：HTML页面而不是图片
+                        if self.verbose:
+                            self._log(f"    [DEBUG] ✗ 下载的内容是HTML页面而不是图片，已跳过: {url}")
+                        self.failed_urls.add(url)  # 记录失败的URL
+                        # 返回HTML通常是防盗链页面，计入主机失败
+                        self._record_host_result(url, False, reason='html')
+                        return False
+                    if image_format == 'WEBP':
+                        # 明确识别为WEBP，直接跳过，不保存
+                        if self.verbose:
+                            self._log(f"    [DEBUG] 检测到WEBP图片(内容特征)，已跳过该图片: {url}")
+                        self.failed_urls.add(url)  # 记录失败的URL
+                        return False
+                    if image_format is None:
+                        if self.verbose:
+                            self._log(f"    [DEBUG] ✗ 内容不是有效的图片格式（不是JPEG/PNG/GIF）")
+                        self.failed_urls.add(url)  # 记录失败的URL
+                    elif content_size > self.max_image_bytes:
                         if self.verbose:
-                            print(f"    [DEBUG] 图片格式检测: {image_format}")
-                        
+                            self._log(f"    [DEBUG] ✗ 图片过大 (超过 {self.max_image_bytes} bytes)，已放弃下载: {url}")
+                        self.failed_urls.add(url)  # 记录失败的URL
+                        return False
+                    elif content_size <= 1000:  # 至少1KB
+                        if self.verbose:
+                            self._log(f"    [DEBUG] ✗ 内容太小 ({content_size} bytes < 1KB)")
+                        self.failed_urls.add(url)  # 记录失败的URL
+                    else:
                         # 只保存确认是图片格式的文件
-                        if is_image:
+                        if cancel_event is not None and cancel_event.is_set():
+                            return False
+                        if self.image_store is not None:
+                            ext = {'JPEG': '.jpg', 'PNG': '.png', 'GIF': '.gif'}[image_format]
+                            _, image = self.image_store.put(buffer.getvalue(), ext, url=url)
+                        elif save_path:
                             with open(save_path, 'wb') as f:
-                                f.write(content)
-                            if self.verbose:
-                                print(f"    [DEBUG] ✓ 图片下载成功: {save_path} ({content_size} bytes, {image_format})")
-                            return True
+                                f.write(buffer.getbuffer())
+                            image = save_path
                         else:
-                            if self.verbose:
-                                print(f"    [DEBUG] ✗ 内容不是有效的图片格式（不是JPEG/PNG/GIF）")
-                            self.failed_urls.add(url)  # 记录失败的URL
-                    else:
+                            # 不写临时文件，直接以内存缓冲交给add_picture（各任务互不干扰）
+                            buffer.seek(0)
+                            image = buffer
                         if self.verbose:
-                            print(f"    [DEBUG] ✗ 内容太小 ({content_size} bytes < 1KB)")
-                        self.failed_urls.add(url)  # 记录失败的URL
+                            location = image if isinstance(image, str) else "内存"
+                            self._log(f"    [DEBUG] ✓ 图片下载成功: {location} ({content_size} bytes, {image_format})")
+                        self._record_host_result(url, True, latency=time.time() - start_time)
+                        self.emit_event('image_fetched', url=url, size=content_size,
+                                        elapsed=time.time() - start_time)
+                        return image
                 else:
                     if self.verbose:
-                        print(f"    [DEBUG] ✗ HTTP错误: {response.status_code}")
+                        self._log(f"    [DEBUG] ✗ HTTP错误: {response.status_code}")
                     self.failed_urls.add(url)  # 记录失败的URL
+                    if response.status_code in (401, 403, 429):
+                        # 拒绝访问或限流，重试没有意义
+                        self._record_host_result(url, False, reason=f'http_{response.status_code}')
+                        break
+                    if response.status_code in self.HOST_FAILURE_STATUSES and attempt == retry_count - 1:
+                        # 5xx会重试，只在最后一次仍失败时计入一次主机失败，
+                        # 避免单个有问题的URL一次下载就累计到熔断阈值、连带整个主机被跳过
+                        self._record_host_result(url, False, reason=f'http_{response.status_code}')
                 
             except requests.exceptions.Timeout as e:
                 if self.verbose:
-                    print(f"    [DEBUG] 超时异常: {str(e)}")
-                    print(f"    [DEBUG] 立即放弃该图片URL，不再重试: {url}")
+                    self._log(f"    [DEBUG] 超时异常: {str(e)}")
+                    self._log(f"    [DEBUG] 立即放弃该图片URL，不再重试: {url}")
                 self.failed_urls.add(url)  # 记录失败的URL
+                self._record_host_result(url, False, reason='timeout')
                 # 直接放弃该URL，由上层逻辑尝试其他图片或重新搜索
                 break
             except requests.exceptions.ConnectionError as e:
                 if self.verbose:
-                    print(f"    [DEBUG] 连接异常: {type(e).__name__}: {str(e)[:100]}")
-                    print(f"    [DEBUG] 立即放弃该图片URL，不再重试: {url}")
+                    self._log(f"    [DEBUG] 连接异常: {type(e).__name__}: {str(e)[:100]}")
+                    self._log(f"    [DEBUG] 立即放弃该图片URL，不再重试: {url}")
                 self.failed_urls.add(url)  # 记录失败的URL
+                self._record_host_result(url, False, reason='connection')
                 # 直接放弃该URL，由上层逻辑尝试其他图片或重新搜索
                 break
             except Exception as e:
                 if self.verbose:
-                    print(f"    [DEBUG] 其他异常: {type(e).__name__}: {str(e)[:100]}")
+                    self._log(f"    [DEBUG] 其他异常: {type(e).__name__}: {str(e)[:100]}")
                 if attempt < retry_count - 1:
                     wait_time = 2 * (attempt + 1)
                     if self.verbose:
-                        print(f"    [DEBUG] 等待 {wait_time} 秒后重试 ({attempt + 1}/{retry_count})...")
+                        self._log(f"    [DEBUG] 等待 {wait_time} 秒后重试 ({attempt + 1}/{retry_count})...")
                     time.sleep(wait_time)
                     continue
                 else:
                     if self.verbose:
-                        print(f"    [DEBUG] ✗ 下载失败（异常，已重试{retry_count}次）")
-                    self.failed_urls.add(url)  # 记录失败的URL
-        
-        if self.verbose:
-            print(f"    [DEBUG] ✗ 所有重试均失败")
-        self.failed_urls.add(url)  # 记录失败的URL
-        return False
+                        self._log(f"    [DEBUG] ✗ 下载失败（异常，已重试{retry_count}次）")
+                    self.failed_urls.add(url)  # 记录失败的URL
+            finally:
+                # 流式响应必须关闭，连接才会回到连接池（或在未读完时被丢弃）
+                if response is not None:
+                    response.close()
+        
+        if self.verbose:
+            self._log(f"    [DEBUG] ✗ 所有重试均失败")
+        self.failed_urls.add(url)  # 记录失败的URL
+        return False
+    
+    def download_images_hedged(self, urls, need=2, slide=None):
+        """
+        对冲下载：同时下载多个候选URL，保留最先通过格式校验的need张，取消其余下载
+        
+        单个慢速主机不会再拖住整页（原来逐个下载时每个URL最多等待30秒）。
+        
+        Args:
+            urls: 候选图片URL列表（按搜索结果排序）
+            need: 需要的图片数量
+            slide: 所属页码（从1开始，只用于image_downloaded事件）
+            
+        Returns:
+            下载成功的图片列表（路径或BytesIO，按完成先后排序，最多need个）
+        """
+        if not urls:
+            return []
+        
+        if self.verbose:
+            self._log(f"    [DEBUG] 对冲下载: 同时下载 {len(urls)} 个候选，取最先成功的 {need} 张")
+        
+        cancel_event = threading.Event()
+        started = time.time()
+        executor = ThreadPoolExecutor(max_workers=len(urls), thread_name_prefix="hedged-download")
+        futures = {
+            executor.submit(self.download_image, url, None, 1, cancel_event): url
+            for url in urls
+        }
+        downloaded = []
+        try:
+            for future in as_completed(futures):
+                try:
+                    path = future.result()
+                except Exception as e:
+                    if self.verbose:
+                        self._log(f"    [DEBUG] 对冲下载任务异常: {type(e).__name__}: {str(e)[:100]}")
+                    path = False
+                if path:
+                    downloaded.append(path)
+                    self.emit_event('image_downloaded', slide=slide, url=futures[future], path=path,
+                                    size=self._image_size_bytes(path), elapsed=time.time() - started)
+                    if len(downloaded) >= need:
+                        break
+        finally:
+            # 通知仍在进行的下载立即放弃，并取消尚未开始的任务
+            cancel_event.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+        
+        return downloaded
     
     def extract_text_from_slide(self, slide):
         """
@@ -918,9 +2012,10 @@ class PPTImageEnhancer:
             文本列表
         """
         texts = []
-        for shape in slide.shapes:
-            if hasattr(shape, "text") and shape.text.strip():
-                texts.append(shape.text.strip())
+        with self.timings.span('extract'):
+            for shape in slide.shapes:
+                if hasattr(shape, "text") and shape.text.strip():
+                    texts.append(shape.text.strip())
         return texts
     
     def print_progress(self, current, total):
@@ -964,7 +2059,11 @@ class PPTImageEnhancer:
         progress_text = f"[{bar}] {percent:3d}%  ({current}/{total} pages)"
         
         # 打印一行进度信息（不使用回车覆盖，避免与详细日志冲突）
-        print(f"{color}{progress_text}{RESET}")
+        if self.log_to_stdout:
+            print(f"{color}{progress_text}{RESET}")
+        # 监听者收到不带颜色代码的进度文本
+        if self._event_listeners:
+            self.emit_event('log', message=progress_text)
     
     def get_next_template_id(self):
         """
@@ -988,33 +2087,42 @@ class PPTImageEnhancer:
         self.last_template_id = template_id
         return template_id
     
+    def image_available(self, image):
+        """
+        判断图片是否可用于排版
+        
+        Args:
+            image: 图片文件路径，或内存中的图片（BytesIO等file-like对象）
+        """
+        if hasattr(image, 'read'):
+            return True
+        return isinstance(image, str) and os.path.exists(image)
+    
     def convert_image_format(self, image_path):
         """
         将图片转换为PowerPoint支持的格式（PNG或JPEG）
         
         Args:
-            image_path: 原始图片路径
+            image_path: 原始图片路径，或内存中的图片（BytesIO等file-like对象）
             
         Returns:
-            转换后的图片路径（如果不需要转换则返回原路径）
+            转换后的图片路径或BytesIO（如果不需要转换则原样返回），内存图片无效时返回None
         """
+        # 内存中的图片：在内存中校验和转换，不经过磁盘
+        if hasattr(image_path, 'read'):
+            return self._convert_image_buffer(image_path)
+        
         # 首先检查文件是否存在
         if not os.path.exists(image_path):
             if self.verbose:
-                print(f"    [DEBUG] 图片文件不存在: {image_path}")
-            return image_path
-        
-        # 检查是否是文件路径（不是BytesIO或其他对象）
-        if not isinstance(image_path, str):
-            if self.verbose:
-                print(f"    [DEBUG] 图片路径不是字符串类型: {type(image_path)}")
+                self._log(f"    [DEBUG] 图片文件不存在: {image_path}")
             return image_path
         
         if not PIL_AVAILABLE:
             # 如果没有PIL，无法安全转换WEBP等格式，直接返回原路径
             # 后续在 add_picture_safe 中会捕获不支持的格式错误，避免程序崩溃
             if self.verbose:
-                print(f"    [DEBUG] Pillow未安装，无法转换图片格式: {image_path}")
+                self._log(f"    [DEBUG] Pillow未安装，无法转换图片格式: {image_path}")
             return image_path
         
         try:
@@ -1033,15 +2141,15 @@ class PPTImageEnhancer:
                     test_img.close()
                 except Exception as e:
                     if self.verbose:
-                        print(f"    [DEBUG] 文件扩展名是图片格式，但文件内容无效: {e}")
-                        print(f"    [DEBUG] 错误类型: {type(e).__name__}")
+                        self._log(f"    [DEBUG] 文件扩展名是图片格式，但文件内容无效: {e}")
+                        self._log(f"    [DEBUG] 错误类型: {type(e).__name__}")
                     # 如果验证失败，返回None而不是原路径，避免后续处理失败
                     return None
                 return image_path
             
             # 需要转换格式
             if self.verbose:
-                print(f"    [DEBUG] 转换图片格式: {ext} -> PNG")
+                self._log(f"    [DEBUG] 转换图片格式: {ext} -> PNG")
             
             # 打开图片（这里会验证文件是否是有效的图片）
             # 确保 image_path 是字符串路径，不是 BytesIO 对象
@@ -1069,34 +2177,148 @@ class PPTImageEnhancer:
             img.save(new_path, 'PNG', quality=95)
             
             if self.verbose:
-                print(f"    [DEBUG] 图片已转换: {new_path}")
+                self._log(f"    [DEBUG] 图片已转换: {new_path}")
             
             return new_path
             
         except Exception as e:
             if self.verbose:
-                print(f"    [DEBUG] 图片格式转换失败: {e}")
-                print(f"    [DEBUG] 错误类型: {type(e).__name__}")
-                print(f"    [DEBUG] 图片路径类型: {type(image_path).__name__}")
+                self._log(f"    [DEBUG] 图片格式转换失败: {e}")
+                self._log(f"    [DEBUG] 错误类型: {type(e).__name__}")
+                self._log(f"    [DEBUG] 图片路径类型: {type(image_path).__name__}")
                 if isinstance(image_path, str):
-                    print(f"    [DEBUG] 图片路径: {image_path}")
-                    print(f"    [DEBUG] 文件是否存在: {os.path.exists(image_path) if image_path else False}")
+                    self._log(f"    [DEBUG] 图片路径: {image_path}")
+                    self._log(f"    [DEBUG] 文件是否存在: {os.path.exists(image_path) if image_path else False}")
             # 转换失败，返回原路径（可能会失败，但至少尝试一下）
             # 但如果原路径也不是字符串，返回None让上层处理
             if isinstance(image_path, str):
                 return image_path
             else:
                 if self.verbose:
-                    print(f"    [DEBUG] 图片路径不是字符串，无法返回: {type(image_path)}")
+                    self._log(f"    [DEBUG] 图片路径不是字符串，无法返回: {type(image_path)}")
                 return None
     
+    def _convert_image_buffer(self, buffer):
+        """
+        校验内存中的图片，必要时在内存中转换为PNG
+        
+        Args:
+            buffer: 图片数据（BytesIO等file-like对象）
+            
+        Returns:
+            可直接交给add_picture的file-like对象，无效图片返回None
+        """
+        if not PIL_AVAILABLE:
+            # 没有PIL时无法校验，交给 add_picture_safe 捕获不支持的格式
+            return buffer
+        
+        try:
+            buffer.seek(0)
+            img = Image.open(buffer)
+            image_format = img.format
+            img.verify()
+            if image_format in ('JPEG', 'PNG', 'GIF', 'BMP', 'TIFF'):
+                return buffer
+            
+            # 需要转换格式（verify之后需要重新打开）
+            if self.verbose:
+                self._log(f"    [DEBUG] 转换图片格式: {image_format} -> PNG")
+            buffer.seek(0)
+            img = Image.open(buffer)
+            if img.mode == 'RGBA':
+                background = Image.new('RGB', img.size, (255, 255, 255))
+                background.paste(img, mask=img.split()[3])  # 使用alpha通道作为mask
+                img = background
+            elif img.mode not in ['RGB', 'L']:
+                img = img.convert('RGB')
+            converted = io.BytesIO()
+            img.save(converted, 'PNG')
+            converted.seek(0)
+            return converted
+        except Exception as e:
+            if self.verbose:
+                self._log(f"    [DEBUG] 内存图片无效或转换失败: {type(e).__name__}: {e}")
+            return None
+        finally:
+            buffer.seek(0)
+    
+    def _image_size_bytes(self, image):
+        """图片数据的字节数（路径或BytesIO）"""
+        if hasattr(image, 'getbuffer'):
+            return image.getbuffer().nbytes
+        return os.path.getsize(image)
+    
+    def _fit_image_to_box(self, image, max_width, max_height):
+        """
+        按图片在框中实际显示的尺寸重新采样，并重新编码（不保留EXIF等元数据）
+        
+        原图比显示所需的像素多时才处理；结果不比原图小时仍使用原图。
+        
+        Args:
+            image: 图片路径或BytesIO
+            max_width, max_height: 框的宽度和高度（EMU）
+            
+        Returns:
+            缩小后的BytesIO，不需要处理时原样返回
+        """
+        if self.image_target_dpi <= 0 or not PIL_AVAILABLE:
+            return image
+        
+        try:
+            original_size = self._image_size_bytes(image)
+            if hasattr(image, 'seek'):
+                image.seek(0)
+            img = Image.open(image)
+            width, height = img.size
+            # 图片等比放入框中后的显示尺寸（英寸）× DPI = 实际需要的像素数
+            display_scale = min(max_width / width, max_height / height) / Inches(1)
+            target_w = max(1, int(round(width * display_scale * self.image_target_dpi)))
+            target_h = max(1, int(round(height * display_scale * self.image_target_dpi)))
+            if target_w >= width or target_h >= height or img.format == 'GIF':
+                # 已经足够小，或是GIF（缩放会丢失动画）
+                self.image_bytes_original += original_size
+                self.image_bytes_embedded += original_size
+                return image
+            
+            has_alpha = img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info)
+            if has_alpha:
+                img = img.convert('RGBA')
+            elif img.mode not in ('RGB', 'L'):
+                img = img.convert('RGB')
+            img = img.resize((target_w, target_h), Image.LANCZOS)
+            
+            resized = io.BytesIO()
+            if has_alpha:
+                # 保留透明度
+                img.save(resized, 'PNG', optimize=True)
+            else:
+                img.save(resized, 'JPEG', quality=self.image_jpeg_quality, optimize=True)
+            
+            self.image_bytes_original += original_size
+            if resized.tell() >= original_size:
+                self.image_bytes_embedded += original_size
+                return image
+            self.image_bytes_embedded += resized.tell()
+            if self.verbose:
+                self._log(f"    [DEBUG] 图片已按显示尺寸缩小: {width}x{height} → {target_w}x{target_h}，"
+                          f"{original_size // 1024}KB → {resized.tell() // 1024}KB")
+            resized.seek(0)
+            return resized
+        except Exception as e:
+            if self.verbose:
+                self._log(f"    [DEBUG] 图片缩小失败，使用原图: {type(e).__name__}: {e}")
+            return image
+        finally:
+            if hasattr(image, 'seek'):
+                image.seek(0)
+    
     def add_picture_safe(self, slide, image_path, x, y, max_width, max_height):
         """
         安全地添加图片到幻灯片，并在给定"框"中自适应缩放，保证不拉伸变形
         
         Args:
             slide: 幻灯片对象
-            image_path: 图片路径
+            image_path: 图片路径，或内存中的图片（BytesIO等file-like对象）
             x, y: 框的左上角位置
             max_width, max_height: 框的最大宽度和高度（图片在其中等比缩放、居中）
             
@@ -1104,34 +2326,29 @@ class PPTImageEnhancer:
             添加的图片形状对象（或None，如果格式不支持）
         """
         # 首先验证输入
-        if not isinstance(image_path, str):
-            if self.verbose:
-                print(f"    [DEBUG] 图片路径不是字符串类型: {type(image_path)}")
-            return None
-        
-        if not os.path.exists(image_path):
+        if not self.image_available(image_path):
             if self.verbose:
-                print(f"    [DEBUG] 图片文件不存在: {image_path}")
+                self._log(f"    [DEBUG] 图片文件不存在或类型无效: {image_path}")
             return None
         
         # 转换图片格式
-        converted_path = self.convert_image_format(image_path)
+        with self.timings.span('convert'):
+            converted_path = self.convert_image_format(image_path)
         
         # 再次验证转换后的路径
         if converted_path is None:
             if self.verbose:
-                print(f"    [DEBUG] 图片格式转换返回None，已跳过: {image_path}")
+                self._log(f"    [DEBUG] 图片格式转换返回None，已跳过: {image_path}")
             return None
         
-        if not isinstance(converted_path, str):
+        if not self.image_available(converted_path):
             if self.verbose:
-                print(f"    [DEBUG] 转换后的图片路径不是字符串类型: {type(converted_path)}")
+                self._log(f"    [DEBUG] 转换后的图片文件不存在: {converted_path}")
             return None
         
-        if not os.path.exists(converted_path):
-            if self.verbose:
-                print(f"    [DEBUG] 转换后的图片文件不存在: {converted_path}")
-            return None
+        # 按框的实际显示尺寸缩小图片，避免把原始大图整张嵌入PPT
+        with self.timings.span('resize'):
+            converted_path = self._fit_image_to_box(converted_path, max_width, max_height)
         
         # 先以原始大小插入，再根据max_width/max_height做等比缩放和居中
         try:
@@ -1140,18 +2357,18 @@ class PPTImageEnhancer:
             msg = str(e)
             if "WEBP" in msg.upper():
                 if self.verbose:
-                    print(f"    [DEBUG] PowerPoint不支持WEBP图片，已跳过该图片: {converted_path}")
-                    print("           如需使用WEBP图片，请安装 Pillow库 并重新运行：pip install Pillow")
+                    self._log(f"    [DEBUG] PowerPoint不支持WEBP图片，已跳过该图片: {converted_path}")
+                    self._log("           如需使用WEBP图片，请安装 Pillow库 并重新运行：pip install Pillow")
                 return None
             elif "cannot identify image file" in msg.lower() or "not a valid" in msg.lower() or "bytesio" in msg.lower():
                 if self.verbose:
-                    print(f"    [DEBUG] 无法识别图片文件（可能是无效的图片或HTML页面），已跳过: {converted_path}")
-                    print(f"    [DEBUG] 错误详情: {msg}")
+                    self._log(f"    [DEBUG] 无法识别图片文件（可能是无效的图片或HTML页面），已跳过: {converted_path}")
+                    self._log(f"    [DEBUG] 错误详情: {msg}")
                 return None
             # 其他错误继续抛出，便于排查
             if self.verbose:
-                print(f"    [DEBUG] 添加图片时发生错误: {msg}")
-                print(f"    [DEBUG] 错误类型: {type(e).__name__}")
+                self._log(f"    [DEBUG] 添加图片时发生错误: {msg}")
+                self._log(f"    [DEBUG] 错误类型: {type(e).__name__}")
             raise
         
         # 当前尺寸
@@ -1232,10 +2449,10 @@ class PPTImageEnhancer:
         slide_height = self.prs.slide_height
         combined_text = "\n".join(original_texts)
         
-        if len(image_paths) > 0 and os.path.exists(image_paths[0]):
+        if len(image_paths) > 0 and self.image_available(image_paths[0]):
             self.add_picture_safe(slide, image_paths[0], Inches(0), Inches(0), slide_width * 0.6, slide_height)
         
-        if len(image_paths) > 1 and os.path.exists(image_paths[1]):
+        if len(image_paths) > 1 and self.image_available(image_paths[1]):
             self.add_picture_safe(slide, image_paths[1], slide_width * 0.4, Inches(0), slide_width * 0.6, slide_height)
         
         # 文字框居中，降低透明度以提高可读性
@@ -1247,10 +2464,10 @@ class PPTImageEnhancer:
         slide_height = self.prs.slide_height
         combined_text = "\n".join(original_texts)
         
-        if len(image_paths) > 0 and os.path.exists(image_paths[0]):
+        if len(image_paths) > 0 and self.image_available(image_paths[0]):
             self.add_picture_safe(slide, image_paths[0], Inches(0), Inches(0), slide_width, slide_height * 0.55)
         
-        if len(image_paths) > 1 and os.path.exists(image_paths[1]):
+        if len(image_paths) > 1 and self.image_available(image_paths[1]):
             self.add_picture_safe(slide, image_paths[1], Inches(0), slide_height * 0.45, slide_width, slide_height * 0.55)
         
         # 文字框放在中间位置，降低透明度以提高可读性
@@ -1262,10 +2479,10 @@ class PPTImageEnhancer:
         slide_height = self.prs.slide_height
         combined_text = "\n".join(original_texts)
         
-        if len(image_paths) > 0 and os.path.exists(image_paths[0]):
+        if len(image_paths) > 0 and self.image_available(image_paths[0]):
             self.add_picture_safe(slide, image_paths[0], Inches(0), Inches(0), slide_width * 0.7, slide_height * 0.7)
         
-        if len(image_paths) > 1 and os.path.exists(image_paths[1]):
+        if len(image_paths) > 1 and self.image_available(image_paths[1]):
             self.add_picture_safe(slide, image_paths[1], slide_width * 0.3, slide_height * 0.3, slide_width * 0.7, slide_height * 0.7)
         
         # 文字框位置优化，降低透明度
@@ -1277,10 +2494,10 @@ class PPTImageEnhancer:
         slide_height = self.prs.slide_height
         combined_text = "\n".join(original_texts)
         
-        if len(image_paths) > 0 and os.path.exists(image_paths[0]):
+        if len(image_paths) > 0 and self.image_available(image_paths[0]):
             self.add_picture_safe(slide, image_paths[0], slide_width * 0.15, slide_height * 0.15, slide_width * 0.7, slide_height * 0.7)
         
-        if len(image_paths) > 1 and os.path.exists(image_paths[1]):
+        if len(image_paths) > 1 and self.image_available(image_paths[1]):
             self.add_picture_safe(slide, image_paths[1], slide_width * 0.7, slide_height * 0.05, slide_width * 0.25, slide_height * 0.25)
         
         self.add_text_box(slide, combined_text, slide_width * 0.2, slide_height * 0.75, slide_width * 0.6, slide_height * 0.2)
@@ -1291,10 +2508,10 @@ class PPTImageEnhancer:
         slide_height = self.prs.slide_height
         combined_text = "\n".join(original_texts)
         
-        if len(image_paths) > 0 and os.path.exists(image_paths[0]):
+        if len(image_paths) > 0 and self.image_available(image_paths[0]):
             self.add_picture_safe(slide, image_paths[0], Inches(0), Inches(0), slide_width * 0.5, slide_height * 0.5)
         
-        if len(image_paths) > 1 and os.path.exists(image_paths[1]):
+        if len(image_paths) > 1 and self.image_available(image_paths[1]):
             self.add_picture_safe(slide, image_paths[1], slide_width * 0.5, slide_height * 0.5, slide_width * 0.5, slide_height * 0.5)
         
         self.add_text_box(slide, combined_text, slide_width * 0.2, slide_height * 0.4, slide_width * 0.6, slide_height * 0.2)
@@ -1305,10 +2522,10 @@ class PPTImageEnhancer:
         slide_height = self.prs.slide_height
         combined_text = "\n".join(original_texts)
         
-        if len(image_paths) > 0 and os.path.exists(image_paths[0]):
+        if len(image_paths) > 0 and self.image_available(image_paths[0]):
             self.add_picture_safe(slide, image_paths[0], Inches(0), Inches(0), slide_width * 0.65, slide_height)
         
-        if len(image_paths) > 1 and os.path.exists(image_paths[1]):
+        if len(image_paths) > 1 and self.image_available(image_paths[1]):
             self.add_picture_safe(slide, image_paths[1], slide_width * 0.68, slide_height * 0.1, slide_width * 0.3, slide_height * 0.4)
         
         self.add_text_box(slide, combined_text, slide_width * 0.68, slide_height * 0.55, slide_width * 0.3, slide_height * 0.35)
@@ -1319,10 +2536,10 @@ class PPTImageEnhancer:
         slide_height = self.prs.slide_height
         combined_text = "\n".join(original_texts)
         
-        if len(image_paths) > 0 and os.path.exists(image_paths[0]):
+        if len(image_paths) > 0 and self.image_available(image_paths[0]):
             self.add_picture_safe(slide, image_paths[0], Inches(0), Inches(0), slide_width, slide_height * 0.65)
         
-        if len(image_paths) > 1 and os.path.exists(image_paths[1]):
+        if len(image_paths) > 1 and self.image_available(image_paths[1]):
             self.add_picture_safe(slide, image_paths[1], slide_width * 0.1, slide_height * 0.68, slide_width * 0.4, slide_height * 0.3)
         
         self.add_text_box(slide, combined_text, slide_width * 0.55, slide_height * 0.68, slide_width * 0.4, slide_height * 0.3)
@@ -1333,10 +2550,10 @@ class PPTImageEnhancer:
         slide_height = self.prs.slide_height
         combined_text = "\n".join(original_texts)
         
-        if len(image_paths) > 0 and os.path.exists(image_paths[0]):
+        if len(image_paths) > 0 and self.image_available(image_paths[0]):
             self.add_picture_safe(slide, image_paths[0], slide_width * 0.1, slide_height * 0.1, slide_width * 0.5, slide_height * 0.6)
         
-        if len(image_paths) > 1 and os.path.exists(image_paths[1]):
+        if len(image_paths) > 1 and self.image_available(image_paths[1]):
             self.add_picture_safe(slide, image_paths[1], slide_width * 0.4, slide_height * 0.3, slide_width * 0.5, slide_height * 0.6)
         
         self.add_text_box(slide, combined_text, slide_width * 0.15, slide_height * 0.72, slide_width * 0.7, slide_height * 0.25)
@@ -1347,10 +2564,10 @@ class PPTImageEnhancer:
         slide_height = self.prs.slide_height
         combined_text = "\n".join(original_texts)
         
-        if len(image_paths) > 0 and os.path.exists(image_paths[0]):
+        if len(image_paths) > 0 and self.image_available(image_paths[0]):
             self.add_picture_safe(slide, image_paths[0], Inches(0), Inches(0), slide_width, slide_height)
         
-        if len(image_paths) > 1 and os.path.exists(image_paths[1]):
+        if len(image_paths) > 1 and self.image_available(image_paths[1]):
             self.add_picture_safe(slide, image_paths[1], slide_width * 0.3, slide_height * 0.2, slide_width * 0.7, slide_height * 0.6)
             
         # 文字框放在底部，降低透明度以提高可读性
@@ -1362,10 +2579,10 @@ class PPTImageEnhancer:
         slide_height = self.prs.slide_height
         combined_text = "\n".join(original_texts)
         
-        if len(image_paths) > 0 and os.path.exists(image_paths[0]):
+        if len(image_paths) > 0 and self.image_available(image_paths[0]):
             self.add_picture_safe(slide, image_paths[0], slide_width * 0.05, slide_height * 0.05, slide_width * 0.45, slide_height * 0.45)
         
-        if len(image_paths) > 1 and os.path.exists(image_paths[1]):
+        if len(image_paths) > 1 and self.image_available(image_paths[1]):
             self.add_picture_safe(slide, image_paths[1], slide_width * 0.5, slide_height * 0.5, slide_width * 0.45, slide_height * 0.45)
         
         self.add_text_box(slide, combined_text, slide_width * 0.2, slide_height * 0.7, slide_width * 0.6, slide_height * 0.25)
@@ -1376,10 +2593,10 @@ class PPTImageEnhancer:
         slide_height = self.prs.slide_height
         combined_text = "\n".join(original_texts)
         
-        if len(image_paths) > 0 and os.path.exists(image_paths[0]):
+        if len(image_paths) > 0 and self.image_available(image_paths[0]):
             self.add_picture_safe(slide, image_paths[0], Inches(0), Inches(0), slide_width * 0.55, slide_height)
         
-        if len(image_paths) > 1 and os.path.exists(image_paths[1]):
+        if len(image_paths) > 1 and self.image_available(image_paths[1]):
             self.add_picture_safe(slide, image_paths[1], slide_width * 0.45, slide_height * 0.1, slide_width * 0.55, slide_height * 0.8)
         
         self.add_text_box(slide, combined_text, slide_width * 0.5, slide_height * 0.1, slide_width * 0.45, slide_height * 0.3)
@@ -1390,7 +2607,7 @@ class PPTImageEnhancer:
         slide_height = self.prs.slide_height
         combined_text = "\n".join(original_texts)
         
-        if len(image_paths) > 0 and os.path.exists(image_paths[0]):
+        if len(image_paths) > 0 and self.image_available(image_paths[0]):
             self.add_picture_safe(slide, image_paths[0], slide_width * 0.15, slide_height * 0.1, slide_width * 0.35, slide_height * 0.5)
             
             frame1 = slide.shapes.add_shape(1, slide_width * 0.15, slide_height * 0.1, slide_width * 0.35, slide_height * 0.5)
@@ -1400,7 +2617,7 @@ class PPTImageEnhancer:
             slide.shapes._spTree.remove(frame1._element)
             slide.shapes._spTree.insert(-1, frame1._element)
         
-        if len(image_paths) > 1 and os.path.exists(image_paths[1]):
+        if len(image_paths) > 1 and self.image_available(image_paths[1]):
             self.add_picture_safe(slide, image_paths[1], slide_width * 0.5, slide_height * 0.1, slide_width * 0.35, slide_height * 0.5)
             
             frame2 = slide.shapes.add_shape(1, slide_width * 0.5, slide_height * 0.1, slide_width * 0.35, slide_height * 0.5)
@@ -1442,7 +2659,7 @@ class PPTImageEnhancer:
             template_id = self.get_next_template_id()
         
         if self.verbose:
-            print(f"    [DEBUG] 使用模板 {template_id}/11")
+            self._log(f"    [DEBUG] 使用模板 {template_id}/11")
         
         # 根据模板ID应用不同的布局
         template_methods = [
@@ -1458,164 +2675,566 @@ class PPTImageEnhancer:
             # 如果模板ID无效，使用模板0
             self.apply_template_0(slide, image_paths, original_texts)
         
-    def process_slides(self):
+    @staticmethod
+    def _file_hash(path):
+        """文件内容的sha256（path也可以是文件对象，读取后回到开头）"""
+        import hashlib
+        digest = hashlib.sha256()
+        if not isinstance(path, str):
+            path.seek(0)
+            for chunk in iter(lambda: path.read(1024 * 1024), b''):
+                digest.update(chunk)
+            path.seek(0)
+            return digest.hexdigest()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+    
+    @staticmethod
+    def _slide_text_hash(texts):
+        """幻灯片文本的哈希（用于判断页面内容是否变化）"""
+        import hashlib
+        return hashlib.sha256("\n".join(texts).encode('utf-8')).hexdigest()[:32]
+    
+    def _load_checkpoints(self):
+        """处理开始前读取上次中断时留下的检查点"""
+        self._restored_slides = {}
+        if self.checkpoints is None or not self.resume:
+            return
+        self._restored_slides = self.checkpoints.load(self._deck_key)
+        if self._restored_slides:
+            self._log(f"[INFO] 找到上次中断时的检查点，{len(self._restored_slides)} 页将直接恢复，不再搜索和下载")
+    
+    def _restore_slide_job(self, job):
         """
-        处理所有幻灯片
+        复用之前的处理结果：先查本份PPT的检查点，再查增量处理清单（文本相同的页面），
+        取回仓库中的图片并记录模板ID，之后跳过搜索和下载
+        
+        页面文本与检查点不一致，或图片已被仓库淘汰时不复用，按正常流程处理。
+        
+        Returns:
+            是否已复用（job['restored']为 checkpoint 或 manifest）
         """
-        total_slides = len(self.prs.slides)
-        print(f"开始处理PPT: {self.ppt_path}")
-        print(f"共 {total_slides} 页幻灯片")
+        text_hash = self._slide_text_hash(job['texts'])
+        record, source = self._restored_slides.get(job['idx']), 'checkpoint'
+        if record is None or record['text_hash'] != text_hash:
+            record = self.slide_manifest.get(text_hash) if self.slide_manifest is not None else None
+            source = 'manifest'
+        if record is None:
+            return False
+        image_paths = [self.image_store.lookup_hash(sha256) for sha256, _ in record['images']]
+        if not image_paths or not all(image_paths):
+            return False
+        job['image_paths'] = image_paths
+        job['image_records'] = record['images']
+        job['template_id'] = record['template_id']
+        job['keywords'] = record['keywords']
+        job['restored'] = source
+        return True
+    
+    def _record_slide(self, job):
+        """
+        一页排版完成后写入检查点和增量处理清单（图片先存入图片仓库，只记录哈希）
+        
+        从检查点恢复的页面不再重复写入检查点。
+        """
+        images = job.get('image_records')
+        if images is None:
+            images = []
+            for image in job['image_paths']:
+                if hasattr(image, 'getvalue'):
+                    data = image.getvalue()
+                    ext = '.' + (self._sniff_image_format(data[:self.SNIFF_BYTES]) or 'jpg').lower()
+                else:
+                    with open(image, 'rb') as f:
+                        data = f.read()
+                    ext = os.path.splitext(image)[1] or '.jpg'
+                sha256, _ = self.image_store.put(data, ext)
+                images.append([sha256, ext])
+        text_hash = self._slide_text_hash(job['texts'])
+        keywords = job.get('keywords', [])
+        if self.checkpoints is not None and job.get('restored') != 'checkpoint':
+            self.checkpoints.save(self._deck_key, job['idx'], text_hash, self.last_template_id, keywords, images)
+        if self.slide_manifest is not None:
+            self.slide_manifest.put(text_hash, self.last_template_id, keywords, images)
+    
+    def _extract_slide_job(self, idx, slide):
+        """
+        流水线第一阶段：提取幻灯片文本，生成该页的处理任务
+        
+        Args:
+            idx: 幻灯片索引
+            slide: 幻灯片对象
+            
+        Returns:
+            任务字典（后续各阶段在其中写入搜索结果、图片路径和错误信息）
+        """
+        started = time.time()
+        self.emit_event('slide_started', slide=idx + 1, total=len(self.prs.slides))
+        texts = self.extract_text_from_slide(slide)
+        job = {
+            'idx': idx,
+            'slide': slide,
+            'texts': texts,
+            'search_keyword': " ".join(texts),  # 合并所有文本作为搜索关键词
+            'keywords': [],  # 实际搜索过的关键词（写入检查点）
+            'image_urls': [],
+            'image_paths': [],
+            'template_id': None,  # 复用之前的结果时使用记录的模板
+            'restored': None,  # 复用之前结果的来源：checkpoint / manifest
+            'error': None,
+            'started': started,
+        }
+        if texts and (self._restored_slides or self.slide_manifest is not None):
+            self._restore_slide_job(job)
+        return job
+    
+    def _search_slide_job(self, job):
+        """流水线第二阶段：为该页搜索候选图片"""
+        idx = job['idx']
+        self._log(f"  [第 {idx + 1} 页] 提取的文本: {', '.join(job['texts'])}")
+        self._log(f"  [第 {idx + 1} 页] 正在搜索图片...")
+        started = time.time()
+        job['keywords'].append(job['search_keyword'])
+        job['image_urls'] = self.search_images(job['search_keyword'], count=self._candidate_count())
+        self.emit_event('search_done', slide=idx + 1, keyword=job['search_keyword'],
+                        candidates=len(job['image_urls']), elapsed=time.time() - started)
+    
+    def _candidate_count(self):
+        """每次搜索需要的候选URL数量（对冲下载时需要更多候选）"""
+        return max(2, self.hedged_download_fanout)
+    
+    def _download_hedged_candidates(self, urls, image_paths, slide=None):
+        """
+        对冲下载模式下补足图片：过滤WEBP和已知失败的URL后，并发下载前K个候选
+        
+        Args:
+            urls: 候选URL列表
+            image_paths: 已下载的图片列表（原地追加）
+            slide: 所属页码（从1开始）
+        """
+        candidates = []
+        for url in urls:
+            if url.lower().endswith('.webp'):
+                self.failed_urls.add(url)  # 记录失败的URL
+                continue
+            if url in self.failed_urls:
+                continue
+            candidates.append(url)
+        if self.host_health is not None:
+            # 熔断中的主机不占用并发名额
+            states = self.host_health.get_states(self._url_host(url) for url in candidates)
+            candidates = [url for url in candidates
+                          if self.host_health.is_available(states.get(self._url_host(url)))]
+        candidates = candidates[:self.hedged_download_fanout]
+        
+        need = 2 - len(image_paths)
+        self._log(f"  对冲下载图片（{len(candidates)} 个候选，需要 {need} 张）...", end='', flush=True)
+        downloaded = self.download_images_hedged(candidates, need=need, slide=slide)
+        image_paths.extend(downloaded)
+        if downloaded:
+            self._log(f" ✓ 成功 {len(downloaded)} 张")
+        else:
+            self._log(f" ✗ 失败")
+    
+    def _download_sequential_candidates(self, urls, image_paths, retry=False, slide=None):
+        """
+        逐个下载候选图片，直到凑够2张
+        
+        Args:
+            urls: 候选URL列表
+            image_paths: 已下载的图片列表（原地追加）
+            retry: 是否为重新搜索后的下载（只影响日志）
+            slide: 所属页码（从1开始）
+        """
+        for i, url in enumerate(urls):
+            if retry and len(image_paths) >= 2:
+                break
+            label = f"重新下载图片 {len(image_paths)+1}/2..." if retry else f"下载图片 {i+1}/2..."
+            # 如果链接明显是WEBP，直接跳过，避免浪费请求
+            if url.lower().endswith('.webp'):
+                if not retry:
+                    self._log(f"  {label} ✗ 跳过WEBP链接: {url}")
+                elif self.verbose:
+                    self._log(f"  {label} ✗ 跳过WEBP链接: {url[:60]}...")
+                self.failed_urls.add(url)  # 记录失败的URL
+                continue
+            # 如果URL已经在失败列表中，直接跳过
+            if url in self.failed_urls:
+                if self.verbose:
+                    self._log(f"  {label} ✗ 跳过已知失败的URL: {url[:60]}...")
+                continue
+            self._log(f"  {label}", end='', flush=True)
+            started = time.time()
+            downloaded_path = self.download_image(url)
+            if downloaded_path:
+                image_paths.append(downloaded_path)
+                self.emit_event('image_downloaded', slide=slide, url=url, path=downloaded_path,
+                                size=self._image_size_bytes(downloaded_path), elapsed=time.time() - started)
+                self._log(f" ✓ 成功")
+            else:
+                self._log(f" ✗ 失败")
+    
+    def _download_candidates(self, urls, image_paths, retry=False, slide=None):
+        """按配置选择对冲下载或逐个下载"""
+        if self.hedged_download_fanout > 2:
+            self._download_hedged_candidates(urls, image_paths, slide=slide)
+        else:
+            self._download_sequential_candidates(urls, image_paths, retry=retry, slide=slide)
+    
+    def _download_slide_job(self, job):
+        """
+        流水线第三阶段：下载并校验图片，不足2张时重新搜索补足
+        
+        Args:
+            job: 任务字典
+        """
+        idx = job['idx']
+        texts = job['texts']
+        search_keyword = job['search_keyword']
+        image_paths = job['image_paths']
+        
+        # 下载图片（跳过WEBP链接和已知失败的URL）
+        self._download_candidates(job['image_urls'], image_paths, slide=idx + 1)
+        
+        # 强制要求必须有2张图片，如果不够则反复搜索直到找到2张
+        max_retries = 3  # 最多重试3次（减少重试次数，避免超时）
+        retry_count = 0
+        
+        while len(image_paths) < 2 and retry_count < max_retries:
+            if retry_count == 0 and not image_paths:
+                self._log(f"  ✗ 本轮图片下载失败，尝试使用首行文本重新搜索...")
+            elif len(image_paths) < 2:
+                self._log(f"  ✗ 图片数量不足({len(image_paths)}/2)，继续搜索...")
+            
+            # 使用第一行文本作为更精简的关键词，或者用AI优化关键词
+            retry_keyword = texts[0] if texts else search_keyword
+        
+            # 如果配置了AI，尝试用AI优化关键词（使用缓存，避免重复调用）
+            # 只在第一次重试时尝试AI优化，避免API配额问题导致超时
+            if (self.google_ai_api_key or self.ollama_base_url or self.spark_api_key) and retry_count == 1:
+                if self.verbose:
+                    self._log(f"    [DEBUG] 使用AI优化关键词（第{retry_count+1}次重试，使用缓存）")
+                # 使用缓存的优化方法，如果之前已经优化过，会直接返回缓存结果
+                optimized = self.optimize_search_keyword_cached(retry_keyword)
+                if optimized:
+                    retry_keyword = optimized
+                    if self.verbose:
+                        self._log(f"    [DEBUG] AI优化后的关键词: {optimized}")
+            
+            # 重新搜索（search_images内部仍然优先用Google API和Google爬虫）
+            job['keywords'].append(retry_keyword)
+            retry_urls = self.search_images(retry_keyword, count=self._candidate_count())
+            
+            # 再尝试下载（跳过已知失败的URL）
+            self._download_candidates(retry_urls, image_paths, retry=True, slide=idx + 1)
+            
+            retry_count += 1
+        
+        # 必须使用2张图片，如果只有1张则重复使用
+        if image_paths:
+            while len(image_paths) < 2:
+                # 直接重复引用同一张图片（PPT中相同图片只会保存一份）
+                image_paths.append(image_paths[0])
+                if self.verbose:
+                    self._log(f"    [DEBUG] 图片不足2张，重复使用图片以补足: {image_paths[0]}")
+            del image_paths[2:]
+        job['max_retries'] = max_retries
+    
+    def _layout_slide_job(self, job):
+        """
+        流水线最后阶段：把图片排版到幻灯片上
         
-        # 创建临时图片目录
-        temp_dir = "temp_images"
-        os.makedirs(temp_dir, exist_ok=True)
+        只能在持有Presentation的线程中调用（python-pptx对象不是线程安全的）
+        """
+        idx = job['idx']
+        image_paths = job['image_paths']
+        if image_paths:
+            self._log(f"  正在添加图片到幻灯片...")
+            template_id = job.get('template_id')
+            if job.get('restored') == 'manifest' and template_id == self.last_template_id:
+                # 增量复用的模板与上一页相同时重新选择，保证相邻页面不同；
+                # 从检查点恢复的页面照原样使用记录的模板，与中断前的排版一致
+                template_id = None
+            with self.timings.span('layout'):
+                self.add_creative_layout(job['slide'], image_paths, job['texts'], template_id=template_id)
+            if template_id is not None:
+                self.last_template_id = template_id
+            self._log(f"  ✓ 第 {idx + 1} 页处理完成（模板ID: {self.last_template_id}，图片数: {len(image_paths)})")
+        else:
+            self._log(f"  ✗ 第 {idx + 1} 页经过{job.get('max_retries', 3)}次搜索仍无法获得图片")
+            self._log(f"  ✗ 第 {idx + 1} 页所有搜索方案均失败，保留原始文字布局（不使用随机图片）")
+    
+    def _report_slide_error(self, idx, error):
+        """单个页面处理失败，记录错误但继续处理其他页面"""
+        error_msg = str(error)
+        if self.verbose:
+            self._log(f"  ✗ 第 {idx + 1} 页处理失败: {error_msg}")
+            trace = getattr(error, '_pipeline_trace', None)
+            if trace is None:
+                import traceback
+                trace = traceback.format_exc()
+            self._log(f"  [DEBUG] 错误详情: {trace}")
+        else:
+            self._log(f"  ✗ 第 {idx + 1} 页处理失败，跳过")
+    
+    def _finish_slide(self, idx, total_slides, job=None, error=None):
+        """
+        一页处理结束：打印整体进度并发出slide_done事件
         
+        Args:
+            idx: 幻灯片索引
+            total_slides: 总页数
+            job: 该页的任务字典（文本提取失败时为None）
+            error: 该页处理失败时的异常
+        """
+        self.print_progress(idx + 1, total_slides)
+        if ((self.checkpoints is not None or self.slide_manifest is not None)
+                and error is None and job is not None and job['image_paths']):
+            try:
+                self._record_slide(job)
+            except Exception as e:
+                if self.verbose:
+                    self._log(f"  [DEBUG] 检查点写入失败: {type(e).__name__}: {e}")
+        started = job.get('started') if job else None
+        if started:
+            self.timings.add('slide', time.time() - started)
+        if not self._event_listeners:
+            return
+        if error is not None:
+            status = 'failed'
+        elif job is None or not job['texts']:
+            status = 'no_text'
+        elif not job['image_paths']:
+            status = 'no_images'
+        else:
+            status = 'done'
+        self.emit_event('slide_done', slide=idx + 1, total=total_slides, completed=idx + 1, status=status,
+                        images=len(job['image_paths']) if job else 0,
+                        template_id=self.last_template_id if status == 'done' else None,
+                        error=str(error) if error is not None else None,
+                        elapsed=time.time() - started if started else None)
+    
+    def _process_slides_sequential(self):
+        """逐页处理：提取 → 搜索 → 下载 → 排版，一页完成后再处理下一页"""
+        total_slides = len(self.prs.slides)
         for idx, slide in enumerate(self.prs.slides):
+            job = None
             try:
-                print(f"\n处理第 {idx + 1} 页...")
+                self._log(f"\n处理第 {idx + 1} 页...")
                 
-                # 提取文本
-                texts = self.extract_text_from_slide(slide)
-                if not texts:
-                    print(f"  第 {idx + 1} 页没有找到文本，跳过")
-                    self.print_progress(idx + 1, total_slides)
+                job = self._extract_slide_job(idx, slide)
+                if not job['texts']:
+                    self._log(f"  第 {idx + 1} 页没有找到文本，跳过")
+                    self._finish_slide(idx, total_slides, job)
                     continue
                 
-                print(f"  提取的文本: {', '.join(texts)}")
-                
-                # 合并所有文本作为搜索关键词
-                search_keyword = " ".join(texts)
-                
-                # 搜索图片
-                print(f"  正在搜索图片...")
-                image_urls = self.search_images(search_keyword, count=2)
-                
-                # 下载图片（跳过WEBP链接和已知失败的URL）
-                image_paths = []
-                for i, url in enumerate(image_urls):
-                    image_path = os.path.join(temp_dir, f"slide_{idx}_img_{i}.jpg")
-                    # 如果链接明显是WEBP，直接跳过，避免浪费请求
-                    if url.lower().endswith('.webp'):
-                        print(f"  下载图片 {i+1}/2... ✗ 跳过WEBP链接: {url}")
-                        self.failed_urls.add(url)  # 记录失败的URL
-                        continue
-                    # 如果URL已经在失败列表中，直接跳过
-                    if url in self.failed_urls:
-                        if self.verbose:
-                            print(f"  下载图片 {i+1}/2... ✗ 跳过已知失败的URL: {url[:60]}...")
-                        continue
-                    print(f"  下载图片 {i+1}/2...", end='', flush=True)
-                    if self.download_image(url, image_path):
-                        image_paths.append(image_path)
-                        print(f" ✓ 成功")
-                    else:
-                        print(f" ✗ 失败")
-                
-                # 强制要求必须有2张图片，如果不够则反复搜索直到找到2张
-                max_retries = 3  # 最多重试3次（减少重试次数，避免超时）
-                retry_count = 0
-                
-                while len(image_paths) < 2 and retry_count < max_retries:
-                    if retry_count == 0 and not image_paths:
-                        print(f"  ✗ 本轮图片下载失败，尝试使用首行文本重新搜索...")
-                    elif len(image_paths) < 2:
-                        print(f"  ✗ 图片数量不足({len(image_paths)}/2)，继续搜索...")
-                    
-                    # 使用第一行文本作为更精简的关键词，或者用AI优化关键词
-                    retry_keyword = texts[0] if texts else search_keyword
-                
-                    # 如果配置了AI，尝试用AI优化关键词（使用缓存，避免重复调用）
-                    # 只在第一次重试时尝试AI优化，避免API配额问题导致超时
-                    if (self.google_ai_api_key or self.ollama_base_url or self.spark_api_key) and retry_count == 1:
-                        if self.verbose:
-                            print(f"    [DEBUG] 使用AI优化关键词（第{retry_count+1}次重试，使用缓存）")
-                        # 使用缓存的优化方法，如果之前已经优化过，会直接返回缓存结果
-                        optimized = self.optimize_search_keyword_cached(retry_keyword)
-                        if optimized:
-                            retry_keyword = optimized
-                            if self.verbose:
-                                print(f"    [DEBUG] AI优化后的关键词: {optimized}")
-                    
-                    # 重新搜索（search_images内部仍然优先用Google API和Google爬虫）
-                    retry_urls = self.search_images(retry_keyword, count=2)
-                    
-                    # 再尝试下载（跳过已知失败的URL）
-                    for i, url in enumerate(retry_urls):
-                        if len(image_paths) >= 2:
-                            break
-                        image_path = os.path.join(temp_dir, f"slide_{idx}_retry{retry_count}_img_{i}.jpg")
-                        # 如果链接明显是WEBP，直接跳过
-                        if url.lower().endswith('.webp'):
-                            if self.verbose:
-                                print(f"  重新下载图片 {len(image_paths)+1}/2... ✗ 跳过WEBP链接: {url[:60]}...")
-                            self.failed_urls.add(url)  # 记录失败的URL
-                            continue
-                        # 如果URL已经在失败列表中，直接跳过
-                        if url in self.failed_urls:
-                            if self.verbose:
-                                print(f"  重新下载图片 {len(image_paths)+1}/2... ✗ 跳过已知失败的URL: {url[:60]}...")
-                            continue
-                        print(f"  重新下载图片 {len(image_paths)+1}/2...", end='', flush=True)
-                        if self.download_image(url, image_path):
-                            image_paths.append(image_path)
-                            print(f" ✓ 成功")
-                        else:
-                            print(f" ✗ 失败")
-                    
-                    retry_count += 1
-                
-                # 如果图片下载成功，添加到幻灯片（必须使用2张，如果只有1张则重复使用）
-                if image_paths:
-                    # 确保有2张图片（如果只有1张，复制一份）
-                    while len(image_paths) < 2:
-                        import shutil
-                        single_img = image_paths[0]
-                        dup_path = single_img.replace('.jpg', '_dup.jpg')
-                        shutil.copy2(single_img, dup_path)
-                        image_paths.append(dup_path)
-                        if self.verbose:
-                            print(f"    [DEBUG] 图片不足2张，复制图片以补足: {dup_path}")
-                    
-                    image_paths = image_paths[:2]
-                    print(f"  正在添加图片到幻灯片...")
-                    self.add_creative_layout(slide, image_paths, texts)
-                    print(f"  ✓ 第 {idx + 1} 页处理完成（模板ID: {self.last_template_id}，图片数: {len(image_paths)})")
+                if job['restored'] == 'checkpoint':
+                    self._log(f"  [第 {idx + 1} 页] 已从检查点恢复")
+                elif job['restored'] == 'manifest':
+                    self._log(f"  [第 {idx + 1} 页] 内容未变化，复用上次的图片和排版")
                 else:
-                    print(f"  ✗ 第 {idx + 1} 页经过{max_retries}次搜索仍无法获得图片")
-                    print(f"  ✗ 第 {idx + 1} 页所有搜索方案均失败，保留原始文字布局（不使用随机图片）")
+                    self._search_slide_job(job)
+                    self._download_slide_job(job)
+                self._layout_slide_job(job)
                 
                 # 打印整体进度
-                self.print_progress(idx + 1, total_slides)
+                self._finish_slide(idx, total_slides, job)
                 
             except Exception as e:
-                # 单个页面处理失败，记录错误但继续处理其他页面
-                error_msg = str(e)
-                if self.verbose:
-                    print(f"  ✗ 第 {idx + 1} 页处理失败: {error_msg}")
-                    import traceback
-                    print(f"  [DEBUG] 错误详情: {traceback.format_exc()}")
+                self._report_slide_error(idx, e)
+                # 打印整体进度（即使失败也要更新）
+                self._finish_slide(idx, total_slides, job, error=e)
+    
+    def _process_slides_pipelined(self):
+        """
+        跨页流水线处理
+        
+        各阶段通过有界队列连接：文本提取（1个线程）→ 搜索（search_workers个线程）
+        → 下载/校验（download_workers个线程）→ 排版（当前线程，唯一持有Presentation的线程）。
+        第N+1页搜索时第N页可以同时下载；同时处理中的页数不超过max_slides_in_flight。
+        排版严格按页码顺序进行，保证模板选择与逐页处理时一致。
+        """
+        import threading
+        import queue
+        import traceback
+        
+        slides = list(self.prs.slides)
+        total_slides = len(slides)
+        if total_slides == 0:
+            return
+        
+        in_flight = threading.BoundedSemaphore(self.max_slides_in_flight)
+        search_queue = queue.Queue(maxsize=self.max_slides_in_flight)
+        download_queue = queue.Queue(maxsize=self.max_slides_in_flight)
+        done_queue = queue.Queue()
+        
+        if self.verbose:
+            self._log(f"[INFO] 流水线模式: 同时处理 {self.max_slides_in_flight} 页，"
+                  f"搜索线程 {self.search_workers} 个，下载线程 {self.download_workers} 个")
+        
+        def run_stage(job, stage, *args):
+            # 出错的任务直接向后传递，由排版线程统一报告
+            if job['error'] is not None:
+                return
+            try:
+                stage(job, *args)
+            except Exception as e:
+                e._pipeline_trace = traceback.format_exc()
+                job['error'] = e
+        
+        def extract_worker():
+            for idx, slide in enumerate(slides):
+                in_flight.acquire()
+                try:
+                    job = self._extract_slide_job(idx, slide)
+                except Exception as e:
+                    e._pipeline_trace = traceback.format_exc()
+                    job = {'idx': idx, 'slide': slide, 'texts': [], 'image_paths': [], 'error': e}
+                if job['error'] is None and job['texts'] and not job.get('restored'):
+                    search_queue.put(job)
                 else:
-                    print(f"  ✗ 第 {idx + 1} 页处理失败，跳过")
-                
+                    done_queue.put(job)
+        
+        def search_worker():
+            while True:
+                job = search_queue.get()
+                if job is None:
+                    return
+                run_stage(job, self._search_slide_job)
+                download_queue.put(job)
+        
+        def download_worker():
+            while True:
+                job = download_queue.get()
+                if job is None:
+                    return
+                run_stage(job, self._download_slide_job)
+                done_queue.put(job)
+        
+        threads = [threading.Thread(target=extract_worker, name="slide-extract", daemon=True)]
+        threads += [threading.Thread(target=search_worker, name=f"slide-search-{i}", daemon=True)
+                    for i in range(self.search_workers)]
+        threads += [threading.Thread(target=download_worker, name=f"slide-download-{i}", daemon=True)
+                    for i in range(self.download_workers)]
+        for thread in threads:
+            thread.start()
+        
+        # 当前线程负责排版：按页码顺序取出已完成下载的任务
+        finished = {}
+        next_idx = 0
+        while next_idx < total_slides:
+            job = done_queue.get()
+            finished[job['idx']] = job
+            while next_idx in finished:
+                job = finished.pop(next_idx)
+                self._log(f"\n处理第 {next_idx + 1} 页...")
+                error = None
+                try:
+                    if job['error'] is not None:
+                        raise job['error']
+                    if not job['texts']:
+                        self._log(f"  第 {next_idx + 1} 页没有找到文本，跳过")
+                    else:
+                        self._layout_slide_job(job)
+                except Exception as e:
+                    error = e
+                    self._report_slide_error(next_idx, e)
+                finally:
+                    in_flight.release()
                 # 打印整体进度（即使失败也要更新）
-                self.print_progress(idx + 1, total_slides)
+                self._finish_slide(next_idx, total_slides, job, error=error)
+                next_idx += 1
+        
+        # 所有页面已完成，通知各阶段线程退出
+        for _ in range(self.search_workers):
+            search_queue.put(None)
+        for _ in range(self.download_workers):
+            download_queue.put(None)
+        for thread in threads:
+            thread.join()
+    
+    def process_slides(self):
+        """
+        处理所有幻灯片
+        
+        max_slides_in_flight > 1 时使用跨页流水线，否则逐页处理
+        """
+        total_slides = len(self.prs.slides)
+        started = time.time()
+        self._log(f"开始处理PPT: {self.ppt_name}")
+        self._log(f"共 {total_slides} 页幻灯片")
+        self.emit_event('started', ppt_path=self.ppt_name, total=total_slides)
+        
+        self._load_checkpoints()
+        if self.llm_batch_size > 0 and (self.google_ai_api_key or self.ollama_base_url or self.spark_api_key):
+            self._prefetch_slide_keywords()
+        
+        if self.max_slides_in_flight > 1:
+            self._process_slides_pipelined()
+        else:
+            self._process_slides_sequential()
+        
+        # 不再等待尚未完成的后台AI优化
+        if self._llm_executor is not None:
+            self._llm_executor.shutdown(wait=False, cancel_futures=True)
+            self._llm_executor = None
+            self._pending_optimizations.clear()
         
         # 保存PPT
-        print(f"\n保存处理后的PPT到: {self.output_path}")
+        in_memory = not isinstance(self.output_path, str)
+        self._log(f"\n保存处理后的PPT到: {'内存' if in_memory else self.output_path}")
+        save_started = time.time()
         self.prs.save(self.output_path)
-        print("✓ 处理完成！")
+        save_elapsed = time.time() - save_started
+        self.timings.add('save', save_elapsed)
+        if in_memory:
+            # 回到开头，调用方可以直接读取或发送
+            output_size = self.output_path.seek(0, os.SEEK_END)
+            self.output_path.seek(0)
+        else:
+            output_size = os.path.getsize(self.output_path)
+        self._log(f"输出文件大小: {output_size / 1024 / 1024:.2f} MB，保存耗时: {save_elapsed:.2f} 秒")
+        # 已成功保存，检查点不再需要
+        if self.checkpoints is not None:
+            self.checkpoints.clear(self._deck_key)
+        if self.image_target_dpi > 0 and self.image_bytes_original > 0:
+            self._log(f"图片嵌入大小: {self.image_bytes_original / 1024 / 1024:.2f} MB → "
+                      f"{self.image_bytes_embedded / 1024 / 1024:.2f} MB（目标 {self.image_target_dpi} DPI）")
+        elapsed = time.time() - started
+        self.performance_report = self.build_performance_report(elapsed, output_size)
+        self.emit_event('saved', path=None if in_memory else self.output_path, total=total_slides, size=output_size,
+                        save_elapsed=save_elapsed, elapsed=elapsed,
+                        image_bytes_original=self.image_bytes_original,
+                        image_bytes_embedded=self.image_bytes_embedded,
+                        performance=self.performance_report)
+        self._log("✓ 处理完成！")
+    
+    def build_performance_report(self, elapsed, output_size=None):
+        """
+        生成本次处理的性能报告（可直接序列化为JSON）
         
-        # 清理临时文件夹
-        import shutil
-        try:
-            if os.path.exists(temp_dir):
-                shutil.rmtree(temp_dir)
-                if self.verbose:
-                    print(f"✓ 已清理临时文件夹: {temp_dir}")
-        except Exception as e:
-            if self.verbose:
-                print(f"[WARN] 清理临时文件夹失败: {e}")
-                print(f"      临时图片保存在 {temp_dir} 目录，可以手动删除")
+        阶段：extract、optimize（逐个AI优化）、optimize_batch.<提供商>、search.<提供商> / llm.<提供商>（每次网络请求，
+        不含缓存命中和限流等待）、ratelimit_wait.<提供商>（等待令牌的时间）、download.<主机>（不含图片仓库命中）、
+        convert、resize、layout（包含其中的convert和resize）、save、slide（每页总耗时）
+        
+        Args:
+            elapsed: 总耗时（秒）
+            output_size: 输出文件大小（字节）
+            
+        Returns:
+            {ppt_path, slides, elapsed, output_size, image_bytes_original, image_bytes_embedded, stages}
+        """
+        return {
+            'ppt_path': self.ppt_name,
+            'slides': len(self.prs.slides),
+            'elapsed': round(elapsed, 3),
+            'output_size': output_size,
+            'image_bytes_original': self.image_bytes_original,
+            'image_bytes_embedded': self.image_bytes_embedded,
+            'stages': self.timings.summary(),
+        }
 
 
 def load_config():
@@ -1670,10 +3289,282 @@ def load_config():
     
     return google_api_key, google_cse_id, google_ai_api_key, spark_api_key, spark_base_url, spark_model, ollama_base_url, ollama_model, exa_api_key, serp_api_key
 
-def main():
+
+# 性能相关配置项及默认值（config.json中的同名键会覆盖默认值）
+PERFORMANCE_OPTION_DEFAULTS = {
+    'max_slides_in_flight': 1,   # 大于1时启用跨页流水线
+    'search_workers': 2,
+    'download_workers': 2,
+    'hedged_download_fanout': 0,  # 大于2时启用对冲下载
+    'search_fanout': False,       # 同时查询所有图片搜索提供商
+    'search_cache_path': 'cache/search_cache.sqlite3',  # 为空时不使用持久化搜索缓存
+    'search_cache_ttl': 7 * 86400,
+    'search_cache_max_entries': 50000,
+    'image_store_dir': 'cache/images',  # 为空时不使用图片仓库
+    'image_store_max_mb': 1024,
+    'http_pool_maxsize': 10,
+    'http_host_pool_sizes': None,  # 例如 {"serpapi.com": 32}
+    'http_connect_timeout': 5,
+    'llm_batch_size': 0,  # 大于0时整份PPT的关键词批量交给AI优化
+    'speculative_keyword_optimization': False,  # AI优化关键词的同时直接用原始关键词搜索
+    'speculative_llm_wait': 10.0,
+    'image_target_dpi': 150,  # 按显示尺寸缩小嵌入的图片，0为嵌入原图
+    'image_jpeg_quality': 85,
+    'max_image_mb': 20,  # 单张图片下载大小上限
+    'host_health_path': 'cache/host_health.sqlite3',  # 为空时不使用主机熔断
+    'host_failure_threshold': 3,
+    'host_open_seconds': 300,
+    'provider_limits_path': 'cache/provider_limits.sqlite3',  # 为空时不限流
+    'provider_rate_limits': None,  # 默认不主动限速；例如 {"serp": [5, 10]}（每秒请求数, 突发请求数）
+    'provider_max_wait': 5.0,
+    'provider_quota_block_seconds': 3600,
+    'checkpoint_path': 'cache/checkpoints.sqlite3',  # 为空时不记录逐页检查点
+    'resume': True,  # 从上次中断的检查点继续
+    'incremental': False,  # 文本未变化的页面复用之前的图片和排版
+    'slide_manifest_path': 'cache/slide_manifest.sqlite3',
+}
+
+
+def _coerce_option_value(default, value):
+    """把环境变量中的字符串转换成与默认值相同的类型"""
+    if not isinstance(value, str) or isinstance(default, str):
+        return value
+    if value.strip().startswith(('{', '[')):
+        return json.loads(value)
+    if default is None:
+        return value
+    if isinstance(default, bool):
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+    if isinstance(default, int):
+        return int(value)
+    if isinstance(default, float):
+        return float(value)
+    return value
+
+
+def load_performance_options(config_file="config.json", environ=None):
+    """
+    从配置文件加载性能相关配置
+    
+    Args:
+        config_file: 配置文件路径
+        environ: 可选的环境变量字典（如os.environ），其中的大写同名变量优先于配置文件
+        
+    Returns:
+        可直接传给 PPTImageEnhancer 的关键字参数字典
+    """
+    options = dict(PERFORMANCE_OPTION_DEFAULTS)
+    if os.path.exists(config_file):
+        try:
+            with open(config_file, 'r', encoding='utf-8') as f:
+                config = json.load(f)
+            for key in PERFORMANCE_OPTION_DEFAULTS:
+                if key in config:
+                    options[key] = config[key]
+        except Exception as e:
+            print(f"[WARN] 读取性能配置失败: {e}")
+    if environ is not None:
+        for key, default in PERFORMANCE_OPTION_DEFAULTS.items():
+            if key.upper() in environ:
+                try:
+                    options[key] = _coerce_option_value(default, environ[key.upper()])
+                except ValueError:
+                    print(f"[WARN] 环境变量 {key.upper()} 的值无效，已忽略")
+    return options
+
+def collect_deck_paths(inputs):
+    """
+    展开命令行中给出的PPT路径
+    
+    Args:
+        inputs: 文件、目录（递归查找其中的.pptx）或通配符（如 "lessons/*.pptx"）
+        
+    Returns:
+        去重并排序后的.pptx文件路径列表（跳过已增强的输出文件和Office临时文件）
+    """
+    import glob
+    paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            candidates = glob.glob(os.path.join(item, '**', '*.pptx'), recursive=True)
+        elif glob.has_magic(item):
+            candidates = glob.glob(item, recursive=True)
+        else:
+            candidates = [item]
+        for path in candidates:
+            name = os.path.basename(path)
+            if not name.lower().endswith('.pptx') or name.startswith('~$'):
+                continue
+            if name.endswith('_enhanced.pptx'):
+                continue
+            paths.append(os.path.abspath(path))
+    return sorted(set(paths))
+
+
+def _process_deck(ppt_path, output_path, api_config, options, verbose):
+    """
+    批量处理中的单个任务（在进程池的工作进程中运行）
+    
+    Returns:
+        该PPT的处理结果字典（可直接序列化为JSON）
+    """
+    import sys
+    import contextlib
+    
+    (google_api_key, google_cse_id, google_ai_api_key, spark_api_key, spark_base_url, spark_model,
+     ollama_base_url, ollama_model, exa_api_key, serp_api_key) = api_config
+    result = {'input': ppt_path, 'output': output_path, 'status': 'error', 'slides': 0,
+              'slide_status': {}, 'failed_slides': [], 'duration': 0.0, 'output_size': None,
+              'error': None, 'performance': None}
+    
+    def on_event(event, data):
+        if event == 'started':
+            result['slides'] = data['total']
+        elif event == 'slide_done':
+            result['slide_status'][data['status']] = result['slide_status'].get(data['status'], 0) + 1
+            if data['status'] == 'failed':
+                result['failed_slides'].append({'slide': data['slide'], 'error': data['error']})
+    
+    started = time.time()
+    # 工作进程中的日志（包括构造函数和各处的print）一律写到标准错误，标准输出只留给JSON汇总
+    with contextlib.redirect_stdout(sys.stderr):
+        try:
+            enhancer = PPTImageEnhancer(
+                ppt_path,
+                output_path=output_path,
+                google_api_key=google_api_key,
+                google_cse_id=google_cse_id,
+                google_ai_api_key=google_ai_api_key,
+                spark_api_key=spark_api_key,
+                spark_base_url=spark_base_url,
+                spark_model=spark_model,
+                ollama_base_url=ollama_base_url,
+                ollama_model=ollama_model,
+                exa_api_key=exa_api_key,
+                serp_api_key=serp_api_key,
+                verbose=verbose,
+                event_callback=on_event,
+                log_to_stdout=verbose,
+                **options
+            )
+            enhancer.process_slides()
+            result['status'] = 'partial_success' if result['failed_slides'] else 'success'
+            result['output_size'] = os.path.getsize(output_path)
+            result['performance'] = enhancer.performance_report
+        except Exception as e:
+            import traceback
+            result['error'] = f"{type(e).__name__}: {e}"
+            if verbose:
+                traceback.print_exc()
+    result['duration'] = round(time.time() - started, 3)
+    return result
+
+
+def run_batch(argv):
+    """
+    批量处理多个PPT：各PPT在进程池中并行处理，结束后输出一份JSON汇总
+    
+    所有工作进程共用同一组SQLite缓存（搜索结果、图片仓库、主机健康度），
+    提供商的限流令牌桶也保存在其中，因此速率限制对整个进程池全局生效。
+    
+    Returns:
+        退出码（有PPT处理失败时为1，两个PPT的输出文件相同时为2）
+    """
+    import sys
+    import argparse
+    import contextlib
+    from concurrent.futures import ProcessPoolExecutor
+    
+    parser = argparse.ArgumentParser(description="日语词汇PPT图片增强工具 - 批量处理")
+    parser.add_argument('inputs', nargs='+', help="PPT文件、目录（递归查找.pptx）或通配符")
+    parser.add_argument('-j', '--workers', type=int, default=2, help="同时处理的PPT数（工作进程数，默认2）")
+    parser.add_argument('-o', '--output-dir', help="输出目录（保留输入的子目录结构；默认与输入文件放在一起，文件名后加_enhanced）")
+    parser.add_argument('--summary', help="把JSON汇总写入该文件（默认输出到标准输出）")
+    parser.add_argument('--skip-existing', action='store_true', help="跳过输出文件已存在的PPT")
+    parser.add_argument('-v', '--verbose', action='store_true', help="显示各PPT的详细日志")
+    args = parser.parse_args(argv)
+    
+    # 标准输出只留给JSON汇总，其他信息写到标准错误
+    with contextlib.redirect_stdout(sys.stderr):
+        api_config = load_config()
+        options = load_performance_options()
+    
+    paths = collect_deck_paths(args.inputs)
+    output_root = None
+    if args.output_dir and paths:
+        # 输出目录中保留输入文件相对于公共上级目录的子目录结构，不同子目录中的同名PPT不会互相覆盖
+        try:
+            output_root = os.path.commonpath([os.path.dirname(path) for path in paths])
+        except ValueError:
+            output_root = None  # 不在同一个盘符上（Windows），只能按文件名输出
+    decks = []
+    output_owners = {}
+    for path in paths:
+        if args.output_dir:
+            relative = os.path.relpath(path, output_root) if output_root else os.path.basename(path)
+            output_path = os.path.join(os.path.abspath(args.output_dir),
+                                       f"{os.path.splitext(relative)[0]}_enhanced.pptx")
+        else:
+            output_path = f"{os.path.splitext(path)[0]}_enhanced.pptx"
+        if output_path in output_owners:
+            print(f"[ERROR] {output_owners[output_path]} 和 {path} 的输出文件相同: {output_path}", file=sys.stderr)
+            return 2
+        output_owners[output_path] = path
+        if args.skip_existing and os.path.exists(output_path):
+            print(f"[INFO] 输出已存在，跳过: {path}", file=sys.stderr)
+            continue
+        decks.append((path, output_path))
+    for _, output_path in decks:
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    
+    workers = max(1, min(args.workers, len(decks) or 1))
+    print(f"共 {len(decks)} 个PPT，{workers} 个工作进程", file=sys.stderr)
+    started = time.time()
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(_process_deck, path, output_path, api_config, options, args.verbose): path
+                   for path, output_path in decks}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                # 工作进程异常退出（例如内存不足被终止）
+                result = {'input': futures[future], 'status': 'error', 'error': f"{type(e).__name__}: {e}"}
+            results.append(result)
+            mark = '✓' if result['status'] == 'success' else '✗'
+            print(f"[{len(results)}/{len(decks)}] {mark} {os.path.basename(result['input'])} "
+                  f"{result['status']} {result.get('slides', 0)} 页 {result.get('duration', 0):.1f}s", file=sys.stderr)
+    
+    results.sort(key=lambda result: result['input'])
+    summary = {
+        'elapsed': round(time.time() - started, 3),
+        'workers': workers,
+        'decks': len(results),
+        'succeeded': sum(1 for result in results if result['status'] == 'success'),
+        'partial': sum(1 for result in results if result['status'] == 'partial_success'),
+        'failed': sum(1 for result in results if result['status'] == 'error'),
+        'slides': sum(result.get('slides', 0) for result in results),
+        'results': results,
+    }
+    text = json.dumps(summary, ensure_ascii=False, indent=2)
+    if args.summary:
+        with open(args.summary, 'w', encoding='utf-8') as f:
+            f.write(text)
+        print(f"汇总已写入: {args.summary}", file=sys.stderr)
+    else:
+        print(text)
+    return 1 if summary['failed'] else 0
+
+
+def main(argv=None):
     """
-    主函数
+    主函数：带参数时批量处理，不带参数时交互式处理单个PPT
     """
+    import sys
+    argv = sys.argv[1:] if argv is None else argv
+    if argv:
+        return run_batch(argv)
+    
     print("=" * 50)
     print("日语词汇PPT图片增强工具")
     print("=" * 50)
@@ -1739,11 +3630,13 @@ def main():
         ollama_model=ollama_model,
         exa_api_key=exa_api_key,
         serp_api_key=serp_api_key,
-        verbose=verbose
+        verbose=verbose,
+        **load_performance_options()
     )
     enhancer.process_slides()
+    print()
+    print(format_performance_report(enhancer.performance_report))
 
 
 if __name__ == "__main__":
-    main()
-
+    raise SystemExit(main())
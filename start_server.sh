@@ -40,7 +40,8 @@ echo ""
 
 # 使用gunicorn启动（生产环境）
 if command -v gunicorn &> /dev/null; then
-    gunicorn -w 4 -b 0.0.0.0:5000 web_app:app
+    # 使用gthread线程worker：进度流（SSE）连接只占用一个线程，不会占满整个worker
+    gunicorn -w 4 -k gthread --threads 8 -b 0.0.0.0:5000 web_app:app
 else
     # 如果没有gunicorn，使用Flask开发服务器
     echo "提示: 建议安装gunicorn以获得更好的性能: pip install gunicorn"
@@ -4,15 +4,23 @@
 """
 
 import os
+import sys
 import uuid
 import shutil
-from flask import Flask, request, jsonify, send_file, after_this_request
+from flask import Flask, request, jsonify, send_file, Response, stream_with_context
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
 import tempfile
 import traceback
+import io
+import json
+import re
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-from main import PPTImageEnhancer, load_config
+from main import PPTImageEnhancer, load_config, load_performance_options
+from cache_store import SharedDB, get_metrics_store, get_rate_limiter
 
 app = Flask(__name__)
 CORS(app)  # 允许跨域请求
@@ -22,6 +30,30 @@ UPLOAD_FOLDER = 'uploads'
 OUTPUT_FOLDER = 'outputs'
 ALLOWED_EXTENSIONS = {'pptx', 'ppt'}
 MAX_FILE_SIZE = 100 * 1024 * 1024  # 100MB
+# 每个worker进程同时处理的任务数（其余任务排队等待）
+# 各任务的进度通过事件回调分别记录，可以按服务器内存适当调大
+JOB_CONCURRENCY = int(os.getenv('JOB_CONCURRENCY', '1'))
+# 任务状态数据库（所有worker共享）及结束后保留时间
+TASK_DB_PATH = os.getenv('TASK_DB_PATH', 'cache/tasks.sqlite3')
+TASK_STATUS_TTL = int(os.getenv('TASK_STATUS_TTL', '86400'))  # 24小时
+# SSE进度流：单个连接最长保持时间（秒），到期后由浏览器带Last-Event-ID自动重连
+SSE_MAX_DURATION = int(os.getenv('SSE_MAX_DURATION', '30'))
+SSE_POLL_INTERVAL = 0.5  # 检查任务状态变化的间隔（秒）
+SSE_RETRY_MS = 1000  # 浏览器断线后重连等待时间（毫秒）
+# 监控指标数据库（所有worker共享）及各worker写入/上报内存的间隔（秒）
+METRICS_DB_PATH = os.getenv('METRICS_DB_PATH', 'cache/metrics.sqlite3')
+METRICS_FLUSH_INTERVAL = int(os.getenv('METRICS_FLUSH_INTERVAL', '5'))
+# 内存模式：上传的PPT和处理结果都留在内存中（上传内容过大时自动转存到匿名临时文件），不经过uploads/outputs目录。
+# 结果只保存在处理该任务的worker进程中，需要单worker（-w 1 --threads N）或按任务ID的会话保持
+IN_MEMORY_PROCESSING = os.getenv('IN_MEMORY_PROCESSING', '0').lower() in ('1', 'true', 'yes', 'on')
+UPLOAD_SPOOL_MAX_MB = int(os.getenv('UPLOAD_SPOOL_MAX_MB', '32'))
+MEMORY_OUTPUT_TTL = int(os.getenv('MEMORY_OUTPUT_TTL', '3600'))  # 处理结果在内存中保留的秒数
+# 输出文件索引（所有worker共享）、保留时间和总大小上限；后台清理线程每JANITOR_INTERVAL秒检查一次
+ARTIFACT_DB_PATH = os.getenv('ARTIFACT_DB_PATH', 'cache/artifacts.sqlite3')
+ARTIFACT_TTL = int(os.getenv('ARTIFACT_TTL', '86400'))  # 24小时
+ARTIFACT_MAX_MB = int(os.getenv('ARTIFACT_MAX_MB', '2048'))
+UPLOAD_TTL = int(os.getenv('UPLOAD_TTL', '3600'))  # 残留的上传文件保留1小时
+JANITOR_INTERVAL = int(os.getenv('JANITOR_INTERVAL', '300'))
 
 # 确保文件夹存在
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
@@ -42,6 +74,9 @@ ollama_model = os.getenv('OLLAMA_MODEL', ollama_model)
 exa_api_key = os.getenv('EXA_API_KEY', exa_api_key)
 serp_api_key = os.getenv('SERP_API_KEY', serp_api_key)
 
+# 性能相关配置（流水线并发度等），环境变量同样优先
+performance_options = load_performance_options(environ=os.environ)
+
 
 def allowed_file(filename):
     """检查文件扩展名是否允许"""
@@ -70,80 +105,577 @@ def handle_exception(e):
     }), 500
 
 
-# 全局任务状态存储（用于进度查询）
-task_status = {}
+class TaskStatusStore:
+    """
+    任务状态存储（SQLite，WAL模式）
+    
+    gunicorn多个worker进程共享同一个数据库文件，进度查询无论落到哪个worker都能查到任务；
+    任务状态和日志分表保存，日志按序号递增，轮询时只需读取新增的部分。
+    结束的任务超过TTL后自动删除。
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS tasks (
+            task_id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            data TEXT NOT NULL,
+            updated REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_tasks_updated ON tasks (updated);
+        CREATE TABLE IF NOT EXISTS task_logs (
+            task_id TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            line TEXT NOT NULL,
+            PRIMARY KEY (task_id, seq)
+        );
+    """
+    FINISHED_STATUSES = ('success', 'partial_success', 'error')
+    
+    def __init__(self, db_path, ttl=86400):
+        """
+        Args:
+            db_path: 数据库文件路径
+            ttl: 任务最后一次更新后保留的秒数
+        """
+        self.db = SharedDB(db_path, self.SCHEMA)
+        self.ttl = ttl
+        self._writes = 0
+    
+    def set(self, task_id, status, **fields):
+        """整体替换任务状态（不影响已有日志）"""
+        self.db.conn().execute(
+            "INSERT OR REPLACE INTO tasks (task_id, status, data, updated) VALUES (?, ?, ?, ?)",
+            (task_id, status, json.dumps(fields, ensure_ascii=False), time.time()))
+        self._maybe_expire()
+    
+    def update(self, task_id, **fields):
+        """在事务中合并更新部分字段（字段中可以包含status）"""
+        conn = self.db.conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT status, data FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+            if row is not None:
+                data = json.loads(row[1])
+                status = fields.pop('status', row[0])
+                data.update(fields)
+                conn.execute("UPDATE tasks SET status = ?, data = ?, updated = ? WHERE task_id = ?",
+                             (status, json.dumps(data, ensure_ascii=False), time.time(), task_id))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    
+    def append_logs(self, task_id, lines):
+        """追加日志行（序号从1开始连续递增）"""
+        if not lines:
+            return
+        conn = self.db.conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            last_seq = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM task_logs WHERE task_id = ?",
+                                    (task_id,)).fetchone()[0]
+            conn.executemany("INSERT INTO task_logs (task_id, seq, line) VALUES (?, ?, ?)",
+                             [(task_id, last_seq + i + 1, line) for i, line in enumerate(lines)])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    
+    def get(self, task_id, since=None, log_limit=100):
+        """
+        查询任务状态
+        
+        Args:
+            task_id: 任务ID
+            since: 只返回序号大于since的日志；为None时返回最后log_limit条
+            log_limit: 最多返回的日志条数
+            
+        Returns:
+            状态字典（含logs和log_seq），任务不存在时返回None
+        """
+        conn = self.db.conn()
+        row = conn.execute("SELECT status, data FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+        if row is None:
+            return None
+        status = json.loads(row[1])
+        status['status'] = row[0]
+        if since is None:
+            logs = conn.execute(
+                "SELECT seq, line FROM task_logs WHERE task_id = ? ORDER BY seq DESC LIMIT ?",
+                (task_id, log_limit)).fetchall()[::-1]
+        else:
+            logs = conn.execute(
+                "SELECT seq, line FROM task_logs WHERE task_id = ? AND seq > ? ORDER BY seq LIMIT ?",
+                (task_id, since, log_limit)).fetchall()
+        status['logs'] = [line for _, line in logs]
+        status['log_seq'] = logs[-1][0] if logs else (since or 0)
+        return status
+    
+    def count_by_status(self):
+        """各状态的任务数 {status: n}（只包含尚未过期的任务）"""
+        return dict(self.db.conn().execute("SELECT status, COUNT(*) FROM tasks GROUP BY status").fetchall())
+    
+    def active_task_ids(self):
+        """排队中或处理中（尚未结束）的任务ID集合"""
+        placeholders = ', '.join('?' * len(self.FINISHED_STATUSES))
+        return {row[0] for row in self.db.conn().execute(
+            f"SELECT task_id FROM tasks WHERE status NOT IN ({placeholders})", self.FINISHED_STATUSES)}
+    
+    def _maybe_expire(self):
+        self._writes += 1
+        if self._writes % 20 == 1:
+            self.expire()
+    
+    def expire(self):
+        """删除超过TTL的任务及其日志（运行中的任务长时间没有更新也视为已失效）"""
+        conn = self.db.conn()
+        cutoff = time.time() - self.ttl
+        expired = [row[0] for row in conn.execute("SELECT task_id FROM tasks WHERE updated < ?", (cutoff,))]
+        for task_id in expired:
+            conn.execute("DELETE FROM task_logs WHERE task_id = ?", (task_id,))
+            conn.execute("DELETE FROM tasks WHERE task_id = ?", (task_id,))
+        return len(expired)
+
+
+# 全局任务状态存储（用于进度查询，所有worker共享）
+task_status = TaskStatusStore(TASK_DB_PATH, ttl=TASK_STATUS_TTL)
+
+
+class MemoryOutputStore:
+    """
+    内存模式下的处理结果：task_id → (内容, 文件名, 完成时间)
+    
+    只存在于当前worker进程中；保留TTL秒（期间可以断点续传或重复下载），之后释放。
+    """
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+        self._outputs = {}
+        self._lock = threading.Lock()
+    
+    def put(self, task_id, buffer, filename):
+        """
+        保存处理结果并关闭增强器的输出缓冲区
+        
+        缓冲区没有被其他对象引用时getvalue()直接接管其内部数据（不复制），随后关闭缓冲区，
+        内存中只保留这一份；下载时用BytesIO(data)包装也只是只读共享，不会再复制。
+        """
+        data = buffer.getvalue()
+        buffer.close()
+        with self._lock:
+            self._outputs[task_id] = (data, filename, time.time())
+        self.expire()
+    
+    def get(self, task_id):
+        """
+        Returns:
+            (内容bytes, 文件名, 完成时间)，不存在时返回None
+        """
+        with self._lock:
+            return self._outputs.get(task_id)
+    
+    def expire(self):
+        """释放超过TTL仍未下载的结果"""
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            for task_id in [key for key, entry in self._outputs.items() if entry[2] < cutoff]:
+                del self._outputs[task_id]
+
+
+memory_outputs = MemoryOutputStore(ttl=MEMORY_OUTPUT_TTL)
+
+
+class ArtifactStore:
+    """
+    输出文件索引：task_id → 文件路径、下载文件名、大小和生成时间
+    
+    下载时按task_id直接查询，不再扫描outputs目录。所有worker共享同一个SQLite文件；
+    过期和超出总大小上限的文件由后台清理线程删除（enforce_limits），下载后不再立即删除，
+    这样中断的大文件下载可以用Range请求续传。
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS artifacts (
+            task_id TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            created REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_artifacts_created ON artifacts (created);
+    """
+    
+    def __init__(self, db_path, ttl=86400, max_bytes=2048 * 1024 * 1024):
+        """
+        Args:
+            db_path: 数据库文件路径
+            ttl: 文件生成后保留的秒数
+            max_bytes: 所有输出文件的总大小上限，超出时从最旧的开始删除
+        """
+        self.db = SharedDB(db_path, self.SCHEMA)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+    
+    def add(self, task_id, path, filename):
+        """登记一个输出文件"""
+        self.db.conn().execute(
+            "INSERT OR REPLACE INTO artifacts (task_id, path, filename, size, created) VALUES (?, ?, ?, ?, ?)",
+            (task_id, path, filename, os.path.getsize(path), time.time()))
+    
+    def get(self, task_id):
+        """
+        查询输出文件
+        
+        Returns:
+            {'path', 'filename', 'size', 'created'}，不存在（或文件已被删除）时返回None
+        """
+        row = self.db.conn().execute(
+            "SELECT path, filename, size, created FROM artifacts WHERE task_id = ?", (task_id,)).fetchone()
+        if row is None:
+            return None
+        if not os.path.exists(row[0]):
+            self.remove(task_id)
+            return None
+        return {'path': row[0], 'filename': row[1], 'size': row[2], 'created': row[3]}
+    
+    def remove(self, task_id):
+        """删除一个输出文件及其索引"""
+        conn = self.db.conn()
+        row = conn.execute("SELECT path FROM artifacts WHERE task_id = ?", (task_id,)).fetchone()
+        conn.execute("DELETE FROM artifacts WHERE task_id = ?", (task_id,))
+        if row is not None:
+            try:
+                os.remove(row[0])
+            except OSError:
+                pass
+    
+    def is_indexed(self, path):
+        return self.db.conn().execute("SELECT 1 FROM artifacts WHERE path = ?", (path,)).fetchone() is not None
+    
+    def enforce_limits(self):
+        """
+        删除过期的文件，总大小仍超出上限时按生成时间从旧到新删除
+        
+        Returns:
+            删除的文件数
+        """
+        conn = self.db.conn()
+        removed = 0
+        expired = conn.execute("SELECT task_id FROM artifacts WHERE created < ?",
+                               (time.time() - self.ttl,)).fetchall()
+        for (task_id,) in expired:
+            self.remove(task_id)
+            removed += 1
+        excess = conn.execute("SELECT COALESCE(SUM(size), 0) FROM artifacts").fetchone()[0] - self.max_bytes
+        if excess > 0:
+            for task_id, size in conn.execute("SELECT task_id, size FROM artifacts ORDER BY created").fetchall():
+                if excess <= 0:
+                    break
+                self.remove(task_id)
+                removed += 1
+                excess -= size
+        return removed
+
+
+artifacts = ArtifactStore(ARTIFACT_DB_PATH, ttl=ARTIFACT_TTL, max_bytes=ARTIFACT_MAX_MB * 1024 * 1024)
+
+
+def run_janitor():
+    """
+    清理过期文件：输出文件按索引执行保留时间和总大小上限，另外删除残留的上传文件、
+    未登记的旧输出文件（例如升级前生成的），并释放内存模式下过期的结果
+    
+    上传文件名以任务ID开头，仍在排队或处理中的任务的上传文件不会被删除（即使排队超过UPLOAD_TTL）
+    
+    Returns:
+        删除的文件数
+    """
+    removed = artifacts.enforce_limits()
+    active_tasks = task_status.active_task_ids()
+    now = time.time()
+    for folder, ttl, indexed_only in ((UPLOAD_FOLDER, UPLOAD_TTL, False), (OUTPUT_FOLDER, ARTIFACT_TTL, True)):
+        for entry in os.scandir(folder):
+            try:
+                if not entry.is_file() or now - entry.stat().st_mtime <= ttl:
+                    continue
+                if indexed_only and artifacts.is_indexed(entry.path):
+                    continue
+                if not indexed_only and entry.name.split('_', 1)[0] in active_tasks:
+                    continue
+                os.remove(entry.path)
+                removed += 1
+            except OSError:
+                pass
+    memory_outputs.expire()
+    return removed
+
+# 后台任务线程池：/api/process 只负责入队，不再占用请求线程
+job_executor = ThreadPoolExecutor(max_workers=JOB_CONCURRENCY, thread_name_prefix="ppt-job")
 
 
 class ProgressLogger:
-    """用于捕获处理进度的日志类，同时转发到原始stdout，方便在服务器日志中查看完整输出"""
-    def __init__(self, original_stdout=None, task_id=None):
-        self.logs = []
-        self.original_stdout = original_stdout
+    """
+    任务进度记录器：订阅PPTImageEnhancer的处理事件，把进度和日志写入任务状态存储
+    
+    直接作为 event_callback 传给增强器，不需要替换sys.stdout，同一进程中的多个任务互不干扰。
+    """
+    # 日志批量写入状态存储的间隔（秒），避免每行都写数据库
+    FLUSH_INTERVAL = 0.5
+    
+    def __init__(self, task_id):
+        self.pending_logs = []
         self.task_id = task_id
         self.current_page = 0
         self.total_pages = 0
         self.progress_percent = 0
+        self.last_flush = time.time()
+        self.lock = threading.Lock()
     
-    def write(self, message):
-        # 记录到内存日志
-        if message.strip():
-            self.logs.append(message.strip())
-            
-            # 解析进度信息（例如："[####################] 100% (37/37 pages)"）
-            import re
-            progress_match = re.search(r'(\d+)% \((\d+)/(\d+) pages\)', message)
-            if progress_match:
-                self.progress_percent = int(progress_match.group(1))
-                self.current_page = int(progress_match.group(2))
-                self.total_pages = int(progress_match.group(3))
-                
-                # 更新全局任务状态
-                if self.task_id:
-                    task_status[self.task_id] = {
-                        'status': 'processing',
-                        'progress': self.progress_percent,
-                        'current_page': self.current_page,
-                        'total_pages': self.total_pages,
-                        'logs': self.logs[-100:]  # 保留最后100条日志
-                    }
-            
-            # 检测错误信息
-            if '✗' in message or '失败' in message or 'ERROR' in message.upper() or 'Exception' in message:
-                if self.task_id and self.task_id in task_status:
-                    # 不改变状态为error，但记录错误日志
-                    current_status = task_status[self.task_id].copy()
-                    current_status['logs'] = self.logs[-100:]
-                    task_status[self.task_id] = current_status
+    def __call__(self, event, data):
+        if event == 'log':
+            self.log(data['message'], echo=False)
+        elif event == 'started':
+            self.total_pages = data['total']
+            self.flush_to_store(progress_changed=True)
+        elif event == 'slide_done':
+            self.current_page = data['completed']
+            self.total_pages = data['total']
+            self.progress_percent = int(data['completed'] * 100 / data['total']) if data['total'] else 0
+            self.flush_to_store(progress_changed=True)
+        elif event == 'saved':
+            # 记录输出文件大小、保存耗时和各阶段的性能报告
+            task_status.update(self.task_id, output_size=data['size'],
+                               save_seconds=round(data['save_elapsed'], 3),
+                               performance=data.get('performance'))
+    
+    def log(self, message, echo=True):
+        """
+        记录一行日志
         
-        # 同时转发到原stdout，这样 journalctl 里也能看到完整日志
-        if self.original_stdout is not None:
-            try:
-                self.original_stdout.write(message)
-            except Exception:
-                # 避免因为日志转发失败影响主流程
-                pass
+        Args:
+            message: 日志内容
+            echo: 是否同时打印到服务器控制台（增强器自己的日志已经打印过）
+        """
+        if echo:
+            print(message)
+        with self.lock:
+            self.pending_logs.append(message)
+        if time.time() - self.last_flush >= self.FLUSH_INTERVAL:
+            self.flush_to_store()
     
-    def flush(self):
-        if self.original_stdout is not None:
-            try:
-                self.original_stdout.flush()
-            except Exception:
-                pass
+    def flush_to_store(self, progress_changed=False):
+        """把缓冲的日志（以及最新进度）写入任务状态存储"""
+        with self.lock:
+            lines, self.pending_logs = self.pending_logs, []
+            self.last_flush = time.time()
+        try:
+            task_status.append_logs(self.task_id, lines)
+            if progress_changed:
+                task_status.update(self.task_id,
+                                   progress=self.progress_percent,
+                                   current_page=self.current_page,
+                                   total_pages=self.total_pages)
+        except Exception:
+            # 状态写入失败不影响处理
+            pass
+
+
+# 全局监控指标（所有worker共享同一个数据库，/api/metrics 无论落到哪个worker都返回汇总值）
+metrics = get_metrics_store(METRICS_DB_PATH, flush_interval=METRICS_FLUSH_INTERVAL)
+# 直方图的桶上界（秒）
+JOB_DURATION_BUCKETS = (10, 30, 60, 120, 300, 600, 1200, 1800, 3600)
+REQUEST_DURATION_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# 导出的指标：名称 → (类型, 说明)
+METRIC_DEFINITIONS = {
+    'ppt_jobs': ('gauge', '当前各状态的任务数（结束的任务在TTL内保留）'),
+    'ppt_jobs_submitted_total': ('counter', '提交的任务数'),
+    'ppt_jobs_finished_total': ('counter', '结束的任务数（按最终状态）'),
+    'ppt_job_queue_wait_seconds': ('histogram', '任务从提交到开始处理的等待时间'),
+    'ppt_job_duration_seconds': ('histogram', '任务处理耗时（按最终状态）'),
+    'ppt_slides_processed_total': ('counter', '处理完成的幻灯片页数（按页面状态）'),
+    'ppt_provider_request_duration_seconds': ('histogram', '搜索/AI提供商请求耗时'),
+    'ppt_provider_errors_total': ('counter', '搜索/AI提供商请求失败或因限流跳过的次数'),
+    'ppt_provider_blocked': ('gauge', '当前处于限流/配额阻断期的 提供商+Key 数'),
+    'ppt_image_fetches_total': ('counter', '从网络下载的图片数'),
+    'ppt_image_fetch_bytes_total': ('counter', '从网络下载的图片字节数'),
+    'ppt_cache_lookups_total': ('counter', '缓存查询次数（按缓存和命中结果）'),
+    'ppt_worker_rss_bytes': ('gauge', '各worker进程的常驻内存'),
+}
+
+
+def record_metrics_event(event, data):
+    """把增强器的处理事件计入监控指标（作为事件监听者添加到每个任务的增强器上）"""
+    if event == 'slide_done':
+        metrics.inc('ppt_slides_processed_total', labels={'status': data['status']})
+    elif event == 'provider_request':
+        if data['status'] is not None:
+            metrics.observe('ppt_provider_request_duration_seconds', data['elapsed'],
+                            REQUEST_DURATION_BUCKETS, labels={'provider': data['provider']})
+        if data['error']:
+            metrics.inc('ppt_provider_errors_total', labels={'provider': data['provider'], 'reason': data['error']})
+    elif event == 'image_fetched':
+        metrics.inc('ppt_image_fetches_total')
+        metrics.inc('ppt_image_fetch_bytes_total', data['size'])
+    elif event == 'cache_lookup':
+        labels = {'cache': data['cache'], 'result': 'hit' if data['hit'] else 'miss'}
+        if data['provider']:
+            labels['provider'] = data['provider']
+        metrics.inc('ppt_cache_lookups_total', labels=labels)
+
+
+def current_rss_bytes():
+    """当前进程的常驻内存（字节），无法获取时返回0"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return 0
+    # 非Linux系统只能取得峰值内存（macOS上单位为字节，其他系统为KB）
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+_background_threads_pid = None
+_background_threads_lock = threading.Lock()
+_worker_started = time.time()
+
+
+def report_worker_metrics():
+    """上报本worker的内存占用，并把内存中累积的指标写入共享数据库"""
+    try:
+        metrics.report_worker(os.getpid(), current_rss_bytes(), _worker_started)
+        metrics.flush()
+    except Exception:
+        # 指标写入失败不影响服务
+        pass
+
+
+def _metrics_reporter_loop():
+    while True:
+        report_worker_metrics()
+        time.sleep(METRICS_FLUSH_INTERVAL)
+
+
+def _janitor_loop():
+    while True:
+        try:
+            run_janitor()
+        except Exception as e:
+            print(f"[WARN] 清理过期文件失败: {e}")
+        time.sleep(JANITOR_INTERVAL)
+
+
+@app.before_request
+def start_background_threads():
+    """
+    每个worker进程收到第一个请求时启动后台线程：指标上报和过期文件清理
     
-    def get_logs(self):
-        return self.logs
+    gunicorn fork之后线程不会被继承，所以按pid判断；多个worker同时清理是安全的（删除操作是幂等的）。
+    """
+    global _background_threads_pid, _worker_started
+    if _background_threads_pid == os.getpid():
+        return
+    with _background_threads_lock:
+        if _background_threads_pid == os.getpid():
+            return
+        _background_threads_pid = os.getpid()
+        _worker_started = time.time()
+        threading.Thread(target=_metrics_reporter_loop, name="metrics-reporter", daemon=True).start()
+        threading.Thread(target=_janitor_loop, name="artifact-janitor", daemon=True).start()
 
 
 @app.route('/api/progress/<task_id>', methods=['GET'])
 def get_progress(task_id):
-    """获取任务处理进度"""
-    if task_id not in task_status:
+    """
+    获取任务处理进度
+    
+    可选参数 since：只返回序号大于since的新日志（响应中的log_seq为最后一条日志的序号）
+    """
+    since = request.args.get('since', type=int)
+    status = task_status.get(task_id, since=since)
+    if status is None:
         return jsonify({'error': '任务不存在'}), 404
     
-    status = task_status[task_id]
     return jsonify(status)
 
 
+def _sse_event(event, data, event_id=None):
+    """格式化一条SSE事件"""
+    message = f"event: {event}\n"
+    if event_id is not None:
+        message += f"id: {event_id}\n"
+    return message + f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@app.route('/api/progress/<task_id>/stream', methods=['GET'])
+def stream_progress(task_id):
+    """
+    以Server-Sent Events推送任务进度，只推送变化的进度和新增日志
+    
+    事件类型：
+        progress: 任务状态/进度变化
+        log: 新增日志行，事件id为最后一行日志的序号
+        done: 任务结束（最终状态），客户端收到后应关闭连接
+    
+    断线重连时浏览器通过Last-Event-ID头带回最后收到的日志序号，从该序号之后继续推送。
+    每个连接最长保持SSE_MAX_DURATION秒后主动结束，由浏览器自动重连。
+    
+    进度流需要线程或协程worker（gthread/gevent）。同步worker（wsgi.multithread为False）
+    下返回204，浏览器的EventSource随即关闭，前端退回?since=轮询，不会占住整个worker。
+    """
+    if not request.environ.get('wsgi.multithread'):
+        return Response(status=204)
+    
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    try:
+        since = int(last_event_id) if last_event_id else 0
+    except ValueError:
+        since = 0
+    
+    if task_status.get(task_id, since=since, log_limit=0) is None:
+        return jsonify({'error': '任务不存在'}), 404
+    
+    def generate(since):
+        deadline = time.time() + SSE_MAX_DURATION
+        last_progress = None
+        log_limit = 200
+        yield f"retry: {SSE_RETRY_MS}\n\n"
+        
+        while True:
+            status = task_status.get(task_id, since=since, log_limit=log_limit)
+            if status is None:
+                yield _sse_event('done', {'status': 'error', 'error': '任务不存在'})
+                return
+            
+            logs = status.pop('logs')
+            log_seq = status.pop('log_seq')
+            if logs:
+                since = log_seq
+                yield _sse_event('log', {'lines': logs}, event_id=log_seq)
+            
+            finished = status['status'] in TaskStatusStore.FINISHED_STATUSES
+            if finished and len(logs) < log_limit:
+                # 日志已全部推送，发送最终状态后结束
+                yield _sse_event('done', status)
+                return
+            if status != last_progress and not finished:
+                last_progress = status
+                yield _sse_event('progress', status)
+            
+            if len(logs) >= log_limit:
+                # 还有未推送的日志，立即继续
+                continue
+            if time.time() >= deadline:
+                return
+            time.sleep(SSE_POLL_INTERVAL)
+    
+    return Response(stream_with_context(generate(since)), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',  # 禁止Nginx缓冲，保证事件及时送达
+    })
+
+
 @app.route('/api/health', methods=['GET'])
 def health_check():
     """健康检查接口
@@ -170,6 +702,64 @@ def health_check():
     })
 
 
+def _render_metrics():
+    """把汇总后的指标格式化为Prometheus文本格式"""
+    snapshot = metrics.snapshot()
+    samples = {name: [] for name in METRIC_DEFINITIONS}
+    for name, labels, value in snapshot['counters']:
+        family = name
+        for suffix in ('_bucket', '_sum', '_count'):
+            if name.endswith(suffix) and name[:-len(suffix)] in METRIC_DEFINITIONS:
+                family = name[:-len(suffix)]
+        if family in samples:
+            samples[family].append((name, labels, value))
+    
+    for status, count in task_status.count_by_status().items():
+        samples['ppt_jobs'].append(('ppt_jobs', metrics.format_labels({'status': status}), count))
+    limits_path = performance_options.get('provider_limits_path')
+    if limits_path:
+        blocked = {}
+        for provider, _, _, _ in get_rate_limiter(limits_path).blocked():
+            blocked[provider] = blocked.get(provider, 0) + 1
+        for provider, count in sorted(blocked.items()):
+            samples['ppt_provider_blocked'].append(
+                ('ppt_provider_blocked', metrics.format_labels({'provider': provider}), count))
+    for pid, rss_bytes, _ in snapshot['workers']:
+        samples['ppt_worker_rss_bytes'].append(
+            ('ppt_worker_rss_bytes', metrics.format_labels({'pid': pid}), rss_bytes))
+    
+    def histogram_order(sample):
+        # 同一组标签的样本排在一起，桶按上界从小到大排列（float('+Inf')为无穷大）
+        name, labels, _ = sample
+        match = re.search(r'le="([^"]+)"', labels)
+        series = re.sub(r',?le="[^"]+"', '', labels).lstrip(',')
+        return (series, name.rsplit('_', 1)[1], float(match.group(1)) if match else 0.0)
+    
+    lines = []
+    for family, (metric_type, help_text) in METRIC_DEFINITIONS.items():
+        lines.append(f"# HELP {family} {help_text}")
+        lines.append(f"# TYPE {family} {metric_type}")
+        family_samples = samples[family]
+        if metric_type == 'histogram':
+            family_samples = sorted(family_samples, key=histogram_order)
+        for name, labels, value in family_samples:
+            value = int(value) if float(value).is_integer() else value
+            lines.append(f"{name}{{{labels}}} {value}" if labels else f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+@app.route('/api/metrics', methods=['GET'])
+def export_metrics():
+    """
+    Prometheus格式的监控指标
+    
+    计数器和直方图保存在所有worker共享的SQLite中，每个worker每METRICS_FLUSH_INTERVAL秒写入一次增量，
+    因此无论请求落到哪个worker，得到的都是所有worker的汇总值（最多延迟一个写入间隔）。
+    """
+    report_worker_metrics()
+    return Response(_render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 @app.route('/api/process', methods=['POST'])
 def process_ppt():
     """处理PPT文件的主接口"""
@@ -206,212 +796,206 @@ def process_ppt():
     
     # 生成唯一ID
     task_id = str(uuid.uuid4())
-    upload_path = None
-    output_path = None
     
-    try:
-        # 保存上传的文件
-        filename = secure_filename(file.filename)
+    filename = secure_filename(file.filename)
+    base_name = os.path.splitext(filename)[0]
+    output_filename = f"{base_name}_enhanced.pptx"
+    if IN_MEMORY_PROCESSING:
+        # 上传内容复制到内存（超过UPLOAD_SPOOL_MAX_MB时转存到匿名临时文件），结果保存到内存缓冲区
+        upload_path = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_MAX_MB * 1024 * 1024)
+        file.save(upload_path)
+        upload_path.seek(0)
+        output_path = io.BytesIO()
+    else:
+        # 保存上传的文件，生成输出文件路径
         upload_path = os.path.join(UPLOAD_FOLDER, f"{task_id}_{filename}")
         file.save(upload_path)
-        
-        # 生成输出文件路径
-        base_name = os.path.splitext(filename)[0]
-        output_filename = f"{base_name}_enhanced.pptx"
         output_path = os.path.join(OUTPUT_FOLDER, f"{task_id}_{output_filename}")
-        
-        # 创建进度日志捕获器
-        import sys
-        original_stdout = sys.stdout
-        progress_logger = ProgressLogger(original_stdout=original_stdout, task_id=task_id)
-        
-        # 初始化任务状态
-        task_status[task_id] = {
-            'status': 'processing',
-            'progress': 0,
-            'current_page': 0,
-            'total_pages': 0,
-            'logs': []
-        }
-        
-        # 重定向stdout到进度捕获器
-        sys.stdout = progress_logger
+    
+    enhancer_kwargs = dict(
+        output_path=output_path,
+        google_api_key=req_google_api_key,
+        google_cse_id=req_google_cse_id,
+        google_ai_api_key=req_google_ai_api_key,
+        spark_api_key=req_spark_api_key,
+        spark_base_url=req_spark_base_url,
+        spark_model=req_spark_model,
+        ollama_base_url=req_ollama_base_url,
+        ollama_model=req_ollama_model,
+        exa_api_key=req_exa_api_key,
+        serp_api_key=req_serp_api_key,
+        verbose=True,
+        **performance_options
+    )
+    
+    # 初始化任务状态，放入任务队列后立即返回，客户端通过 /api/progress 轮询进度
+    task_status.set(task_id, 'queued',
+                    progress=0,
+                    current_page=0,
+                    total_pages=0,
+                    output_filename=output_filename,
+                    in_memory=IN_MEMORY_PROCESSING,
+                    worker_pid=os.getpid())
+    job_executor.submit(run_process_job, task_id, upload_path, output_filename, enhancer_kwargs, time.time())
+    metrics.inc('ppt_jobs_submitted_total')
+    
+    return jsonify({
+        'status': 'queued',
+        'task_id': task_id,
+        'message': '任务已加入队列',
+        'output_filename': output_filename
+    })
+
+
+def output_exists(output_path):
+    """输出是否已生成（磁盘文件路径或内存缓冲区）"""
+    if isinstance(output_path, str):
+        return os.path.exists(output_path)
+    return output_path.getbuffer().nbytes > 0
+
+
+def run_process_job(task_id, upload_path, output_filename, enhancer_kwargs, submitted=None):
+    """
+    在任务线程池中处理一个PPT任务，结果写入任务状态
+    
+    upload_path和enhancer_kwargs['output_path']在内存模式下分别是上传内容的文件对象和BytesIO
+    """
+    output_path = enhancer_kwargs['output_path']
+    progress_logger = ProgressLogger(task_id)
+    started = time.time()
+    final_status = 'error'
+    if submitted is not None:
+        metrics.observe('ppt_job_queue_wait_seconds', started - submitted, JOB_DURATION_BUCKETS)
+    
+    task_status.update(task_id, status='processing')
+    
+    try:
+        # 创建增强器并处理（优先使用用户在前端传入的API Key），通过事件回调接收进度
+        enhancer = PPTImageEnhancer(upload_path, event_callback=progress_logger, **enhancer_kwargs)
+        enhancer.add_event_listener(record_metrics_event)
         
         try:
-            # 创建增强器并处理（优先使用用户在前端传入的API Key）
-            enhancer = PPTImageEnhancer(
-                upload_path,
-                output_path=output_path,
-                google_api_key=req_google_api_key,
-                google_cse_id=req_google_cse_id,
-                google_ai_api_key=req_google_ai_api_key,
-                spark_api_key=req_spark_api_key,
-                spark_base_url=req_spark_base_url,
-                spark_model=req_spark_model,
-                ollama_base_url=req_ollama_base_url,
-                ollama_model=req_ollama_model,
-                exa_api_key=req_exa_api_key,
-                serp_api_key=req_serp_api_key,
-                verbose=True
-            )
-            
-            try:
-                enhancer.process_slides()
-            except Exception as process_error:
-                # 处理过程中的错误，更新状态但继续
-                error_msg = str(process_error)
-                import traceback
-                print(f"[ERROR] 处理过程中发生错误: {error_msg}")
-                print(f"[ERROR] {traceback.format_exc()}")
-                
-                # 更新任务状态为错误
-                task_status[task_id] = {
-                    'status': 'error',
-                    'progress': progress_logger.progress_percent,
-                    'current_page': progress_logger.current_page,
-                    'total_pages': progress_logger.total_pages,
-                    'error': error_msg,
-                    'logs': progress_logger.get_logs()
-                }
-                
-                # 如果输出文件存在，仍然返回成功（部分完成）
-                if os.path.exists(output_path):
-                    return jsonify({
-                        'status': 'partial_success',
-                        'task_id': task_id,
-                        'message': f'处理完成但有错误: {error_msg}',
-                        'output_filename': output_filename,
-                        'logs': progress_logger.get_logs()
-                    })
-                else:
-                    raise process_error
-            
-            # 检查输出文件是否存在
-            if not os.path.exists(output_path):
-                raise Exception("处理完成但输出文件不存在")
+            enhancer.process_slides()
+        except Exception as process_error:
+            # 处理过程中的错误，更新状态但继续
+            error_msg = str(process_error)
+            progress_logger.log(f"[ERROR] 处理过程中发生错误: {error_msg}")
+            progress_logger.log(f"[ERROR] {traceback.format_exc()}")
             
-            # 更新任务状态为完成
-            task_status[task_id] = {
-                'status': 'success',
-                'progress': 100,
-                'current_page': progress_logger.total_pages,
-                'total_pages': progress_logger.total_pages,
-                'logs': progress_logger.get_logs(),
-                'output_filename': output_filename
-            }
-            
-            # 返回成功响应（返回全部日志，不再截断）
-            return jsonify({
-                'status': 'success',
-                'task_id': task_id,
-                'message': '处理完成',
-                'output_filename': output_filename,
-                'logs': progress_logger.get_logs()  # 返回全部日志
-            })
-            
-        finally:
-            # 恢复stdout
-            sys.stdout = original_stdout
-            
-            # 清理上传的文件
-            if upload_path and os.path.exists(upload_path):
-                try:
-                    os.remove(upload_path)
-                except:
-                    pass
+            # 如果输出文件存在，仍然返回成功（部分完成）
+            if not output_exists(output_path):
+                raise
+            if isinstance(output_path, str):
+                artifacts.add(task_id, output_path, output_filename)
+            else:
+                memory_outputs.put(task_id, output_path, output_filename)
+            progress_logger.flush_to_store()
+            final_status = 'partial_success'
+            task_status.update(task_id, status='partial_success',
+                               progress=progress_logger.progress_percent,
+                               current_page=progress_logger.current_page,
+                               total_pages=progress_logger.total_pages,
+                               error=error_msg,
+                               message=f'处理完成但有错误: {error_msg}',
+                               output_filename=output_filename)
+            return
+        
+        # 检查输出文件是否存在
+        if not output_exists(output_path):
+            raise Exception("处理完成但输出文件不存在")
+        if isinstance(output_path, str):
+            artifacts.add(task_id, output_path, output_filename)
+        else:
+            memory_outputs.put(task_id, output_path, output_filename)
+        
+        # 更新任务状态为完成
+        progress_logger.flush_to_store()
+        final_status = 'success'
+        task_status.update(task_id, status='success',
+                           progress=100,
+                           current_page=progress_logger.total_pages,
+                           total_pages=progress_logger.total_pages,
+                           output_filename=output_filename)
     
     except Exception as e:
-        error_msg = str(e)
-        error_trace = traceback.format_exc()
-        
         # 更新任务状态为失败
-        if 'task_id' in locals():
-            task_status[task_id] = {
-                'status': 'error',
-                'error': error_msg,
-                'logs': progress_logger.get_logs() if 'progress_logger' in locals() else []
-            }
+        progress_logger.flush_to_store()
+        task_status.set(task_id, 'error',
+                        error=str(e),
+                        trace=traceback.format_exc() if app.debug else None)
         
-        # 清理文件
-        if upload_path and os.path.exists(upload_path):
+        # 清理输出文件
+        if isinstance(output_path, str) and os.path.exists(output_path):
             try:
-                os.remove(upload_path)
+                os.remove(output_path)
             except:
                 pass
-        if output_path and os.path.exists(output_path):
+    
+    finally:
+        labels = {'status': final_status}
+        metrics.inc('ppt_jobs_finished_total', labels=labels)
+        metrics.observe('ppt_job_duration_seconds', time.time() - started, JOB_DURATION_BUCKETS, labels=labels)
+        metrics.flush()
+        
+        # 清理上传的文件（内存模式下关闭文件对象即可释放）
+        if not isinstance(upload_path, str):
+            upload_path.close()
+        elif upload_path and os.path.exists(upload_path):
             try:
-                os.remove(output_path)
+                os.remove(upload_path)
             except:
                 pass
-        
-        return jsonify({
-            'status': 'error',
-            'error': error_msg,
-            'trace': error_trace if app.debug else None
-        }), 500
 
 
 @app.route('/api/download/<task_id>', methods=['GET'])
 def download_ppt(task_id):
-    """下载处理后的PPT文件"""
-    # 查找对应的输出文件
-    output_files = [f for f in os.listdir(OUTPUT_FOLDER) if f.startswith(task_id + '_')]
-    
-    if not output_files:
-        return jsonify({'error': '文件不存在或已过期'}), 404
-    
-    output_filename = output_files[0]
-    output_path = os.path.join(OUTPUT_FOLDER, output_filename)
+    """
+    下载处理后的PPT文件
     
-    # 提取原始文件名（去掉task_id前缀）
-    original_filename = output_filename[len(task_id) + 1:]
+    支持条件请求（ETag / If-None-Match、If-Modified-Since）和Range请求，中断的下载可以续传；
+    文件在保留期内可以重复下载，过期后由后台清理线程删除。
+    """
+    pptx_mimetype = 'application/vnd.openxmlformats-officedocument.presentationml.presentation'
+    # 内存模式：直接从内存发送
+    memory_output = memory_outputs.get(task_id)
+    if memory_output is not None:
+        data, output_filename, created = memory_output
+        # 每个请求一个独立的读取位置（send_file发送完会关闭文件对象），数据本身不复制
+        return send_file(
+            io.BytesIO(data),
+            as_attachment=True,
+            download_name=output_filename,
+            mimetype=pptx_mimetype,
+            conditional=True,
+            etag=task_id,
+            last_modified=created
+        )
+    if IN_MEMORY_PROCESSING:
+        status = task_status.get(task_id, log_limit=0)
+        if status and status.get('in_memory') and status.get('worker_pid') != os.getpid():
+            return jsonify({'error': '处理结果保存在其他worker进程的内存中，请使用单worker或按任务ID的会话保持'}), 409
     
-    @after_this_request
-    def remove_file(response):
-        """在响应发送完成后立刻删除输出文件，避免占用磁盘"""
-        try:
-            if os.path.exists(output_path):
-                os.remove(output_path)
-        except Exception:
-            # 删除失败不影响用户下载
-            pass
-        return response
+    # 按task_id查询输出文件索引
+    artifact = artifacts.get(task_id)
+    if artifact is None:
+        return jsonify({'error': '文件不存在或已过期'}), 404
     
     return send_file(
-        output_path,
+        os.path.abspath(artifact['path']),
         as_attachment=True,
-        download_name=original_filename,
-        mimetype='application/vnd.openxmlformats-officedocument.presentationml.presentation'
+        download_name=artifact['filename'],
+        mimetype=pptx_mimetype,
+        conditional=True
     )
 
 
 @app.route('/api/cleanup', methods=['POST'])
 def cleanup():
-    """清理旧文件（可选的管理接口）"""
+    """立即执行一次清理（后台清理线程也会定期执行，通常不需要手动调用）"""
     try:
-        # 清理uploads文件夹中超过1小时的文件
-        import time
-        current_time = time.time()
-        cleaned_count = 0
-        
-        for filename in os.listdir(UPLOAD_FOLDER):
-            file_path = os.path.join(UPLOAD_FOLDER, filename)
-            if os.path.isfile(file_path):
-                if current_time - os.path.getmtime(file_path) > 3600:  # 1小时
-                    os.remove(file_path)
-                    cleaned_count += 1
-        
-        # 清理outputs文件夹中超过24小时的文件
-        for filename in os.listdir(OUTPUT_FOLDER):
-            file_path = os.path.join(OUTPUT_FOLDER, filename)
-            if os.path.isfile(file_path):
-                if current_time - os.path.getmtime(file_path) > 86400:  # 24小时
-                    os.remove(file_path)
-                    cleaned_count += 1
-        
         return jsonify({
             'status': 'success',
-            'cleaned_files': cleaned_count
+            'cleaned_files': run_janitor()
         })
     except Exception as e:
         return jsonify({'error': str(e)}), 500